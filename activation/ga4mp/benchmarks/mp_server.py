@@ -0,0 +1,221 @@
+"""
+Local stand-in for the Measurement Protocol endpoints `/mp/collect` and
+`/debug/mp/collect`, with configurable latency, error rate and 429 injection.
+
+    python -m activation.ga4mp.benchmarks.mp_server --port 8080 --latency-ms 50 --throttle-rate 0.01
+
+prints its endpoint on the first line of stdout and serves until interrupted.
+`GET /stats` returns the number of requests and events received, the status codes
+sent and the server side latency percentiles.
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+MP_PATHS = ("/mp/collect", "/debug/mp/collect")
+
+
+def percentile(values, p):
+    if not values:
+        return None
+
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+class MeasurementProtocolHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        start = time.monotonic()
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        path = urlsplit(self.path).path
+        status, headers, content = self.server.respond(self.path, path, body)
+
+        delay = self.server.delay()
+        if delay:
+            time.sleep(delay)
+
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(content)))
+        if self.headers.get("Connection", "").lower() == "close":
+            self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(content)
+
+        self.server.record(status, time.monotonic() - start)
+
+    def do_GET(self):
+        if urlsplit(self.path).path != "/stats":
+            self.send_error(404)
+            return
+
+        content = json.dumps(self.server.stats()).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class MeasurementProtocolServer(ThreadingHTTPServer):
+    """
+    Answers 204 (`/mp/collect`) or 200 with an empty validation result
+    (`/debug/mp/collect`). `statuses` queues status codes for the next requests and
+    requests of a client_id in `fail_clients` are answered with 400, which makes
+    failures deterministic in tests; error_rate and throttle_rate inject 500 and 429
+    responses at random for load tests.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=0,
+        latency=0.0,
+        latency_jitter=0.0,
+        error_rate=0.0,
+        throttle_rate=0.0,
+        retry_after=None,
+        seed=None,
+    ):
+        super().__init__((host, port), MeasurementProtocolHandler)
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.received = []
+        self.paths = []
+        self.statuses = []
+        self.fail_clients = set()
+        self.latencies = []
+        self.status_counts = {}
+        self.events = 0
+        self.thread = None
+
+    @property
+    def endpoint(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def delay(self):
+        with self.lock:
+            return self.latency + self.random.uniform(0, self.latency_jitter)
+
+    def respond(self, raw_path, path, body):
+        # (status, headers, content) of the response to a POST
+        if path not in MP_PATHS:
+            return 404, {}, b""
+
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            return 400, {}, b""
+
+        with self.lock:
+            self.received.append(body)
+            self.paths.append(raw_path)
+            self.events += len(payload.get("events", []))
+
+            if payload.get("client_id") in self.fail_clients:
+                return 400, {}, b""
+
+            if self.statuses:
+                return self.statuses.pop(0), {}, b""
+
+            draw = self.random.random()
+
+        if draw < self.throttle_rate:
+            headers = {}
+            if self.retry_after is not None:
+                headers["Retry-After"] = str(self.retry_after)
+            return 429, headers, b""
+
+        if draw < self.throttle_rate + self.error_rate:
+            return 500, {}, b""
+
+        if path == "/debug/mp/collect":
+            content = json.dumps({"validationMessages": []}).encode()
+            return 200, {"Content-Type": "application/json"}, content
+
+        return 204, {}, b""
+
+    def record(self, status, latency):
+        with self.lock:
+            self.latencies.append(latency)
+            self.status_counts[status] = self.status_counts.get(status, 0) + 1
+
+    def stats(self):
+        with self.lock:
+            latencies = list(self.latencies)
+            return {
+                "requests": len(self.received),
+                "events": self.events,
+                "status_counts": {str(k): v for k, v in self.status_counts.items()},
+                "latency_p50": percentile(latencies, 50),
+                "latency_p99": percentile(latencies, 99),
+            }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--latency-jitter-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=float, default=None)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    server = MeasurementProtocolServer(
+        args.host,
+        args.port,
+        latency=args.latency_ms / 1000,
+        latency_jitter=args.latency_jitter_ms / 1000,
+        error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate,
+        retry_after=args.retry_after,
+        seed=args.seed,
+    )
+    print(server.endpoint, flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
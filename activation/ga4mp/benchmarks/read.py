@@ -0,0 +1,196 @@
+"""
+Decoding cost of the activation source per read method, with a local fake reader
+standing in for BigQuery (no GCP calls).
+
+    python -m activation.ga4mp.benchmarks.read --rows 100000
+
+EXPORT decodes the newline delimited JSON files of a `SELECT *` export with the coder
+ReadFromBigQuery uses, DIRECT_READ decodes Storage Read API responses (Avro blocks with
+fastavro, or Arrow record batches) of the projected payload columns only. Each row then
+goes through TransformToPayload. The export job and the GCS round trip of EXPORT are
+not included, so the numbers understate the difference on a real run.
+"""
+
+import argparse
+import datetime
+import io
+import json
+import random
+import time
+from types import SimpleNamespace
+
+import fastavro
+import pyarrow as pa
+from apache_beam.io.gcp.bigquery import _ReadReadRowsResponsesWithFastAvro
+from apache_beam.io.gcp.bigquery_read_internal import _JsonToDictCoder
+from apache_beam.io.gcp.internal.clients import bigquery
+
+from activation.ga4mp.main import TransformToPayload, payload_fields
+
+ROWS_PER_RESPONSE = 1000
+
+# (name, BigQuery type, avro type, arrow type)
+COLUMNS = [
+    ("client_id", "STRING", "string", pa.string()),
+    ("user_id", "STRING", "string", pa.string()),
+    (
+        "event_timestamp",
+        "TIMESTAMP",
+        {"type": "long", "logicalType": "timestamp-micros"},
+        pa.timestamp("us", tz="UTC"),
+    ),
+    ("event_name", "STRING", "string", pa.string()),
+    ("stream_id", "STRING", "string", pa.string()),
+    *[(f"ep_param_{i}", "FLOAT", "double", pa.float64()) for i in range(8)],
+    *[(f"up_prop_{i}", "STRING", "string", pa.string()) for i in range(2)],
+    # prediction features materialized by the activation query but not sent
+    *[(f"feature_{i}", "INTEGER", "long", pa.int64()) for i in range(20)],
+]
+
+
+def make_rows(n):
+    start = datetime.datetime(2023, 2, 25, tzinfo=datetime.timezone.utc)
+    rows = []
+    for i in range(n):
+        row = {
+            "client_id": f"{random.randint(10**8, 10**9)}.{random.randint(10**8, 10**9)}",
+            "user_id": str(i),
+            "event_timestamp": start
+            + datetime.timedelta(seconds=random.randint(0, 86400)),
+            "event_name": "maj_purchase_propensity_30_15",
+            "stream_id": "1234567890",
+        }
+        for name, bq_type, _, _ in COLUMNS[5:]:
+            if bq_type == "FLOAT":
+                row[name] = random.random()
+            elif bq_type == "STRING":
+                row[name] = f"segment_{random.randint(0, 9)}"
+            else:
+                row[name] = random.randint(0, 10**6)
+        rows.append(row)
+
+    return rows
+
+
+def export_reader(rows):
+    schema = bigquery.TableSchema(
+        fields=[
+            bigquery.TableFieldSchema(name=name, type=bq_type, mode="NULLABLE")
+            for name, bq_type, _, _ in COLUMNS
+        ]
+    )
+    lines = []
+    for row in rows:
+        row = dict(row)
+        row["event_timestamp"] = row["event_timestamp"].strftime(
+            "%Y-%m-%d %H:%M:%S UTC"
+        )
+        for name, bq_type, _, _ in COLUMNS:
+            if bq_type == "INTEGER":
+                row[name] = str(row[name])  # exported as JSON strings
+        lines.append(json.dumps(row).encode("utf-8"))
+
+    def read():
+        coder = _JsonToDictCoder(schema)
+        return (coder.decode(line) for line in lines)
+
+    return read
+
+
+def avro_reader(rows, fields):
+    avro_schema = {
+        "type": "record",
+        "name": "__root__",
+        "fields": [
+            {"name": name, "type": ["null", avro_type]}
+            for name, _, avro_type, _ in COLUMNS
+            if name in fields
+        ],
+    }
+    parsed_schema = fastavro.parse_schema(avro_schema)
+    responses = []
+    for i in range(0, len(rows), ROWS_PER_RESPONSE):
+        buf = io.BytesIO()
+        for row in rows[i : i + ROWS_PER_RESPONSE]:
+            fastavro.schemaless_writer(
+                buf, parsed_schema, {name: row[name] for name in fields}
+            )
+        responses.append(
+            SimpleNamespace(
+                avro_schema=SimpleNamespace(schema=json.dumps(avro_schema)),
+                avro_rows=SimpleNamespace(serialized_binary_rows=buf.getvalue()),
+            )
+        )
+
+    def read():
+        it = iter(responses)
+        return _ReadReadRowsResponsesWithFastAvro(it, next(it))
+
+    return read
+
+
+def arrow_reader(rows, fields):
+    schema = pa.schema([(name, t) for name, _, _, t in COLUMNS if name in fields])
+    responses = []
+    for i in range(0, len(rows), ROWS_PER_RESPONSE):
+        batch = pa.RecordBatch.from_pylist(rows[i : i + ROWS_PER_RESPONSE], schema)
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, schema) as writer:
+            writer.write_batch(batch)
+        responses.append(sink.getvalue())
+
+    def read():
+        # same per value conversion as ReadFromBigQuery does for Arrow streams
+        for response in responses:
+            for batch in pa.ipc.open_stream(response):
+                columns = list(zip(batch.schema.names, batch.columns))
+                for i in range(batch.num_rows):
+                    yield {name: column[i].as_py() for name, column in columns}
+
+    return read
+
+
+def measure(read, repeat):
+    best_read, best_total = None, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        decoded = list(read())
+        read_elapsed = time.perf_counter() - start
+
+        transform = TransformToPayload()
+        for row in decoded:
+            for _ in transform.process(row):
+                pass
+        total_elapsed = time.perf_counter() - start
+
+        best_read = read_elapsed if best_read is None else min(best_read, read_elapsed)
+        best_total = (
+            total_elapsed if best_total is None else min(best_total, total_elapsed)
+        )
+
+    return best_read / len(decoded) * 1e6, best_total / len(decoded) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    rows = make_rows(args.rows)
+    fields = payload_fields(name for name, _, _, _ in COLUMNS)
+    readers = {
+        "EXPORT (JSON)": export_reader(rows),
+        "DIRECT_READ (AVRO)": avro_reader(rows, fields),
+        "DIRECT_READ (ARROW)": arrow_reader(rows, fields),
+    }
+
+    print(f"{len(COLUMNS)} columns, {len(fields)} projected by DIRECT_READ")
+    print(f"{'read method':<22}{'decode us/row':>15}{'decode+transform us/row':>26}")
+    for name, read in readers.items():
+        decode, total = measure(read, args.repeat)
+        print(f"{name:<22}{decode:>15.2f}{total:>26.2f}")
+
+
+if __name__ == "__main__":
+    main()
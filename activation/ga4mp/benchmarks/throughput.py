@@ -0,0 +1,184 @@
+"""
+Activation throughput against the local Measurement Protocol stand-in server.
+
+    python -m activation.ga4mp.benchmarks.throughput --rows 20000 --latency-ms 30 \
+        --mp_max_in_flight 8
+
+runs activation.ga4mp.main.run (or the in-process engine with --engine inprocess) on
+synthetic source rows, with the BigQuery source and log tables replaced, and reports
+events/sec, the client side latencies and the CPU time of the driver and the Beam worker
+processes. The send latency (send_latency_ms metric) of a request runs from its batch
+reaching the sender to the last response, so it includes the wait for a sender thread,
+the rate limit pacing and the retries; Beam distributions only keep its mean and max.
+The server side p50/p99 handler latency is shown next to it. Unknown arguments are
+passed to the pipeline, e.g. --mp_batch_size 10 or --direct_running_mode in_memory.
+With --min-events-per-sec the exit code is non-zero below that throughput, to use the
+benchmark as a regression gate.
+"""
+
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+import urllib.request
+
+import apache_beam as beam
+from apache_beam.options.pipeline_options import DirectOptions
+
+from activation.ga4mp import inprocess, main as activation
+
+PREDICTION_RUN_ID = "202309172113"
+
+
+def synthetic_rows(n, clients, event_params=4):
+    rows = []
+    for i in range(n):
+        row = {
+            "client_id": f"{i % clients}.1677283200",
+            "event_timestamp": "2023-02-25 10:00:00 UTC",
+            "event_name": f"maj_purchase_propensity_{i // clients}",
+            "stream_id": "1234567890",
+        }
+        for p in range(event_params):
+            row[f"ep_param_{p}"] = (i * 31 + p) % 1000 / 10
+        rows.append(row)
+
+    return rows
+
+
+def start_server(args):
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "activation.ga4mp.benchmarks.mp_server",
+            f"--latency-ms={args.latency_ms}",
+            f"--latency-jitter-ms={args.latency_jitter_ms}",
+            f"--error-rate={args.error_rate}",
+            f"--throttle-rate={args.throttle_rate}",
+            "--seed=0",
+        ]
+        + (
+            [f"--retry-after={args.retry_after}"]
+            if args.retry_after is not None
+            else []
+        ),
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    return process, process.stdout.readline().strip()
+
+
+def server_stats(endpoint):
+    with urllib.request.urlopen(f"{endpoint}/stats") as response:
+        return json.loads(response.read())
+
+
+def cpu_seconds(who):
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+
+def ms(value):
+    # metrics are None when no request was sent
+    return "-" if value is None else f"{value:.1f} ms"
+
+
+def flags_to_params(flags):
+    # ["--name=value"] or ["--name", "value"] to {"name": "value"}
+    params, flags = {}, list(flags)
+    while flags:
+        name, sep, value = flags.pop(0).lstrip("-").partition("=")
+        params[name] = value if sep else flags.pop(0)
+
+    return params
+
+
+def run_benchmark(args, pipeline_args, endpoint):
+    params = {
+        "project": "benchmark",
+        "source_table": "benchmark.activation_rows",
+        "log_db_dataset": "benchmark",
+        "prediction_run_id": PREDICTION_RUN_ID,
+        "ga4_measurement_id": "G-BENCHMARK",
+        "ga4_api_secret": "benchmark",
+        "mp_endpoint": endpoint,
+    }
+    rows = synthetic_rows(args.rows, args.clients)
+
+    if args.engine == "inprocess":
+        options = DirectOptions.from_dictionary(
+            {**params, **flags_to_params(pipeline_args)}
+        ).view_as(activation.ActivationOptions)
+        with inprocess.metrics_scope() as container:
+            inprocess.activate(rows, options)
+        return inprocess.container_summary(container)
+
+    return activation.run(
+        {
+            **params,
+            "direct_running_mode": "multi_processing",
+            "direct_num_workers": 0,
+            **flags_to_params(pipeline_args),
+        },
+        source=beam.Create(rows),
+        sink=lambda *args: beam.Map(lambda row: None),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--engine", choices=["beam", "inprocess"], default="beam")
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--clients", type=int, default=5000)
+    parser.add_argument("--latency-ms", type=float, default=30.0)
+    parser.add_argument("--latency-jitter-ms", type=float, default=10.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=float, default=None)
+    parser.add_argument("--min-events-per-sec", type=float, default=None)
+    args, pipeline_args = parser.parse_known_args()
+
+    server, endpoint = start_server(args)
+    try:
+        driver_cpu, workers_cpu = cpu_seconds(resource.RUSAGE_SELF), cpu_seconds(
+            resource.RUSAGE_CHILDREN
+        )
+        start = time.perf_counter()
+        summary = run_benchmark(args, pipeline_args, endpoint)
+        elapsed = time.perf_counter() - start
+        # the server is still running, so RUSAGE_CHILDREN only has the Beam workers
+        driver_cpu = cpu_seconds(resource.RUSAGE_SELF) - driver_cpu
+        workers_cpu = cpu_seconds(resource.RUSAGE_CHILDREN) - workers_cpu
+        stats = server_stats(endpoint)
+    finally:
+        server.terminate()
+        server.wait()
+
+    events_per_sec = args.rows / elapsed
+    print(f"engine:            {args.engine} {' '.join(pipeline_args)}")
+    print(f"events:            {args.rows} in {elapsed:.2f}s")
+    print(f"events/sec:        {events_per_sec:.1f}")
+    print(f"requests received: {stats['requests']} ({stats['events']} events)")
+    print(f"status codes:      {stats['status_counts']}")
+    print(
+        f"send latency:      client mean {ms(summary['send_latency_ms_mean'])}, "
+        f"max {ms(summary['send_latency_ms_max'])} | "
+        f"server p50 {stats['latency_p50'] * 1000:.1f} ms, "
+        f"p99 {stats['latency_p99'] * 1000:.1f} ms"
+    )
+    print(
+        f"http latency:      client mean {ms(summary['http_latency_ms_mean'])}, "
+        f"max {ms(summary['http_latency_ms_max'])}"
+    )
+    print(f"cpu:               driver {driver_cpu:.2f}s, workers {workers_cpu:.2f}s")
+
+    if args.min_events_per_sec is not None and events_per_sec < args.min_events_per_sec:
+        print(f"below the {args.min_events_per_sec} events/sec gate")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+Per-row cost of TransformToPayload.
+
+    python -m activation.ga4mp.benchmarks.transform --rows 100000
+
+LegacyTransformToPayload is the implementation before the schema was compiled
+(deepcopy of a template, per-row key classification and strptime probing), kept
+here only to compare against.
+"""
+
+import argparse
+import datetime
+import random
+import time
+from copy import deepcopy
+
+import pytz
+
+from activation.ga4mp.main import TransformToPayload
+
+
+class LegacyTransformToPayload:
+    def __init__(self):
+        self.date_formats = [
+            "%Y-%m-%d %H:%M:%S.%f UTC",
+            "%Y-%m-%d %H:%M:%S UTC",
+            "%Y-%m-%d %H:%M:%S",
+            "%Y-%m-%d",
+        ]
+        self.payload_template = {
+            "client_id": None,
+            "timestamp_micros": None,
+            "nonPersonalizedAds": False,
+            "events": [{"name": None, "params": {}}],
+        }
+
+    def process(self, element):
+        hit = deepcopy(self.payload_template)
+        hit["client_id"] = element["client_id"]
+        if "user_id" in element:
+            hit["user_id"] = element["user_id"]
+        hit["timestamp_micros"] = self.date_to_micro(element["event_timestamp"])
+        hit["events"][0]["name"] = element["event_name"]
+
+        up, ep = self.extract_params(element)
+        if up:
+            hit["user_properties"] = up
+        if ep:
+            hit["events"][0]["params"] = ep
+        if "user_data" in element:
+            hit["user_data"] = element["user_data"]
+        if "stream_id" in element:
+            hit["stream_id"] = element["stream_id"]
+
+        yield hit
+
+    def date_to_micro(self, date_str):
+        ts = None
+        for df in self.date_formats:
+            try:
+                dt = datetime.datetime.strptime(date_str, df)
+                dt = dt.replace(tzinfo=pytz.utc)
+                ts = int(dt.timestamp() * 1e6)
+                break
+            except:
+                pass
+
+        return ts
+
+    def extract_params(self, element):
+        el = element.copy()
+        user_props, event_props = {}, {}
+
+        for k, v in el.items():
+            k_clean = k[3:-1] if k.endswith("_") else k[3:]
+            if k.startswith("up_") and v is not None:
+                user_props[k_clean] = {"value": v}
+
+            elif k.startswith("ep_") and v is not None:
+                event_props[k_clean] = v
+
+        return user_props, event_props
+
+
+def make_rows(n, event_params=8, user_props=2, timestamp_format="%Y-%m-%d"):
+    start = datetime.datetime(2023, 2, 25)
+    rows = []
+    for i in range(n):
+        ts = start + datetime.timedelta(seconds=random.randint(0, 86400))
+        row = {
+            "client_id": f"{random.randint(10**8, 10**9)}.{random.randint(10**8, 10**9)}",
+            "user_id": str(i),
+            "event_timestamp": ts.strftime(timestamp_format),
+            "event_name": "maj_purchase_propensity_30_15",
+            "stream_id": "1234567890",
+        }
+        for p in range(event_params):
+            row[f"ep_param_{p}"] = random.random() if p % 2 else None
+        for p in range(user_props):
+            row[f"up_prop_{p}"] = f"segment_{p}"
+        rows.append(row)
+
+    return rows
+
+
+def per_row_us(transform, rows, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for row in rows:
+            for _ in transform.process(row):
+                pass
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best / len(rows) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    formats = {
+        "date": "%Y-%m-%d",
+        "datetime": "%Y-%m-%d %H:%M:%S",
+        "timestamp (UTC)": "%Y-%m-%d %H:%M:%S.%f UTC",
+    }
+    print(f"{'event_timestamp':<18}{'legacy us/row':>15}{'compiled us/row':>17}")
+    for name, timestamp_format in formats.items():
+        rows = make_rows(args.rows, timestamp_format=timestamp_format)
+        legacy = per_row_us(LegacyTransformToPayload(), rows, args.repeat)
+        compiled = per_row_us(TransformToPayload(), rows, args.repeat)
+        print(f"{name:<18}{legacy:>15.2f}{compiled:>17.2f}")
+
+
+if __name__ == "__main__":
+    main()
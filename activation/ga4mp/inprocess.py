@@ -0,0 +1,215 @@
+"""
+In-process engine for small activation runs.
+
+Runs the same transform, batching, send and log steps as the Beam pipeline in
+activation.ga4mp.main, without pipeline construction and worker processes: rows are
+streamed from the source table, requests are sent from a thread pool and each log
+table gets a single load job.
+"""
+
+import contextlib
+import json
+import logging
+
+import apache_beam as beam
+from apache_beam.io.gcp import bigquery_tools
+from google.cloud import bigquery
+
+try:  # Beam worker internals, only used to collect the metrics (see metrics_scope)
+    from apache_beam.metrics.execution import MetricsContainer
+    from apache_beam.runners.worker import statesampler
+    from apache_beam.utils.counters import CounterFactory
+except ImportError:
+    MetricsContainer = statesampler = CounterFactory = None
+
+from common.bigquery_ops import get_client
+from activation.ga4mp.main import (
+    DEAD_LETTER_TABLE_NAME,
+    DEAD_LETTER_TABLE_SCHEMA,
+    LOG_TABLE_NAME,
+    LOG_TABLE_SCHEMA,
+    ActivationOptions,
+    BatchPayloads,
+    CallMeasurementProtocolAPI,
+    ToDeadLetterFormat,
+    ToLogFormat,
+    TransformToPayload,
+    check_resume,
+    metric_totals,
+    metrics_summary,
+    mp_limits,
+    options_from_dict,
+    payload_fields,
+    sent_payloads_query,
+)
+from activation.ga4mp.payload import EncodedPayload
+
+
+def activate(rows, activation_options, sent=frozenset()):
+    """
+    Sends the activation rows and returns the (log rows, dead letter rows) the Beam
+    pipeline would write for them.
+    """
+    transform = TransformToPayload()
+    groups = {}
+    for row in rows:
+        for payload in transform.process(row):
+            payload = EncodedPayload.from_dict(payload)
+            if payload.md5 in sent:
+                continue
+            groups.setdefault(payload.key, []).append(payload)
+
+    # all requests go through one sender, so keep its whole connection pool busy
+    max_in_flight = max(
+        activation_options.mp_max_in_flight, activation_options.mp_pool_size
+    )
+    sender = CallMeasurementProtocolAPI(
+        activation_options.project,
+        activation_options.ga4_measurement_id,
+        activation_options.ga4_api_secret,
+        debug=activation_options.use_api_validation,
+        pool_size=activation_options.mp_pool_size,
+        keep_alive=activation_options.mp_keep_alive,
+        max_in_flight=max_in_flight,
+        limits=mp_limits(activation_options),
+        max_retries=activation_options.mp_max_retries,
+        endpoint=activation_options.mp_endpoint,
+        secrets_ttl=activation_options.mp_secrets_ttl,
+    )
+    batcher = BatchPayloads(activation_options.mp_batch_size)
+    to_log = ToLogFormat(
+        activation_options.prediction_run_id, activation_options.log_detail
+    )
+    to_dead_letter = ToDeadLetterFormat(activation_options.prediction_run_id)
+
+    log_rows, dead_letter_rows = [], []
+
+    def collect(outputs):
+        for output in outputs:
+            if isinstance(output, beam.pvalue.TaggedOutput):
+                dead_letter_rows.extend(to_dead_letter.process(output.value))
+            else:
+                log_rows.extend(to_log.process(output))
+
+    sender.setup()
+    try:
+        for key, payloads in groups.items():
+            for batch in batcher.process((key, payloads)):
+                collect(sender.process(batch, window=None, timestamp=None))
+        collect(sender.finish_bundle())
+    finally:
+        sender.teardown()
+
+    return log_rows, dead_letter_rows
+
+
+@contextlib.contextmanager
+def metrics_scope():
+    """
+    Collects the Beam Metrics updated in the current thread into the yielded
+    MetricsContainer, as a Beam worker does for the DoFns of a step.
+
+    This relies on Beam worker internals (tested with the pinned apache-beam version):
+    if they are missing or changed the activation still runs, but None is yielded and
+    its metrics are not collected.
+    """
+    try:
+        container = MetricsContainer("activate")
+        sampler = statesampler.StateSampler("inprocess", CounterFactory())
+        state = sampler.scoped_state("activate", "process", metrics_container=container)
+    except (AttributeError, TypeError) as e:
+        logging.warning(f"In-process activation metrics are not collected: {e!r}")
+        yield None
+        return
+
+    statesampler.set_current_tracker(sampler)
+    try:
+        with state:
+            yield container
+    finally:
+        statesampler.set_current_tracker(None)
+
+
+def container_summary(container):
+    if container is None:  # see metrics_scope
+        return metrics_summary({}, {})
+
+    updates = container.get_cumulative()
+    return metrics_summary(*metric_totals(updates.counters, updates.distributions))
+
+
+def _json_row(row):
+    # same value encoding as WriteToBigQuery uses for its load files
+    return json.loads(json.dumps(row, default=bigquery_tools.default_encoder))
+
+
+def load_rows(client, rows, table_id, schema, clustering_fields):
+    if not rows:
+        return
+
+    job_config = bigquery.LoadJobConfig(
+        schema=[bigquery.SchemaField.from_api_repr(f) for f in schema["fields"]],
+        write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+        create_disposition=bigquery.CreateDisposition.CREATE_IF_NEEDED,
+        time_partitioning=bigquery.TimePartitioning(
+            type_=bigquery.TimePartitioningType.DAY, field="prediction_run_ts"
+        ),
+        clustering_fields=clustering_fields,
+        schema_update_options=[bigquery.SchemaUpdateOption.ALLOW_FIELD_ADDITION],
+    )
+    client.load_table_from_json(
+        [_json_row(row) for row in rows], table_id, job_config=job_config
+    ).result()
+
+
+def run(params):
+    """
+    Same as activation.ga4mp.main.run, returns the metrics_summary of the run.
+    """
+    activation_options = options_from_dict(params).view_as(ActivationOptions)
+    if activation_options.prediction_run_id is None:
+        raise ValueError("--prediction_run_id is required")
+    if activation_options.source_table is None:
+        raise ValueError("--source_table is required")
+
+    client = get_client(activation_options.project)
+    table = client.get_table(activation_options.source_table)
+    fields = set(payload_fields(f.name for f in table.schema))
+    rows = (
+        dict(row.items())
+        for row in client.list_rows(
+            table, selected_fields=[f for f in table.schema if f.name in fields]
+        )
+    )
+
+    sent = frozenset()
+    if activation_options.resume:
+        check_resume(client, activation_options)
+        sent = frozenset(
+            row["payload_md5"]
+            for row in client.query(sent_payloads_query(activation_options)).result()
+        )
+
+    with metrics_scope() as container:
+        log_rows, dead_letter_rows = activate(rows, activation_options, sent)
+    logging.info(
+        f"Sent {len(log_rows)} events in-process, {len(dead_letter_rows)} failed"
+    )
+
+    dataset = f"{activation_options.project}.{activation_options.log_db_dataset}"
+    load_rows(
+        client,
+        log_rows,
+        f"{dataset}.{LOG_TABLE_NAME}",
+        LOG_TABLE_SCHEMA,
+        ["state", "client_id"],
+    )
+    load_rows(
+        client,
+        dead_letter_rows,
+        f"{dataset}.{DEAD_LETTER_TABLE_NAME}",
+        DEAD_LETTER_TABLE_SCHEMA,
+        ["prediction_run_id", "client_id"],
+    )
+
+    return container_summary(container)
@@ -1,17 +1,134 @@
-import datetime, pytz
-import hashlib
+import datetime
+import concurrent.futures
 import json
 import logging
+import os
+import threading
+import time
+import typing
 import uuid
-from copy import deepcopy
-from decimal import Decimal
 
 import apache_beam as beam
 import requests
+from apache_beam.io.gcp import bigquery_tools
 from apache_beam.io.gcp.internal.clients import bigquery
-from apache_beam.options.pipeline_options import GoogleCloudOptions, DirectOptions
+from apache_beam.metrics import Metrics
+from apache_beam.options.pipeline_options import (
+    DirectOptions,
+    GoogleCloudOptions,
+    StandardOptions,
+    WorkerOptions,
+)
+from apache_beam.utils import shared
+from apache_beam.utils.windowed_value import WindowedValue
 from google.cloud import secretmanager
 
+from activation.ga4mp.payload import EncodedPayload, batch_body
+from activation.ga4mp.rate_limit import (
+    RETRYABLE_STATUS_CODES,
+    backoff_delay,
+    get_limiter,
+)
+
+MP_ENDPOINT = "https://www.google-analytics.com"
+MP_MAX_EVENTS_PER_REQUEST = 25  # GA4 MP limit of events in a single request
+MP_MAX_REQUEST_BYTES = 130000  # GA4 MP limit of the POST body size
+
+LOG_TABLE_NAME = "activation_ga4mp_log"
+LOG_TABLE_SCHEMA = {
+    "fields": [
+        {"name": "prediction_run_ts", "type": "TIMESTAMP", "mode": "REQUIRED"},
+        {"name": "prediction_run_id", "type": "STRING", "mode": "REQUIRED"},
+        {"name": "id", "type": "STRING", "mode": "REQUIRED"},
+        {"name": "client_id", "type": "STRING", "mode": "REQUIRED"},
+        {"name": "event_name", "type": "STRING", "mode": "REQUIRED"},
+        {"name": "payload_md5", "type": "STRING", "mode": "REQUIRED"},
+        {"name": "payload", "type": "STRING", "mode": "REQUIRED"},
+        {"name": "response", "type": "STRING", "mode": "REQUIRED"},
+        {"name": "state", "type": "STRING", "mode": "REQUIRED"},
+    ]
+}
+
+# full: every event with its payload and response
+# hash_only: successful events only keep client_id, payload_md5 and state
+# failures_only: successful events are not logged
+LOG_DETAILS = ("full", "hash_only", "failures_only")
+
+DEAD_LETTER_TABLE_NAME = "activation_ga4mp_dead_letter"
+DEAD_LETTER_TABLE_SCHEMA = {
+    "fields": [
+        {"name": "prediction_run_ts", "type": "TIMESTAMP", "mode": "REQUIRED"},
+        {"name": "prediction_run_id", "type": "STRING", "mode": "REQUIRED"},
+        {"name": "client_id", "type": "STRING", "mode": "REQUIRED"},
+        {"name": "event_name", "type": "STRING", "mode": "REQUIRED"},
+        {"name": "stream_id", "type": "STRING", "mode": "NULLABLE"},
+        {"name": "payload_md5", "type": "STRING", "mode": "REQUIRED"},
+        {"name": "payload", "type": "STRING", "mode": "REQUIRED"},
+        {"name": "status_code", "type": "INTEGER", "mode": "REQUIRED"},
+        {"name": "response", "type": "STRING", "mode": "NULLABLE"},
+        {"name": "attempts", "type": "INTEGER", "mode": "REQUIRED"},
+        {"name": "retryable", "type": "BOOLEAN", "mode": "REQUIRED"},
+        {"name": "first_attempt_ts", "type": "TIMESTAMP", "mode": "NULLABLE"},
+        {"name": "last_attempt_ts", "type": "TIMESTAMP", "mode": "NULLABLE"},
+    ]
+}
+
+RUN_STATS_TABLE_NAME = "activation_ga4mp_run_stats"
+RUN_STATS_TABLE_SCHEMA = {
+    "fields": [
+        {"name": "prediction_run_ts", "type": "TIMESTAMP", "mode": "REQUIRED"},
+        {"name": "prediction_run_id", "type": "STRING", "mode": "REQUIRED"},
+        {"name": "engine", "type": "STRING", "mode": "REQUIRED"},
+        {"name": "started_ts", "type": "TIMESTAMP", "mode": "REQUIRED"},
+        {"name": "duration_s", "type": "FLOAT", "mode": "REQUIRED"},
+        {"name": "rows_in", "type": "INTEGER", "mode": "REQUIRED"},
+        {"name": "events_sent_ok", "type": "INTEGER", "mode": "REQUIRED"},
+        {"name": "events_send_fail", "type": "INTEGER", "mode": "REQUIRED"},
+        {"name": "events_unknown_stream", "type": "INTEGER", "mode": "REQUIRED"},
+        {"name": "events_per_sec", "type": "FLOAT", "mode": "REQUIRED"},
+        {"name": "requests", "type": "INTEGER", "mode": "REQUIRED"},
+        {"name": "retries", "type": "INTEGER", "mode": "REQUIRED"},
+        {"name": "request_errors", "type": "INTEGER", "mode": "REQUIRED"},
+        {"name": "payload_bytes", "type": "INTEGER", "mode": "REQUIRED"},
+        {"name": "request_bytes", "type": "INTEGER", "mode": "REQUIRED"},
+        {"name": "http_latency_ms_mean", "type": "FLOAT", "mode": "NULLABLE"},
+        {"name": "http_latency_ms_max", "type": "INTEGER", "mode": "NULLABLE"},
+        {"name": "send_latency_ms_mean", "type": "FLOAT", "mode": "NULLABLE"},
+        {"name": "send_latency_ms_max", "type": "INTEGER", "mode": "NULLABLE"},
+        {
+            "name": "status_codes",
+            "type": "RECORD",
+            "mode": "REPEATED",
+            "fields": [
+                {"name": "status_code", "type": "INTEGER", "mode": "REQUIRED"},
+                {"name": "responses", "type": "INTEGER", "mode": "REQUIRED"},
+            ],
+        },
+    ]
+}
+
+
+BOOLEAN_OPTIONS = ("mp_keep_alive", "resume")
+
+
+def str_to_bool(value):
+    # argparse type of the boolean options, bool("False") would be True
+    return str(value).lower() in ("1", "true", "yes")
+
+
+def options_from_dict(params):
+    """
+    DirectOptions of a dict of options. from_dictionary drops False values, so the
+    boolean ActivationOptions are passed with their value, e.g. --mp_keep_alive=False
+    overriding its True default.
+    """
+    return DirectOptions.from_dictionary(
+        {
+            k: str(v) if k in BOOLEAN_OPTIONS and isinstance(v, bool) else v
+            for k, v in params.items()
+        }
+    )
+
 
 class ActivationOptions(DirectOptions):
     @classmethod
@@ -26,14 +143,12 @@ class ActivationOptions(DirectOptions):
         parser.add_argument(
             "--source_table",
             type=str,
-            help="table specification for the source data. Format [dataset.data_table]",
-            required=True,
+            help="table specification for the source data. Format [dataset.data_table], required by batch runs",
         )
         parser.add_argument(
             "--prediction_run_id",
             type=str,
-            help="Run id of the prediction - YYYYMMDDHHmm",
-            required=True,
+            help="Run id of the prediction - YYYYMMDDHHmm, required by batch runs",
         )
 
         parser.add_argument(
@@ -61,94 +176,568 @@ class ActivationOptions(DirectOptions):
             default=False,
             nargs="?",
         )
+        parser.add_argument(
+            "--mp_batch_size",
+            type=int,
+            help="Max number of events of the same client sent in a single Measurement Protocol request (1 skips the grouping of the events)",
+            default=MP_MAX_EVENTS_PER_REQUEST,
+        )
+        parser.add_argument(
+            "--mp_pool_size",
+            type=int,
+            help="Max number of pooled HTTP connections per worker to the Measurement Protocol API",
+            default=10,
+        )
+        parser.add_argument(
+            "--mp_keep_alive",
+            type=str_to_bool,
+            help="Keep HTTP connections to the Measurement Protocol API alive between requests",
+            default=True,
+            nargs="?",
+            const=True,
+        )
+        parser.add_argument(
+            "--mp_max_in_flight",
+            type=int,
+            help="Max number of concurrent Measurement Protocol requests per worker (1 sends synchronously)",
+            default=1,
+        )
+        parser.add_argument(
+            "--mp_rate_limit",
+            type=float,
+            help="Max Measurement Protocol requests per second per measurement_id/stream across all workers (0 means no pacing)",
+            default=0,
+        )
+        parser.add_argument(
+            "--mp_max_concurrency",
+            type=int,
+            help="Ceiling of the adaptive number of concurrent requests per measurement_id/stream and worker",
+            default=32,
+        )
+        parser.add_argument(
+            "--mp_max_retries",
+            type=int,
+            help="Number of retries with jittered backoff for 429/5xx responses and connection errors",
+            default=3,
+        )
+        parser.add_argument(
+            "--mp_stream_limits",
+            type=str,
+            help='JSON with per measurement_id/stream_id overrides, e.g. {"<stream_id>": {"rate": 50, "max_concurrency": 8}}',
+            default="{}",
+        )
+        parser.add_argument(
+            "--mp_endpoint",
+            type=str,
+            help="Measurement Protocol host, e.g. a local stand-in server for load tests",
+            default=MP_ENDPOINT,
+        )
+        parser.add_argument(
+            "--mp_secrets_ttl",
+            type=int,
+            help="Seconds the stream secrets of a secret-manager measurement_id are cached per worker",
+            default=3600,
+        )
+        parser.add_argument(
+            "--resume",
+            type=str_to_bool,
+            help="Only send rows whose payload has no SEND_OK log entry for the prediction_run_id yet, fails if there are none and log_detail is failures_only",
+            default=False,
+            nargs="?",
+            const=True,
+        )
+        parser.add_argument(
+            "--read_method",
+            type=str.upper,
+            choices=["EXPORT", "DIRECT_READ"],
+            help="EXPORT re-queries the source table through JSON exports on GCS, DIRECT_READ reads it by reference through the BigQuery Storage Read API",
+            default="EXPORT",
+        )
+        parser.add_argument(
+            "--read_format",
+            type=str.upper,
+            choices=["AVRO", "ARROW"],
+            help="Wire format of the Storage Read API streams when read_method is DIRECT_READ",
+            default="AVRO",
+        )
+        parser.add_argument(
+            "--log_detail",
+            type=str.lower,
+            choices=LOG_DETAILS,
+            help="full logs every payload and response, hash_only logs successful events without their payload and response, failures_only logs failed events only",
+            default="full",
+        )
+
+
+class CountingHTTPAdapter(requests.adapters.HTTPAdapter):
+    # counts requests sent and connections (TCP+TLS handshakes) opened by the pool
+    def __init__(self, *args, **kwargs):
+        self.connections_opened = 0
+        self.requests_sent = 0
+        # the sender threads of the DoFn share the adapter
+        self.counts_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        adapter = self
+
+        def counting(connection_cls):
+            class CountingConnection(connection_cls):
+                def connect(self):
+                    with adapter.counts_lock:
+                        adapter.connections_opened += 1
+                    super().connect()
+
+            return CountingConnection
+
+        self.poolmanager.pool_classes_by_scheme = {
+            scheme: type(
+                pool_cls.__name__,
+                (pool_cls,),
+                {"ConnectionCls": counting(pool_cls.ConnectionCls)},
+            )
+            for scheme, pool_cls in self.poolmanager.pool_classes_by_scheme.items()
+        }
+
+    def send(self, *args, **kwargs):
+        with self.counts_lock:
+            self.requests_sent += 1
+        return super().send(*args, **kwargs)
+
+
+class StreamUrls(dict):
+    # dict can't be weak referenced, which Shared requires
+    pass
+
+
+def send_ok(status_code):
+    # the collect endpoint answers 204, the validation endpoint 200, both mean sent
+    return 200 <= status_code < 300
 
 
 class CallMeasurementProtocolAPI(beam.DoFn):
-    def __init__(self, project_id, measurement_id, api_secret, debug=False):
+    DEAD_LETTER = "dead_letter"
+
+    def __init__(
+        self,
+        project_id,
+        measurement_id,
+        api_secret,
+        debug=False,
+        pool_size=10,
+        keep_alive=True,
+        max_in_flight=1,
+        limits=None,
+        max_retries=3,
+        endpoint=MP_ENDPOINT,
+        secrets_ttl=3600,
+    ):
         super().__init__()
 
         self.project_id = project_id
         self.measurement_id = measurement_id
         self.api_secret = api_secret
+        self.pool_size = pool_size
+        self.keep_alive = keep_alive
+        self.max_in_flight = max(max_in_flight, 1)
+        self.limits = limits or {}
+        self.max_retries = max_retries
+        self.endpoint = endpoint
+        self.secrets_ttl = secrets_ttl
 
-        self.stream_secrets = {}
         self.debug_str = ""
         if debug:
             self.debug_str = "debug/"
 
-    def _event_post_url(self, measurement_id, api_secret, stream_id):
-        if measurement_id != "secret-manager":
-            return f"https://www.google-analytics.com/{self.debug_str}mp/collect?measurement_id={measurement_id}&api_secret={api_secret}"
+        # stream_id -> url of a rollup property, loaded once per process and TTL period
+        self.shared_stream_urls = shared.Shared()
+        self.stream_urls = None
+        self.stream_urls_tag = None
+        self.url = None
 
-        else:
-            mid = self.stream_secrets[stream_id]["measurement_id"]
-            sid = self.stream_secrets[stream_id]["api_secret"]
-            return f"https://www.google-analytics.com/{self.debug_str}mp/collect?measurement_id={mid}&api_secret={sid}"
+        self.session = None
+        self.executor = None
+        self.in_flight = []
+        self.connections_flushed = (0, 0)
+        self.connections_new = Metrics.counter(self.__class__, "mp_connections_new")
+        self.connections_reused = Metrics.counter(
+            self.__class__, "mp_connections_reused"
+        )
+        self.requests = Metrics.counter(self.__class__, "requests")
+        self.retries = Metrics.counter(self.__class__, "retries")
+        self.request_errors = Metrics.counter(self.__class__, "request_errors")
+        self.unknown_stream_events = Metrics.counter(
+            self.__class__, "unknown_stream_events"
+        )
+        self.http_latency = Metrics.distribution(self.__class__, "http_latency_ms")
+        # from the batch reaching the sender to its last response, so with the wait for
+        # a sender thread, the rate limit pacing and the retries
+        self.send_latency = Metrics.distribution(self.__class__, "send_latency_ms")
+        self.request_bytes = Metrics.distribution(self.__class__, "request_bytes")
+
+    def _mp_url(self, measurement_id, api_secret):
+        return f"{self.endpoint}/{self.debug_str}mp/collect?measurement_id={measurement_id}&api_secret={api_secret}"
+
+    def _load_stream_urls(self):
+        client = secretmanager.SecretManagerServiceClient()
+        name = f"projects/{self.project_id}/secrets/{self.api_secret}/versions/latest"
+        response = client.access_secret_version(request={"name": name})
+        stream_secrets = json.loads(response.payload.data.decode("UTF-8"))
+        logging.info(
+            f"Loaded Measurement Protocol secrets of {len(stream_secrets)} streams"
+        )
+
+        return StreamUrls(
+            {
+                stream_id: self._mp_url(secret["measurement_id"], secret["api_secret"])
+                for stream_id, secret in stream_secrets.items()
+            }
+        )
+
+    def _refresh_stream_urls(self):
+        # the tag changes once per TTL period, which makes Shared load the secrets again
+        tag = f"{self.project_id}/{self.api_secret}/{int(time.time() // self.secrets_ttl)}"
+        if tag != self.stream_urls_tag:
+            self.stream_urls = self.shared_stream_urls.acquire(
+                self._load_stream_urls, tag=tag
+            )
+            self.stream_urls_tag = tag
+
+    def _event_post_url(self, stream_id):
+        if self.measurement_id != "secret-manager":
+            return self.url
+
+        return self.stream_urls.get(stream_id)
+
+    def _limiter(self, stream_id):
+        # pacing is shared per destination, i.e. the stream when using secret-manager
+        key = (
+            stream_id
+            if self.measurement_id == "secret-manager"
+            else self.measurement_id
+        )
+        return get_limiter(
+            key, **{**self.limits.get("default", {}), **self.limits.get(key, {})}
+        )
+
+    def connection_stats(self):
+        # (new connections, reused connections) of the session since setup
+        adapter = self.session.get_adapter(self.endpoint)
+        return (
+            adapter.connections_opened,
+            adapter.requests_sent - adapter.connections_opened,
+        )
 
     def setup(self):
         if self.measurement_id == "secret-manager":
-            client = secretmanager.SecretManagerServiceClient()
-            name = (
-                f"projects/{self.project_id}/secrets/{self.api_secret}/versions/latest"
-            )
-            response = client.access_secret_version(request={"name": name})
-            self.stream_secrets = json.loads(response.payload.data.decode("UTF-8"))
+            self._refresh_stream_urls()
+        else:
+            self.url = self._mp_url(self.measurement_id, self.api_secret)
 
-    def process(self, element):
-        stream_id = element.pop("stream_id", None)
+        pool_size = max(self.pool_size, self.max_in_flight)
+        adapter = CountingHTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size
+        )
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update(
+            {
+                "content-type": "application/json",
+                "connection": "keep-alive" if self.keep_alive else "close",
+            }
+        )
 
-        try:
-            ga4_mp_url = self._event_post_url(
-                self.measurement_id, self.api_secret, stream_id
+        if self.max_in_flight > 1:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.max_in_flight
             )
 
-        except Exception as e:
-            yield element, 500, str(e)
+    def start_bundle(self):
+        if self.measurement_id == "secret-manager":
+            self._refresh_stream_urls()
+
+    def process(
+        self,
+        batch,
+        window=beam.DoFn.WindowParam,
+        timestamp=beam.DoFn.TimestampParam,
+    ):
+        queued = time.monotonic()
+        if self.executor is None:
+            yield from self._outputs(*self._send(batch, queued))
+            return
 
-        response = requests.post(
-            ga4_mp_url,
-            data=json.dumps(element),
-            headers={"content-type": "application/json"},
-            timeout=20,
+        self.in_flight.append(
+            (self.executor.submit(self._send, batch, queued), window, timestamp)
         )
-        yield element, response.status_code, response.content
+        if len(self.in_flight) >= self.max_in_flight:
+            yield from self._drain(self.max_in_flight - 1)
+
+    def _drain(self, keep=0):
+        # yields results of completed requests until at most `keep` are in flight
+        while len(self.in_flight) > keep:
+            concurrent.futures.wait(
+                [f for f, _, _ in self.in_flight],
+                return_when=concurrent.futures.FIRST_COMPLETED,
+            )
+            pending = []
+            for future, window, timestamp in self.in_flight:
+                if not future.done():
+                    pending.append((future, window, timestamp))
+                    continue
+
+                yield from self._outputs(*future.result(), window, timestamp)
+            self.in_flight = pending
+
+    def _outputs(self, results, retry, window=None, timestamp=None):
+        # main output for the log, failed payloads also go to the dead letter output
+        def output(value, tag=None):
+            if window is not None:
+                value = WindowedValue(value, timestamp, [window])
+            return value if tag is None else beam.pvalue.TaggedOutput(tag, value)
+
+        self._update_metrics(results, retry)
+        for element, status_code, content in results:
+            if retry["attempts"]:  # requests never sent have nothing to log
+                yield output((element, status_code, content))
+
+            if not send_ok(status_code):
+                yield output((element, status_code, content, retry), self.DEAD_LETTER)
+
+    def _update_metrics(self, results, retry):
+        # metrics are only collected from the bundle thread, not from the senders
+        if not retry["attempts"]:
+            self.unknown_stream_events.inc(len(results))
+            return
+
+        self.requests.inc(retry["attempts"])
+        self.retries.inc(retry["attempts"] - 1)
+        self.request_bytes.update(retry["request_bytes"])
+        self.send_latency.update(retry["send_latency_ms"])
+        for status_code, latency_ms in retry["responses"]:
+            self.http_latency.update(latency_ms)
+            if status_code is None:
+                self.request_errors.inc()
+            else:
+                Metrics.counter(self.__class__, f"status_{status_code}").inc()
+
+    def _send(self, batch, queued):
+        # all payloads in a batch share the stream and every attribute but the events
+        stream_id = batch[0].stream_id
+
+        ga4_mp_url = self._event_post_url(stream_id)
+        if ga4_mp_url is None:  # unknown stream, goes to the dead letter output only
+            retry = {
+                "stream_id": stream_id,
+                "attempts": 0,
+                "retryable": False,
+                "first_attempt_ts": None,
+                "last_attempt_ts": None,
+                "request_bytes": 0,
+                "responses": [],
+            }
+            content = f"No Measurement Protocol secret for stream_id {stream_id}"
+            return [(element, 500, content) for element in batch], retry
+
+        data = batch_body(batch)
+        limiter = self._limiter(stream_id)
+        first_attempt_ts = datetime.datetime.now(datetime.timezone.utc)
+        responses = []  # (status code, latency in ms) of every attempt
+        for attempt in range(self.max_retries + 1):
+            limiter.acquire()
+            start = time.monotonic()
+            try:
+                response = self.session.post(ga4_mp_url, data=data, timeout=20)
+                status_code, content = response.status_code, response.content
+            except requests.exceptions.RequestException as e:
+                response, status_code, content = None, None, str(e)
+            latency = time.monotonic() - start
+            limiter.release(status_code, latency)
+            responses.append((status_code, int(latency * 1000)))
+
+            if status_code is not None and status_code not in RETRYABLE_STATUS_CODES:
+                break
+
+            if attempt < self.max_retries:
+                retry_after = None
+                if response is not None and "retry-after" in response.headers:
+                    try:
+                        retry_after = float(response.headers["retry-after"])
+                    except ValueError:
+                        pass
+                time.sleep(backoff_delay(attempt, retry_after=retry_after))
+
+        retry = {
+            "stream_id": stream_id,
+            "attempts": attempt + 1,
+            "retryable": status_code is None or status_code in RETRYABLE_STATUS_CODES,
+            "first_attempt_ts": first_attempt_ts,
+            "last_attempt_ts": datetime.datetime.now(datetime.timezone.utc),
+            "request_bytes": len(data),
+            "responses": responses,
+            "send_latency_ms": int((time.monotonic() - queued) * 1000),
+        }
+        if status_code is None:  # no response even after retries
+            status_code = 500
+
+        return [(element, status_code, content) for element in batch], retry
+
+    def finish_bundle(self):
+        yield from self._drain()
+
+        new, reused = self.connection_stats()
+        self.connections_new.inc(new - self.connections_flushed[0])
+        self.connections_reused.inc(reused - self.connections_flushed[1])
+        self.connections_flushed = (new, reused)
+
+    def teardown(self):
+        if self.session is not None:
+            new, reused = self.connection_stats()
+            logging.info(
+                f"Measurement Protocol connections opened: {new}, reused: {reused}"
+            )
+            self.session.close()
+            self.session = None
+
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+
+def run_fields(prediction_run_id, window):
+    """
+    prediction_run_ts and prediction_run_id columns of the log tables. Streaming runs
+    have no prediction_run_id and log each window under the minute it starts.
+    """
+    if prediction_run_id is None:
+        prediction_run_id = window.start.to_utc_datetime().strftime("%Y%m%d%H%M")
+
+    return {
+        "prediction_run_ts": datetime.datetime.strptime(
+            prediction_run_id, "%Y%m%d%H%M"
+        ),
+        "prediction_run_id": prediction_run_id,
+    }
 
 
 class ToLogFormat(beam.DoFn):
-    def __init__(self, prediction_run_id):
+    def __init__(self, prediction_run_id, log_detail="full"):
         self.prediction_run_id = prediction_run_id
+        self.log_detail = log_detail
+        self.send_ok = Metrics.counter(self.__class__, "send_ok")
+        self.send_fail = Metrics.counter(self.__class__, "send_fail")
+        self.payload_bytes = Metrics.distribution(self.__class__, "payload_bytes")
 
-    def process(self, element):
-        if element[1] == requests.status_codes.codes.NO_CONTENT:
+    def process(self, element, window=beam.DoFn.WindowParam):
+        if send_ok(element[1]):
             state_msg = "SEND_OK"
+            self.send_ok.inc()
         else:
             state_msg = "SEND_FAIL"
+            self.send_fail.inc()
+
+        payload = element[0]
+        self.payload_bytes.update(len(payload.body))
 
-        pl = json.dumps(element[0], sort_keys=True)
+        run = run_fields(self.prediction_run_id, window)
+        if state_msg == "SEND_OK" and self.log_detail != "full":
+            if self.log_detail == "hash_only":
+                yield {**run, **self.compact(payload, element[1])}
+            return
 
         yield {
-            "prediction_run_ts": datetime.datetime.strptime(
-                self.prediction_run_id, "%Y%m%d%H%M"
-            ),
-            "prediction_run_id": self.prediction_run_id,
+            **run,
             "id": str(uuid.uuid4()),
-            "client_id": element[0]["client_id"],
-            "event_name": element[0]["events"][0]["name"],
-            "payload_md5": hashlib.md5(pl.encode()).hexdigest(),
-            "payload": pl,
+            "client_id": payload.client_id,
+            "event_name": payload.event_name,
+            "payload_md5": payload.md5,
+            "payload": payload.body.decode(),
             "response": element[2],
             "state": f"{state_msg} {element[1]}",
         }
 
+    def compact(self, payload, status_code):
+        # same schema as the full rows, with the large columns left empty
+        return {
+            "id": "",
+            "client_id": payload.client_id,
+            "event_name": "",
+            "payload_md5": payload.md5,
+            "payload": "",
+            "response": "",
+            "state": f"SEND_OK {status_code}",
+        }
 
-class DecimalEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, Decimal):
-            return float(obj)
-        return json.JSONEncoder.default(self, obj)
+
+class ToDeadLetterFormat(beam.DoFn):
+    def __init__(self, prediction_run_id):
+        self.prediction_run_id = prediction_run_id
+
+    def process(self, element, window=beam.DoFn.WindowParam):
+        payload, status_code, content, retry = element
+
+        yield {
+            **run_fields(self.prediction_run_id, window),
+            "client_id": payload.client_id,
+            "event_name": payload.event_name,
+            "stream_id": retry["stream_id"],
+            "payload_md5": payload.md5,
+            "payload": payload.body.decode(),
+            "status_code": status_code,
+            "response": content,
+            "attempts": retry["attempts"],
+            "retryable": retry["retryable"],
+            "first_attempt_ts": retry["first_attempt_ts"],
+            "last_attempt_ts": retry["last_attempt_ts"],
+        }
+
+
+class BatchPayloads(beam.DoFn):
+    def __init__(
+        self,
+        max_events=MP_MAX_EVENTS_PER_REQUEST,
+        max_bytes=MP_MAX_REQUEST_BYTES,
+    ):
+        super().__init__()
+        self.max_events = min(max(max_events, 1), MP_MAX_EVENTS_PER_REQUEST)
+        self.max_bytes = max_bytes
+
+    def process(self, element):
+        _, payloads = element
+
+        batch, batch_events, batch_bytes = [], 0, 0
+        for payload in payloads:
+            n_events = payload.n_events
+            n_bytes = len(payload.events) + 2  # separator in the joined events
+
+            if batch and (
+                batch_events + n_events > self.max_events
+                or batch_bytes + n_bytes > self.max_bytes
+            ):
+                yield batch
+                batch, batch_events, batch_bytes = [], 0, 0
+
+            if not batch:  # request attributes are sent once per batch
+                batch_bytes = len(payload.head) + len(payload.tail)
+
+            batch.append(payload)
+            batch_events += n_events
+            batch_bytes += n_bytes
+
+        if batch:
+            yield batch
 
 
 class TransformToPayload(beam.DoFn):
+    """
+    Turns activation query rows into Measurement Protocol payloads.
+
+    Rows of a run share the same columns, so the up_/ep_ columns are classified once per
+    schema and the timestamp parser that matched last is tried first on the next row.
+    """
+
     def __init__(self):
         super().__init__()
         self.date_formats = [  # from more specific to less
@@ -157,135 +746,497 @@ class TransformToPayload(beam.DoFn):
             "%Y-%m-%d %H:%M:%S",
             "%Y-%m-%d",
         ]
-        self.payload_template = None
-
-    def setup(self):
-        self.payload_template = {
-            "client_id": None,
-            "timestamp_micros": None,
-            "nonPersonalizedAds": False,
-            "events": [{"name": None, "params": {}}],
-        }
+        self.date_parser = None
+        self.schema = None
+        self.user_props = ()
+        self.event_props = ()
+        self.rows_in = Metrics.counter(self.__class__, "rows_in")
 
     def process(self, element):
-        hit = deepcopy(self.payload_template)
-        hit["client_id"] = element["client_id"]
-        if "user_id" in element:
-            hit["user_id"] = element["user_id"]
-        hit["timestamp_micros"] = self.date_to_micro(element["event_timestamp"])
-        hit["events"][0]["name"] = element["event_name"]
+        self.rows_in.inc()
+        if self.schema is None or element.keys() != self.schema:
+            self.compile_schema(element)
 
-        up, ep = self.extract_params(element)
+        user_props = {}
+        for k, k_clean in self.user_props:
+            v = element[k]
+            if v is not None:
+                user_props[k_clean] = {"value": v}
+
+        event_props = {}
+        for k, k_clean in self.event_props:
+            v = element[k]
+            if v is not None:
+                event_props[k_clean] = v
 
-        if up:
-            hit["user_properties"] = up
+        hit = {
+            "client_id": element["client_id"],
+            "nonPersonalizedAds": False,
+            # the time is set per event, so the events of a client share the request
+            # attributes and can be batched
+            "events": [
+                {
+                    "name": element["event_name"],
+                    "params": event_props,
+                    "timestamp_micros": self.date_to_micro(element["event_timestamp"]),
+                }
+            ],
+        }
+        if self.has_user_id:
+            hit["user_id"] = element["user_id"]
 
-        if ep:
-            hit["events"][0]["params"] = ep
+        if user_props:
+            hit["user_properties"] = user_props
 
-        if "user_data" in element:
+        if self.has_user_data:
             hit["user_data"] = element["user_data"]
 
-        if "stream_id" in element:
+        if self.has_stream_id:
             hit["stream_id"] = element["stream_id"]
 
         yield hit
 
-    def date_to_micro(self, date_str):
-        ts = None
-        for df in self.date_formats:
-            try:
-                dt = datetime.datetime.strptime(date_str, df)
-                dt = dt.replace(tzinfo=pytz.utc)
-                ts = int(dt.timestamp() * 1e6)
-                break
-            except:
-                pass
-
-        return ts
+    def compile_schema(self, element):
+        self.schema = set(element)
+        self.user_props, self.event_props = self.extract_params(element)
+        self.has_user_id = "user_id" in self.schema
+        self.has_user_data = "user_data" in self.schema
+        self.has_stream_id = "stream_id" in self.schema
 
     def extract_params(self, element):
-        el = element.copy()
-        user_props, event_props = {}, {}
+        # (column, property name) pairs of the user and event properties of a row schema
+        user_props, event_props = [], []
 
-        for k, v in el.items():
+        for k in element:
             k_clean = k[3:-1] if k.endswith("_") else k[3:]
-            if k.startswith("up_") and v is not None:
-                user_props[k_clean] = {"value": v}
+            if k.startswith("up_"):
+                user_props.append((k, k_clean))
+
+            elif k.startswith("ep_"):
+                event_props.append((k, k_clean))
+
+        return tuple(user_props), tuple(event_props)
+
+    def date_to_micro(self, date_str):
+        # Storage Read API rows carry native values instead of strings
+        if isinstance(date_str, datetime.datetime):
+            return to_micros(date_str)
+
+        if isinstance(date_str, datetime.date):
+            return to_micros(datetime.datetime.combine(date_str, datetime.time()))
+
+        if self.date_parser is not None:
+            dt = self.date_parser(date_str)
+            if dt is not None:
+                return to_micros(dt)
+
+        for parser in [parse_iso_date] + [
+            strptime_parser(df) for df in self.date_formats
+        ]:
+            dt = parser(date_str)
+            if dt is not None:
+                self.date_parser = parser
+                return to_micros(dt)
+
+        return None
+
+
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def to_micros(dt):
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+
+    return (dt - _EPOCH) // datetime.timedelta(microseconds=1)
+
+
+def parse_iso_date(date_str):
+    # BigQuery exports timestamps as "YYYY-MM-DD HH:MM:SS[.ffffff] UTC"
+    if date_str.endswith(" UTC"):
+        date_str = date_str[:-4]
+
+    try:
+        return datetime.datetime.fromisoformat(date_str)
+    except (TypeError, ValueError):
+        return None
+
+
+def strptime_parser(date_format):
+    def parse(date_str):
+        try:
+            return datetime.datetime.strptime(date_str, date_format)
+        except (TypeError, ValueError):
+            return None
+
+    return parse
+
+
+class SendPayloads(beam.PTransform):
+    """
+    Packs EncodedPayloads sharing their request attributes into Measurement Protocol
+    batches, sends them and returns the (log rows, dead letter rows) PCollections.
+    Batches are grouped per window, so it applies to bounded and windowed inputs.
+
+    With mp_batch_size 1 every payload is sent on its own, without the shuffle of the
+    grouping, e.g. for sources with one row per client_id (the request attributes
+    include the client_id, so their payloads never share a request).
+    """
+
+    def __init__(self, activation_options):
+        super().__init__()
+        self.activation_options = activation_options
+
+    def expand(self, payloads):
+        activation_options = self.activation_options
+        if activation_options.mp_batch_size <= 1:
+            batches = payloads | "One payload per request" >> beam.Map(
+                lambda payload: [payload]
+            ).with_output_types(typing.List[EncodedPayload])
+        else:
+            batches = (
+                payloads
+                | "Key by request attributes"
+                >> beam.Map(lambda payload: (payload.key, payload)).with_output_types(
+                    typing.Tuple[str, EncodedPayload]
+                )
+                | "Group by request attributes" >> beam.GroupByKey()
+                | "Pack into Measurement Protocol batches"
+                >> beam.ParDo(
+                    BatchPayloads(activation_options.mp_batch_size)
+                ).with_output_types(typing.List[EncodedPayload])
+            )
+
+        responses = batches | "POST event to Measurement Protocol API" >> beam.ParDo(
+            CallMeasurementProtocolAPI(
+                activation_options.project,
+                activation_options.ga4_measurement_id,
+                activation_options.ga4_api_secret,
+                debug=activation_options.use_api_validation,
+                pool_size=activation_options.mp_pool_size,
+                keep_alive=activation_options.mp_keep_alive,
+                max_in_flight=activation_options.mp_max_in_flight,
+                limits=mp_limits(activation_options),
+                max_retries=activation_options.mp_max_retries,
+                endpoint=activation_options.mp_endpoint,
+                secrets_ttl=activation_options.mp_secrets_ttl,
+            )
+        ).with_outputs(CallMeasurementProtocolAPI.DEAD_LETTER, main="responses")
+
+        log_rows = responses.responses | "Transform log format" >> beam.ParDo(
+            ToLogFormat(
+                activation_options.prediction_run_id, activation_options.log_detail
+            )
+        )
+        dead_letter_rows = responses[
+            CallMeasurementProtocolAPI.DEAD_LETTER
+        ] | "Transform dead letter format" >> beam.ParDo(
+            ToDeadLetterFormat(activation_options.prediction_run_id)
+        )
+        return log_rows, dead_letter_rows
 
-            elif k.startswith("ep_") and v is not None:
-                event_props[k_clean] = v
 
-        return user_props, event_props
+PAYLOAD_COLUMNS = (
+    "client_id",
+    "user_id",
+    "event_timestamp",
+    "event_name",
+    "user_data",
+    "stream_id",
+)
 
 
-def run(params=None):
+def payload_fields(field_names):
+    # columns of the source table TransformToPayload reads, in table order
+    return [
+        name
+        for name in field_names
+        if name in PAYLOAD_COLUMNS or name.startswith(("up_", "ep_"))
+    ]
+
+
+def read_source(p, activation_options):
+    if activation_options.read_method == "DIRECT_READ":
+        table = bigquery_tools.parse_table_reference(
+            activation_options.source_table, project=activation_options.project
+        )
+        schema = (
+            bigquery_tools.BigQueryWrapper()
+            .get_table(table.projectId, table.datasetId, table.tableId)
+            .schema
+        )
+        return p | "Read source table" >> beam.io.gcp.bigquery.ReadFromBigQuery(
+            method=beam.io.gcp.bigquery.ReadFromBigQuery.Method.DIRECT_READ,
+            table=table,
+            selected_fields=payload_fields(f.name for f in schema.fields),
+            use_native_datetime=activation_options.read_format == "ARROW",
+        )
+
+    return p | beam.io.gcp.bigquery.ReadFromBigQuery(
+        project=activation_options.project,
+        query=f"SELECT * FROM `{activation_options.source_table}`",
+        use_json_exports=True,
+        use_standard_sql=True,
+    )
+
+
+def sent_payloads_query(activation_options):
+    # md5 of the payloads already delivered for the prediction run
+    prediction_run_ts = datetime.datetime.strptime(
+        activation_options.prediction_run_id, "%Y%m%d%H%M"
+    )
+    return f"""
+    SELECT DISTINCT payload_md5
+    FROM `{activation_options.project}.{activation_options.log_db_dataset}.{LOG_TABLE_NAME}`
+    WHERE
+      prediction_run_ts = TIMESTAMP('{prediction_run_ts:%Y-%m-%d %H:%M:%S}')
+      AND prediction_run_id = '{activation_options.prediction_run_id}'
+      AND STARTS_WITH(state, 'SEND_OK')
+    """
+
+
+def read_sent_payloads(p, activation_options):
+    return p | "Read already sent payloads" >> beam.io.gcp.bigquery.ReadFromBigQuery(
+        project=activation_options.project,
+        query=sent_payloads_query(activation_options),
+        use_json_exports=True,
+        use_standard_sql=True,
+    )
+
+
+def check_resume(client, activation_options):
+    """
+    --resume skips the payloads logged as SEND_OK for the run, which failures_only runs
+    don't log: without any, the resume would send every event again, so it fails.
+    """
+    if activation_options.log_detail != "failures_only":
+        return
+
+    (row,) = client.query(
+        f"SELECT COUNT(*) as sent FROM ({sent_payloads_query(activation_options)})"
+    ).result()
+    if row["sent"] == 0:
+        raise ValueError(
+            f"--resume needs the SEND_OK log entries of prediction run "
+            f"{activation_options.prediction_run_id}, which log_detail failures_only "
+            f"doesn't write: every event would be sent again"
+        )
+
+
+def write_table(table_spec, schema, clustering_fields):
+    return beam.io.WriteToBigQuery(
+        table_spec,
+        schema=schema,
+        write_disposition=beam.io.BigQueryDisposition.WRITE_APPEND,
+        create_disposition=beam.io.BigQueryDisposition.CREATE_IF_NEEDED,
+        additional_bq_parameters={
+            "timePartitioning": {"type": "DAY", "field": "prediction_run_ts"},
+            "clustering": {"fields": clustering_fields},
+        },
+    )
+
+
+def store_logs(log_rows, dead_letter_rows, activation_options, store=write_table):
+    def table_spec(table_name):
+        return bigquery.TableReference(
+            projectId=activation_options.project,
+            datasetId=activation_options.log_db_dataset,
+            tableId=table_name,
+        )
+
+    _ = log_rows | "Store to log table" >> store(
+        table_spec(LOG_TABLE_NAME), LOG_TABLE_SCHEMA, ["state", "client_id"]
+    )
+    _ = dead_letter_rows | "Store to dead letter table" >> store(
+        table_spec(DEAD_LETTER_TABLE_NAME),
+        DEAD_LETTER_TABLE_SCHEMA,
+        ["prediction_run_id", "client_id"],
+    )
+
+
+def runner_params(runner, region):
+    """
+    Pipeline options of an activation.ga4mp.runner config (other than inprocess).
+    """
+    if runner["type"] == "dataflow":
+        # the default Dataflow image can't import activation.ga4mp, and mp_limits splits
+        # the rate limit between max_num_workers
+        if not runner.get("sdk_container_image") or not runner["num_workers"]:
+            raise ValueError(
+                "runner type dataflow requires sdk_container_image and num_workers > 0"
+            )
+        params = {
+            "runner": "DataflowRunner",
+            "region": region,
+            "max_num_workers": runner["num_workers"],
+            "machine_type": runner.get("machine_type"),
+            "sdk_container_image": runner["sdk_container_image"],
+        }
+        return {k: v for k, v in params.items() if v is not None}
+
+    return {
+        "runner": "DirectRunner",
+        "direct_running_mode": runner["type"],
+        "direct_num_workers": runner["num_workers"],
+    }
+
+
+def mp_limits(activation_options):
+    # rates are configured for the whole run, limiters live in each worker process
+    workers = 1
+    if activation_options.view_as(StandardOptions).runner == "DataflowRunner":
+        workers = activation_options.view_as(WorkerOptions).max_num_workers or 1
+    elif activation_options.direct_running_mode == "multi_processing":
+        workers = activation_options.direct_num_workers or os.cpu_count()
+
+    limits = {"default": {}, **json.loads(activation_options.mp_stream_limits)}
+    limits["default"].setdefault("rate", activation_options.mp_rate_limit)
+    limits["default"].setdefault(
+        "max_concurrency", activation_options.mp_max_concurrency
+    )
+    for stream_limits in limits.values():
+        if stream_limits.get("rate"):
+            stream_limits["rate"] = stream_limits["rate"] / workers
+
+    return limits
+
+
+def metric_totals(counters, distributions):
+    """
+    Sums counters ({MetricKey: int}) and distributions ({MetricKey: DistributionData})
+    of all steps by metric name, the names are unique across the activation DoFns.
+    """
+    counter_totals, distribution_totals = {}, {}
+    for key, value in counters.items():
+        name = key.metric.name
+        counter_totals[name] = counter_totals.get(name, 0) + value
+    for key, value in distributions.items():
+        name = key.metric.name
+        if name in distribution_totals:
+            value = distribution_totals[name].combine(value)
+        distribution_totals[name] = value
+
+    return counter_totals, distribution_totals
+
+
+def pipeline_metric_totals(result):
+    # committed values of a finished pipeline, attempted ones where not supported
+    def value(metric_result):
+        if metric_result.committed is not None:
+            return metric_result.committed
+        return metric_result.attempted
+
+    metrics = result.metrics().query()
+    return metric_totals(
+        {r.key: value(r) for r in metrics["counters"]},
+        {r.key: value(r).data for r in metrics["distributions"]},
+    )
+
+
+def metrics_summary(counters, distributions):
+    """
+    Activation run totals from the metric_totals of either engine.
+    """
+    latency = distributions.get("http_latency_ms")
+    send_latency = distributions.get("send_latency_ms")
+    payload_bytes = distributions.get("payload_bytes")
+    request_bytes = distributions.get("request_bytes")
+    status_codes = [
+        {"status_code": int(name[len("status_") :]), "responses": value}
+        for name, value in counters.items()
+        if name.startswith("status_")
+    ]
+
+    return {
+        "rows_in": counters.get("rows_in", 0),
+        "events_sent_ok": counters.get("send_ok", 0),
+        "events_send_fail": counters.get("send_fail", 0),
+        "events_unknown_stream": counters.get("unknown_stream_events", 0),
+        "requests": counters.get("requests", 0),
+        "retries": counters.get("retries", 0),
+        "request_errors": counters.get("request_errors", 0),
+        "payload_bytes": payload_bytes.sum if payload_bytes else 0,
+        "request_bytes": request_bytes.sum if request_bytes else 0,
+        "http_latency_ms_mean": latency.sum / latency.count if latency else None,
+        "http_latency_ms_max": latency.max if latency else None,
+        "send_latency_ms_mean": (
+            send_latency.sum / send_latency.count if send_latency else None
+        ),
+        "send_latency_ms_max": send_latency.max if send_latency else None,
+        "status_codes": sorted(status_codes, key=lambda s: s["status_code"]),
+    }
+
+
+def run_stats_row(prediction_run_id, engine, started_ts, duration_s, summary):
+    # row of the run stats table from a metrics_summary
+    events = summary["events_sent_ok"] + summary["events_send_fail"]
+    return {
+        "prediction_run_ts": datetime.datetime.strptime(
+            prediction_run_id, "%Y%m%d%H%M"
+        ),
+        "prediction_run_id": prediction_run_id,
+        "engine": engine,
+        "started_ts": started_ts,
+        "duration_s": duration_s,
+        **summary,
+        "events_per_sec": events / duration_s if duration_s > 0 else 0.0,
+    }
+
+
+def run(params=None, source=None, sink=None):
+    """
+    source replaces the BigQuery read of the activation rows (a PTransform applied to
+    the pipeline, e.g. beam.Create) and sink the writes of the log tables (a function
+    with the signature of write_table); both default to BigQuery. Returns the
+    metrics_summary of the run.
+    """
     if params is not None:
-        pipeline_options = DirectOptions.from_dictionary(params)
+        pipeline_options = options_from_dict(params)
     else:
         pipeline_options = DirectOptions()
 
     activation_options = pipeline_options.view_as(ActivationOptions)
+    if activation_options.prediction_run_id is None:
+        raise ValueError("--prediction_run_id is required")
+    if source is None and activation_options.source_table is None:
+        raise ValueError("--source_table is required")
 
-    log_table_name = f"activation_ga4mp_log"
-    table_schema = {
-        "fields": [
-            {"name": "prediction_run_ts", "type": "TIMESTAMP", "mode": "REQUIRED"},
-            {"name": "prediction_run_id", "type": "STRING", "mode": "REQUIRED"},
-            {"name": "id", "type": "STRING", "mode": "REQUIRED"},
-            {"name": "client_id", "type": "STRING", "mode": "REQUIRED"},
-            {"name": "event_name", "type": "STRING", "mode": "REQUIRED"},
-            {"name": "payload_md5", "type": "STRING", "mode": "REQUIRED"},
-            {"name": "payload", "type": "STRING", "mode": "REQUIRED"},
-            {"name": "response", "type": "STRING", "mode": "REQUIRED"},
-            {"name": "state", "type": "STRING", "mode": "REQUIRED"},
-        ]
-    }
+    if activation_options.resume:
+        from common.bigquery_ops import get_client
 
-    log_table_spec = bigquery.TableReference(
-        projectId=activation_options.project,
-        datasetId=activation_options.log_db_dataset,
-        tableId=log_table_name,
-    )
+        check_resume(get_client(activation_options.project), activation_options)
+
+    store = write_table if sink is None else sink
 
     with beam.Pipeline(options=pipeline_options) as p:
-        measurement_api_responses = (
-            p
-            | beam.io.gcp.bigquery.ReadFromBigQuery(
-                project=activation_options.project,
-                query=f"SELECT * FROM `{activation_options.source_table}`",
-                use_json_exports=True,
-                use_standard_sql=True,
-            )
+        rows = (
+            read_source(p, activation_options)
+            if source is None
+            else p | "Read source rows" >> source
+        )
+        payloads = (
+            rows
             | "Transform to Measurement Protocol API payload"
             >> beam.ParDo(TransformToPayload())
-            | "POST event to Measurement Protocol API"
-            >> beam.ParDo(
-                CallMeasurementProtocolAPI(
-                    activation_options.project,
-                    activation_options.ga4_measurement_id,
-                    activation_options.ga4_api_secret,
-                    debug=activation_options.use_api_validation,
-                )
-            )
+            | "Serialize payload"
+            >> beam.Map(EncodedPayload.from_dict).with_output_types(EncodedPayload)
         )
 
-        _ = (
-            measurement_api_responses
-            | "Transform log format"
-            >> beam.ParDo(ToLogFormat(activation_options.prediction_run_id))
-            | "Store to log table"
-            >> beam.io.WriteToBigQuery(
-                log_table_spec,
-                schema=table_schema,
-                write_disposition=beam.io.BigQueryDisposition.WRITE_APPEND,
-                create_disposition=beam.io.BigQueryDisposition.CREATE_IF_NEEDED,
-                additional_bq_parameters={
-                    "timePartitioning": {"type": "DAY", "field": "prediction_run_ts"},
-                    "clustering": {"fields": ["state", "client_id"]},
-                },
+        if activation_options.resume:
+            sent_payloads = read_sent_payloads(
+                p, activation_options
+            ) | "Key by payload md5" >> beam.Map(lambda r: (r["payload_md5"], True))
+            payloads = payloads | "Skip already sent payloads" >> beam.Filter(
+                lambda payload, sent: payload.md5 not in sent,
+                sent=beam.pvalue.AsDict(sent_payloads),
             )
+
+        log_rows, dead_letter_rows = payloads | "Send to Measurement Protocol" >> (
+            SendPayloads(activation_options)
         )
+        store_logs(log_rows, dead_letter_rows, activation_options, store)
+
+    return metrics_summary(*pipeline_metric_totals(p.result))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,190 @@
+import hashlib
+import json
+import struct
+from decimal import Decimal
+
+import apache_beam as beam
+
+
+class DecimalEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, Decimal):
+            return float(obj)
+        return json.JSONEncoder.default(self, obj)
+
+
+_EVENTS_PLACEHOLDER = '"events": null'
+
+
+class EncodedPayload:
+    """
+    A Measurement Protocol payload serialized once, in the canonical form stored in the
+    log tables (sorted keys, without stream_id).
+
+    The serialized payload is kept as `head + events + tail`, where `events` is the
+    content of the events array, so payloads sharing every attribute but their events
+    (same `key`: client_id, user_id, user_properties, user_data and stream_id, the
+    time is set per event) can be sent in one request by joining their events. `md5` is the hash
+    of the canonical payload, i.e. the payload_md5 of the log tables.
+    """
+
+    __slots__ = (
+        "key",
+        "client_id",
+        "event_name",
+        "stream_id",
+        "n_events",
+        "head",
+        "events",
+        "tail",
+        "md5",
+    )
+
+    def __init__(
+        self,
+        key,
+        client_id,
+        event_name,
+        stream_id,
+        n_events,
+        head,
+        events,
+        tail,
+        md5=None,
+    ):
+        self.key = key
+        self.client_id = client_id
+        self.event_name = event_name
+        self.stream_id = stream_id
+        self.n_events = n_events
+        self.head = head
+        self.events = events
+        self.tail = tail
+        self.md5 = md5 or hashlib.md5(self.body).hexdigest()
+
+    @classmethod
+    def from_dict(cls, payload):
+        stream_id = payload.get("stream_id", None)
+        attributes = {
+            k: v for k, v in payload.items() if k not in ("events", "stream_id")
+        }
+        attributes["events"] = None
+        # "client_id" is the only attribute sorted before "events", so the first
+        # placeholder match is the top level one
+        head, tail = json.dumps(attributes, sort_keys=True, cls=DecimalEncoder).split(
+            _EVENTS_PLACEHOLDER, 1
+        )
+        events = json.dumps(payload["events"], sort_keys=True, cls=DecimalEncoder)
+
+        head = f'{head}"events": ['.encode()
+        tail = f"]{tail}".encode()
+        stream = b"" if stream_id is None else str(stream_id).encode()
+        return cls(
+            key=hashlib.md5(head + tail + b"\0" + stream).hexdigest(),
+            client_id=str(payload["client_id"]),
+            event_name=str(payload["events"][0]["name"]),
+            stream_id=None if stream_id is None else str(stream_id),
+            n_events=len(payload["events"]),
+            head=head,
+            events=events[1:-1].encode(),
+            tail=tail,
+        )
+
+    @property
+    def body(self):
+        return self.head + self.events + self.tail
+
+    def to_dict(self):
+        return json.loads(self.body)
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, EncodedPayload)
+            and self.body == other.body
+            and self.stream_id == other.stream_id
+        )
+
+    def __hash__(self):
+        return hash((self.md5, self.stream_id))
+
+    def __repr__(self):
+        return f"EncodedPayload({self.body.decode()}, stream_id={self.stream_id!r})"
+
+
+def batch_body(batch):
+    # request body of payloads sharing the same key
+    return batch[0].head + b", ".join(p.events for p in batch) + batch[0].tail
+
+
+class EncodedPayloadCoder(beam.coders.Coder):
+    """
+    Length prefixed fields instead of pickling, a missing stream_id is encoded with the
+    0xFFFFFFFF length.
+    """
+
+    _NONE = 0xFFFFFFFF
+
+    def encode(self, value):
+        parts = []
+        for field in (
+            value.key.encode(),
+            value.client_id.encode(),
+            value.event_name.encode(),
+            None if value.stream_id is None else value.stream_id.encode(),
+            str(value.n_events).encode(),
+            value.head,
+            value.events,
+            value.tail,
+            value.md5.encode(),
+        ):
+            if field is None:
+                parts.append(struct.pack(">I", self._NONE))
+            else:
+                parts.append(struct.pack(">I", len(field)))
+                parts.append(field)
+
+        return b"".join(parts)
+
+    def decode(self, encoded):
+        fields, offset = [], 0
+        while offset < len(encoded):
+            (length,) = struct.unpack_from(">I", encoded, offset)
+            offset += 4
+            if length == self._NONE:
+                fields.append(None)
+                continue
+
+            fields.append(encoded[offset : offset + length])
+            offset += length
+
+        (
+            key,
+            client_id,
+            event_name,
+            stream_id,
+            n_events,
+            head,
+            events,
+            tail,
+            md5,
+        ) = fields
+        return EncodedPayload(
+            key.decode(),
+            client_id.decode(),
+            event_name.decode(),
+            None if stream_id is None else stream_id.decode(),
+            int(n_events),
+            head,
+            events,
+            tail,
+            md5.decode(),
+        )
+
+    def is_deterministic(self):
+        return True
+
+    def to_type_hint(self):
+        return EncodedPayload
+
+
+beam.coders.registry.register_coder(EncodedPayload, EncodedPayloadCoder)
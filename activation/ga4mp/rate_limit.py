@@ -0,0 +1,123 @@
+import random
+import threading
+import time
+
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+DEFAULT_LIMITS = {
+    "rate": 0,  # requests per second, 0 means no pacing
+    "burst": None,  # token bucket size, defaults to one second worth of requests
+    "max_concurrency": 32,  # ceiling of the adaptive concurrency limit
+    "latency_target": 5.0,  # seconds, slower responses count as overload
+}
+
+
+class TokenBucket:
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+
+class AIMDConcurrency:
+    """
+    Additive increase / multiplicative decrease of the number of concurrent requests.
+    Each successful response grows the limit by 1/limit (+1 per round trip of a full window),
+    a throttled, failed or too slow response halves it (at most once per round trip).
+    """
+
+    def __init__(
+        self, max_concurrency, latency_target, min_concurrency=1, decrease_factor=0.5
+    ):
+        self.max_concurrency = max(max_concurrency, min_concurrency)
+        self.min_concurrency = min_concurrency
+        self.latency_target = latency_target
+        self.decrease_factor = decrease_factor
+
+        self.limit = float(self.max_concurrency)
+        self.in_flight = 0
+        self.last_decrease = 0.0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while self.in_flight >= int(self.limit):
+                self.cond.wait()
+            self.in_flight += 1
+
+    def release(self, overloaded, latency):
+        with self.cond:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if overloaded or latency > self.latency_target:
+                if now - self.last_decrease > latency:
+                    self.limit = max(
+                        self.min_concurrency, self.limit * self.decrease_factor
+                    )
+                    self.last_decrease = now
+            else:
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+
+            self.cond.notify_all()
+
+
+class StreamLimiter:
+    def __init__(self, rate=0, burst=None, max_concurrency=32, latency_target=5.0):
+        self.bucket = TokenBucket(rate, burst)
+        self.concurrency = AIMDConcurrency(max_concurrency, latency_target)
+
+    def acquire(self):
+        self.concurrency.acquire()
+        self.bucket.acquire()
+
+    def release(self, status_code, latency):
+        # status_code is None when the request didn't get a response at all
+        overloaded = status_code is None or status_code in RETRYABLE_STATUS_CODES
+        self.concurrency.release(overloaded, latency)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(key, **limits):
+    """
+    Returns the process-wide limiter for a measurement_id/stream_id, so that all
+    DoFn instances and sender threads of a worker share the same pacing.
+    """
+    settings = {**DEFAULT_LIMITS, **limits}
+    registry_key = (key, tuple(sorted(settings.items())))
+    with _limiters_lock:
+        if registry_key not in _limiters:
+            _limiters[registry_key] = StreamLimiter(**settings)
+
+        return _limiters[registry_key]
+
+
+def backoff_delay(attempt, base=0.5, cap=30.0, retry_after=None):
+    # exponential backoff with full jitter; Retry-After of the server takes precedence
+    if retry_after is not None:
+        return min(cap, retry_after)
+
+    return random.uniform(0, min(cap, base * 2**attempt))
@@ -0,0 +1,139 @@
+"""
+Streaming activation of prediction changes.
+
+Instead of a bounded read of the activation table at the end of the prediction
+pipeline, rows are consumed from a Pub/Sub subscription and sent continuously:
+
+    python -m activation.ga4mp.streaming --project=... \
+        --subscription=projects/<project>/subscriptions/<subscription> \
+        --log_db_dataset=... --ga4_measurement_id=... --ga4_api_secret=... \
+        --temp_location=gs://...
+
+Each message is one activation row as JSON, with the columns of the activation query
+(client_id, event_timestamp, event_name, up_*/ep_* params, ...). Rows are windowed into
+fixed windows of --window_size seconds and go through the same payload, batching, send
+and log steps as activation.ga4mp.main, into the same log tables. Without
+--prediction_run_id the rows of a window are logged under the minute the window starts.
+ReadFromPubSub honours PUBSUB_EMULATOR_HOST, so a local Pub/Sub emulator can stand in for
+the subscription.
+"""
+
+import json
+import logging
+
+import apache_beam as beam
+from apache_beam.metrics import Metrics
+from apache_beam.options.pipeline_options import (
+    DirectOptions,
+    PipelineOptions,
+    StandardOptions,
+)
+from apache_beam.transforms import window
+
+from activation.ga4mp.main import (
+    ActivationOptions,
+    SendPayloads,
+    TransformToPayload,
+    metrics_summary,
+    options_from_dict,
+    pipeline_metric_totals,
+    store_logs,
+    write_table,
+)
+from activation.ga4mp.payload import EncodedPayload
+
+
+class StreamingActivationOptions(PipelineOptions):
+    @classmethod
+    def _add_argparse_args(cls, parser):
+        parser.add_argument(
+            "--subscription",
+            type=str,
+            help="Pub/Sub subscription of the prediction change messages. Format projects/<project>/subscriptions/<subscription>",
+        )
+        parser.add_argument(
+            "--window_size",
+            type=int,
+            help="Seconds of messages batched and sent together",
+            default=60,
+        )
+
+
+class ParseMessage(beam.DoFn):
+    def __init__(self):
+        super().__init__()
+        self.invalid_messages = Metrics.counter(self.__class__, "invalid_messages")
+
+    def process(self, message):
+        try:
+            row = json.loads(message)
+        except ValueError:
+            row = None
+
+        if not isinstance(row, dict):
+            self.invalid_messages.inc()
+            logging.warning(f"Skipping message that is not a JSON row: {message[:200]}")
+            return
+
+        yield row
+
+
+class ActivateStream(beam.PTransform):
+    """
+    Prediction change messages to the (log rows, dead letter rows) PCollections.
+    """
+
+    def __init__(self, activation_options, window_size):
+        super().__init__()
+        self.activation_options = activation_options
+        self.window_size = window_size
+
+    def expand(self, messages):
+        return (
+            messages
+            | "Parse message" >> beam.ParDo(ParseMessage())
+            | "Window" >> beam.WindowInto(window.FixedWindows(self.window_size))
+            | "Transform to Measurement Protocol API payload"
+            >> beam.ParDo(TransformToPayload())
+            | "Serialize payload"
+            >> beam.Map(EncodedPayload.from_dict).with_output_types(EncodedPayload)
+            | "Send to Measurement Protocol" >> SendPayloads(self.activation_options)
+        )
+
+
+def run(params=None, source=None, sink=None):
+    """
+    source replaces the Pub/Sub read (a PTransform applied to the pipeline producing the
+    messages, e.g. TestStream) and sink the writes of the log tables, as in
+    activation.ga4mp.main.run.
+    """
+    if params is not None:
+        pipeline_options = options_from_dict(params)
+    else:
+        pipeline_options = DirectOptions()
+
+    pipeline_options.view_as(StandardOptions).streaming = True
+    activation_options = pipeline_options.view_as(ActivationOptions)
+    streaming_options = pipeline_options.view_as(StreamingActivationOptions)
+    if source is None and streaming_options.subscription is None:
+        raise ValueError("--subscription is required")
+
+    store = write_table if sink is None else sink
+
+    with beam.Pipeline(options=pipeline_options) as p:
+        messages = p | "Read prediction changes" >> (
+            beam.io.ReadFromPubSub(subscription=streaming_options.subscription)
+            if source is None
+            else source
+        )
+        log_rows, dead_letter_rows = messages | "Activate" >> ActivateStream(
+            activation_options, streaming_options.window_size
+        )
+        store_logs(log_rows, dead_letter_rows, activation_options, store)
+
+    return metrics_summary(*pipeline_metric_totals(p.result))
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.INFO)
+    run()
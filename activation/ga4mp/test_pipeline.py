@@ -1,13 +1,44 @@
+import datetime
+import hashlib
+import json
 import os
+import pickle
+import time
+import types
 import yaml
 from decimal import Decimal
 
 import apache_beam as beam
 import pytest
+import requests
+from apache_beam.options.pipeline_options import DirectOptions
+from apache_beam.options.pipeline_options import StandardOptions
 from apache_beam.testing.test_pipeline import TestPipeline
+from apache_beam.testing.test_stream import TestStream
 from apache_beam.testing.util import assert_that, equal_to
 
-from activation.ga4mp.main import TransformToPayload
+from activation.ga4mp.benchmarks.mp_server import MeasurementProtocolServer
+from activation.ga4mp.inprocess import activate, container_summary, metrics_scope
+from activation.ga4mp.payload import EncodedPayload, EncodedPayloadCoder
+from activation.ga4mp.rate_limit import AIMDConcurrency, TokenBucket
+from activation.ga4mp.streaming import ActivateStream
+from activation.ga4mp.main import (
+    ActivationOptions,
+    SendPayloads,
+    TransformToPayload,
+    BatchPayloads,
+    CallMeasurementProtocolAPI,
+    CountingHTTPAdapter,
+    ToLogFormat,
+    ToDeadLetterFormat,
+    check_resume,
+    mp_limits,
+    options_from_dict,
+    payload_fields,
+    run,
+    run_stats_row,
+    runner_params,
+)
 
 
 @pytest.fixture()
@@ -50,7 +81,6 @@ def test_transform_to_payload_ep():
                 [
                     {
                         "client_id": "client-id-value-test",
-                        "timestamp_micros": 1677283200000000,
                         "nonPersonalizedAds": False,
                         "events": [
                             {
@@ -61,6 +91,7 @@ def test_transform_to_payload_ep():
                                     "bool_field": True,
                                     "float_field": 22.4,
                                 },
+                                "timestamp_micros": 1677283200000000,
                             }
                         ],
                         "user_id": "123",
@@ -94,9 +125,14 @@ def test_transform_to_payload_up():
                 [
                     {
                         "client_id": "client-id-value-test",
-                        "timestamp_micros": 1677283200000000,
                         "nonPersonalizedAds": False,
-                        "events": [{"name": "p_prop", "params": {}}],
+                        "events": [
+                            {
+                                "name": "p_prop",
+                                "params": {},
+                                "timestamp_micros": 1677283200000000,
+                            }
+                        ],
                         "user_properties": {
                             "string_field": {"value": "string value"},
                             "int_field": {"value": 42},
@@ -141,9 +177,14 @@ def test_transform_to_payload_user_data_single_values():
                 [
                     {
                         "client_id": "client-id-value-test",
-                        "timestamp_micros": 1677283200000000,
                         "nonPersonalizedAds": False,
-                        "events": [{"name": "p_prop", "params": {}}],
+                        "events": [
+                            {
+                                "name": "p_prop",
+                                "params": {},
+                                "timestamp_micros": 1677283200000000,
+                            }
+                        ],
                         "user_data": {
                             "sha256_email_address": "yourEmailSha256Variable",
                             "sha256_phone_number": "yourPhoneSha256Variable",
@@ -206,9 +247,14 @@ def test_transform_to_payload_user_data_multiple_values():
                 [
                     {
                         "client_id": "client-id-value-test",
-                        "timestamp_micros": 1677283200000000,
                         "nonPersonalizedAds": False,
-                        "events": [{"name": "p_prop", "params": {}}],
+                        "events": [
+                            {
+                                "name": "p_prop",
+                                "params": {},
+                                "timestamp_micros": 1677283200000000,
+                            }
+                        ],
                         "user_data": {
                             "sha256_email_address": ["yourEmailSha256Variable"],
                             "sha256_phone_number": ["yourPhoneSha256Variable"],
@@ -239,6 +285,903 @@ def test_transform_to_payload_user_data_multiple_values():
         )
 
 
+def test_transform_to_payload_schema_and_date_formats():
+    transform = TransformToPayload()
+    rows = [
+        {
+            "client_id": "c1",
+            "event_timestamp": "2023-02-25 10:00:00.123 UTC",
+            "event_name": "p_prop",
+            "ep_score": 1,
+        },
+        {
+            "client_id": "c2",
+            "event_timestamp": "2023-02-25",
+            "event_name": "p_prop",
+            "ep_score": 2,
+        },
+        {
+            "client_id": "c3",
+            "event_timestamp": "25/02/2023",
+            "event_name": "p_prop",
+            "up_segment": "a",
+            "stream_id": "123",
+        },
+    ]
+
+    hits = [hit for row in rows for hit in transform.process(row)]
+
+    assert [hit["events"][0]["timestamp_micros"] for hit in hits] == [
+        1677319200123000,
+        1677283200000000,
+        None,
+    ]
+    assert hits[0]["events"][0]["params"] == {"score": 1}
+    assert hits[2]["events"][0]["params"] == {}
+    assert hits[2]["user_properties"] == {"segment": {"value": "a"}}
+    assert hits[2]["stream_id"] == "123"
+    assert "user_properties" not in hits[1]
+
+
+def test_transform_to_payload_native_timestamps():
+    # rows read through the Storage Read API carry datetime/date values
+    transform = TransformToPayload()
+    rows = [
+        {
+            "client_id": "c1",
+            "event_timestamp": datetime.datetime(
+                2023, 2, 25, 10, 0, 0, 123000, tzinfo=datetime.timezone.utc
+            ),
+            "event_name": "p_prop",
+        },
+        {
+            "client_id": "c2",
+            "event_timestamp": datetime.date(2023, 2, 25),
+            "event_name": "p_prop",
+        },
+    ]
+
+    hits = [hit for row in rows for hit in transform.process(row)]
+
+    assert [hit["events"][0]["timestamp_micros"] for hit in hits] == [
+        1677319200123000,
+        1677283200000000,
+    ]
+
+
+def test_payload_fields():
+    assert payload_fields(
+        [
+            "feature_a",
+            "client_id",
+            "user_id",
+            "event_timestamp",
+            "event_name",
+            "ep_score",
+            "up_segment_",
+            "prediction",
+            "stream_id",
+        ]
+    ) == [
+        "client_id",
+        "user_id",
+        "event_timestamp",
+        "event_name",
+        "ep_score",
+        "up_segment_",
+        "stream_id",
+    ]
+
+
+@pytest.fixture()
+def mp_server():
+    with MeasurementProtocolServer() as server:
+        yield server
+
+
+def _split_outputs(outputs):
+    responses, dead_letters = [], []
+    for output in outputs:
+        if isinstance(output, beam.pvalue.TaggedOutput):
+            dead_letters.append(output.value)
+        else:
+            responses.append(output)
+    return responses, dead_letters
+
+
+def _payload(client_id, event_name, **kwargs):
+    payload = {
+        "client_id": client_id,
+        "nonPersonalizedAds": False,
+        "events": [
+            {"name": event_name, "params": {}, "timestamp_micros": 1677283200000000}
+        ],
+    }
+    payload.update(kwargs)
+    return payload
+
+
+def _encoded(client_id, event_name, **kwargs):
+    return EncodedPayload.from_dict(_payload(client_id, event_name, **kwargs))
+
+
+def test_encoded_payload():
+    payload = _payload(
+        "c1",
+        "e0",
+        user_id="u1",
+        user_properties={"events": {"value": None}},
+        stream_id="s1",
+    )
+    payload["events"][0]["params"] = {"score": Decimal("0.5")}
+    encoded = EncodedPayload.from_dict(payload)
+
+    # canonical form of the log tables, stream_id is not part of the payload
+    del payload["stream_id"]
+    canonical = json.dumps(payload, sort_keys=True, default=float)
+    assert encoded.body == canonical.encode()
+    assert encoded.md5 == hashlib.md5(canonical.encode()).hexdigest()
+    assert (encoded.client_id, encoded.event_name, encoded.stream_id) == (
+        "c1",
+        "e0",
+        "s1",
+    )
+
+    coder = EncodedPayloadCoder()
+    assert coder.decode(coder.encode(encoded)) == encoded
+    assert coder.decode(coder.encode(_encoded("c2", "e0"))).stream_id is None
+    assert isinstance(
+        beam.coders.registry.get_coder(EncodedPayload), EncodedPayloadCoder
+    )
+
+
+def test_batch_payloads():
+    payloads = [_encoded("c1", f"e{i}") for i in range(30)]
+    assert len({p.key for p in payloads}) == 1
+    # rows of a client at different times share the request attributes
+    rows = [
+        {"client_id": "c1", "event_timestamp": f"2023-02-2{i} 10:00:00", "event_name": "e"}
+        for i in range(3)
+    ]
+    transform = TransformToPayload()
+    keys = {
+        EncodedPayload.from_dict(hit).key for row in rows for hit in transform.process(row)
+    }
+    assert len(keys) == 1
+    assert payloads[0].key != _encoded("c1", "e0", user_id="u1").key
+    assert payloads[0].key != _encoded("c2", "e0").key
+    assert payloads[0].key != _encoded("c1", "e0", stream_id="s2").key
+
+    batches = list(BatchPayloads().process(("key", payloads)))
+    assert [len(b) for b in batches] == [25, 5]
+
+    batches = list(BatchPayloads(max_events=10).process(("key", payloads)))
+    assert [len(b) for b in batches] == [10, 10, 10]
+
+    batches = list(BatchPayloads(max_bytes=300).process(("key", payloads)))
+    assert all(len(b) < 25 for b in batches)
+    assert sum(len(b) for b in batches) == 30
+
+
+def test_call_measurement_protocol_api_batch(mp_server):
+    batch = [_encoded("c1", "e0", stream_id="s1"), _encoded("c1", "e1", stream_id="s1")]
+    dofn = CallMeasurementProtocolAPI(
+        "project", "G-TEST", "secret", endpoint=mp_server.endpoint
+    )
+    dofn.setup()
+    results = list(dofn.process(batch))
+    dofn.teardown()
+
+    assert len(mp_server.received) == 1
+    body = json.loads(mp_server.received[0])
+    assert "stream_id" not in body
+    assert [e["name"] for e in body["events"]] == ["e0", "e1"]
+
+    assert [r[0].to_dict() for r in results] == [
+        _payload("c1", "e0"),
+        _payload("c1", "e1"),
+    ]
+    assert all(r[1] == 204 for r in results)
+
+    log_rows = [next(ToLogFormat("202309172113").process(r)) for r in results]
+    assert [r["event_name"] for r in log_rows] == ["e0", "e1"]
+    assert len({r["payload_md5"] for r in log_rows}) == 2
+    assert all(r["state"] == "SEND_OK 204" for r in log_rows)
+
+
+def test_call_measurement_protocol_api_debug(mp_server):
+    # the validation endpoint answers 200, logged as sent and not dead lettered
+    dofn = CallMeasurementProtocolAPI(
+        "project", "G-TEST", "secret", debug=True, endpoint=mp_server.endpoint
+    )
+    dofn.setup()
+    results = list(dofn.process([_encoded("c1", "e0")]))
+    dofn.teardown()
+
+    assert mp_server.paths[0].startswith("/debug/mp/collect?")
+    assert [r[1] for r in results] == [200]
+    (log_row,) = ToLogFormat("202309172113", "hash_only").process(results[0])
+    assert log_row["state"] == "SEND_OK 200"
+
+
+def test_to_log_format_log_detail():
+    ok = (_encoded("c1", "e0"), 204, b"")
+    failed = (_encoded("c2", "e0"), 400, b"bad request")
+
+    def log(log_detail, element):
+        return list(ToLogFormat("202309172113", log_detail).process(element))
+
+    full = log("full", ok)[0]
+    assert full["payload"] == json.dumps(_payload("c1", "e0"), sort_keys=True)
+
+    (compact,) = log("hash_only", ok)
+    assert compact.keys() == full.keys()
+    assert compact["payload"] == compact["response"] == compact["id"] == ""
+    assert compact["client_id"] == "c1"
+    assert compact["payload_md5"] == full["payload_md5"]
+    assert compact["state"] == "SEND_OK 204"
+
+    assert log("failures_only", ok) == []
+    for log_detail in ("hash_only", "failures_only"):
+        (row,) = log(log_detail, failed)
+        assert row["payload"] == json.dumps(_payload("c2", "e0"), sort_keys=True)
+        assert row["response"] == b"bad request"
+        assert row["state"] == "SEND_FAIL 400"
+
+
+@pytest.mark.parametrize("keep_alive,expected_new", [(True, 1), (False, 5)])
+def test_call_measurement_protocol_api_connection_reuse(
+    mp_server, keep_alive, expected_new
+):
+    dofn = CallMeasurementProtocolAPI(
+        "project",
+        "G-TEST",
+        "secret",
+        keep_alive=keep_alive,
+        endpoint=mp_server.endpoint,
+    )
+    dofn.setup()
+    for i in range(5):
+        list(dofn.process([_encoded(f"c{i}", "e0")]))
+
+    assert dofn.connection_stats() == (expected_new, 5 - expected_new)
+    dofn.teardown()
+
+
+def test_keep_alive_option():
+    params = {
+        "project": "project",
+        "ga4_measurement_id": "G-TEST",
+        "ga4_api_secret": "secret",
+        "log_db_dataset": "dataset",
+    }
+
+    def keep_alive(**options):
+        return options_from_dict({**params, **options}).view_as(ActivationOptions).mp_keep_alive
+
+    assert keep_alive() is True
+    assert keep_alive(mp_keep_alive=True) is True
+    assert keep_alive(mp_keep_alive=False) is False
+    # from_dictionary emits a bare flag for True
+    assert DirectOptions.from_dictionary({**params, "mp_keep_alive": True}).view_as(
+        ActivationOptions
+    ).mp_keep_alive is True
+
+
+def test_counting_http_adapter_threads(mp_server):
+    import concurrent.futures
+
+    adapter = CountingHTTPAdapter(pool_connections=1, pool_maxsize=4)
+    session = requests.Session()
+    session.mount(mp_server.endpoint, adapter)
+    body = json.dumps(_payload("c1", "e0"))
+
+    # sender threads share the adapter of a DoFn instance
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        list(
+            executor.map(
+                lambda _: session.post(f"{mp_server.endpoint}/mp/collect", data=body),
+                range(200),
+            )
+        )
+    session.close()
+
+    assert adapter.requests_sent == 200
+    assert 1 <= adapter.connections_opened <= 200
+
+
+def test_call_measurement_protocol_api_in_flight(mp_server):
+    batches = [[_encoded(f"c{i}", "e0")] for i in range(10)]
+
+    with TestPipeline() as p:
+        output = (
+            p
+            | beam.Create(batches)
+            | beam.ParDo(
+                CallMeasurementProtocolAPI(
+                    "project",
+                    "G-TEST",
+                    "secret",
+                    max_in_flight=4,
+                    endpoint=mp_server.endpoint,
+                )
+            )
+        )
+
+        assert_that(output, equal_to([(b[0], 204, b"") for b in batches]))
+
+    assert len(mp_server.received) == 10
+
+
+def test_call_measurement_protocol_api_retries(mp_server, mocker):
+    mocker.patch("activation.ga4mp.main.backoff_delay", return_value=0)
+    dofn = CallMeasurementProtocolAPI(
+        "project", "G-TEST", "secret", max_retries=2, endpoint=mp_server.endpoint
+    )
+    dofn.setup()
+
+    mp_server.statuses.extend([429, 503])
+    assert [r[1] for r in dofn.process([_encoded("c1", "e0")])] == [204]
+    assert len(mp_server.received) == 3
+
+    mp_server.statuses.extend([500, 502, 503])
+    responses, dead_letters = _split_outputs(dofn.process([_encoded("c2", "e0")]))
+    assert [r[1] for r in responses] == [503]
+    assert len(mp_server.received) == 6
+    assert dead_letters[0][3]["attempts"] == 3
+    assert dead_letters[0][3]["retryable"]
+
+    mp_server.statuses.extend([400])
+    responses, dead_letters = _split_outputs(dofn.process([_encoded("c3", "e0")]))
+    assert [r[1] for r in responses] == [400]
+    assert len(mp_server.received) == 7
+    assert dead_letters[0][3]["attempts"] == 1
+    assert not dead_letters[0][3]["retryable"]
+    dofn.teardown()
+
+    row = next(ToDeadLetterFormat("202309172113").process(dead_letters[0]))
+    assert row["client_id"] == "c3"
+    assert row["status_code"] == 400
+    assert row["payload"] == json.dumps(_payload("c3", "e0"), sort_keys=True)
+    assert row["payload_md5"] == hashlib.md5(row["payload"].encode()).hexdigest()
+
+
+def test_call_measurement_protocol_api_secret_manager(mp_server, mocker):
+    client = mocker.patch(
+        "activation.ga4mp.main.secretmanager"
+    ).SecretManagerServiceClient
+    client.return_value.access_secret_version.return_value.payload.data = json.dumps(
+        {
+            "s1": {"measurement_id": "G-S1", "api_secret": "secret1"},
+            "s2": {"measurement_id": "G-S2", "api_secret": "secret2"},
+        }
+    ).encode()
+
+    dofn = CallMeasurementProtocolAPI(
+        "project", "secret-manager", "rollup-secrets", endpoint=mp_server.endpoint
+    )
+    # instances deserialized on a worker share the loaded secrets
+    copies = [pickle.loads(pickle.dumps(dofn)) for _ in range(3)]
+    for copy in copies:
+        copy.setup()
+    assert client.return_value.access_secret_version.call_count == 1
+
+    results, dead_letters = _split_outputs(
+        list(copies[0].process([_encoded("c1", "e0", stream_id="s2")]))
+        + list(copies[1].process([_encoded("c2", "e0", stream_id="unknown")]))
+    )
+    for copy in copies:
+        copy.teardown()
+
+    assert mp_server.paths == ["/mp/collect?measurement_id=G-S2&api_secret=secret2"]
+    assert [r[0].client_id for r in results] == ["c1"]
+    assert [d[0].client_id for d in dead_letters] == ["c2"]
+    assert dead_letters[0][3]["attempts"] == 0
+
+
+def test_measurement_protocol_server():
+    with MeasurementProtocolServer(throttle_rate=1.0, retry_after=2) as server:
+        body = json.dumps(_payload("c1", "e0"))
+        response = requests.post(f"{server.endpoint}/mp/collect", data=body)
+        assert response.status_code == 429
+        assert response.headers["Retry-After"] == "2"
+
+        server.throttle_rate = 0.0
+        assert (
+            requests.post(f"{server.endpoint}/mp/collect", data=body).status_code == 204
+        )
+        response = requests.post(f"{server.endpoint}/debug/mp/collect", data=body)
+        assert response.json() == {"validationMessages": []}
+        assert requests.post(f"{server.endpoint}/collect", data=body).status_code == 404
+
+        stats = requests.get(f"{server.endpoint}/stats").json()
+        assert stats["requests"] == 3
+        assert stats["status_counts"] == {"429": 1, "204": 1, "200": 1, "404": 1}
+
+
+def test_aimd_concurrency():
+    limiter = AIMDConcurrency(max_concurrency=8, latency_target=1.0)
+    assert limiter.limit == 8
+
+    limiter.acquire()
+    limiter.release(overloaded=True, latency=0.1)
+    assert limiter.limit == 4
+
+    for _ in range(8):
+        limiter.acquire()
+        limiter.release(overloaded=False, latency=0.1)
+    assert 5 < limiter.limit <= 6
+
+    limiter.last_decrease = 0
+    limiter.acquire()
+    limiter.release(overloaded=False, latency=2.0)  # too slow
+    assert limiter.limit < 3
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=50, burst=1)
+    start = time.monotonic()
+    for _ in range(11):
+        bucket.acquire()
+    assert time.monotonic() - start >= 0.19
+
+
+def test_runner_params():
+    params = {
+        "project": "project",
+        "ga4_measurement_id": "G-TEST",
+        "ga4_api_secret": "secret",
+        "log_db_dataset": "dataset",
+        "mp_rate_limit": 100,
+    }
+
+    direct = runner_params({"type": "multi_threading", "num_workers": 4}, "region")
+    assert direct == {
+        "runner": "DirectRunner",
+        "direct_running_mode": "multi_threading",
+        "direct_num_workers": 4,
+    }
+
+    dataflow_runner = {
+        "type": "dataflow",
+        "num_workers": 4,
+        "machine_type": "n2-standard-2",
+        "sdk_container_image": "image",
+    }
+    dataflow = runner_params(dataflow_runner, "us-central1")
+    assert dataflow == {
+        "runner": "DataflowRunner",
+        "region": "us-central1",
+        "max_num_workers": 4,
+        "machine_type": "n2-standard-2",
+        "sdk_container_image": "image",
+    }
+
+    # workers of the default image can't import the activation code, and without a
+    # worker count the rate limit isn't split between them
+    for missing in ({"sdk_container_image": None}, {"num_workers": 0}):
+        with pytest.raises(ValueError):
+            runner_params({**dataflow_runner, **missing}, "us-central1")
+
+    # the run wide rate is split between the Dataflow workers
+    options = DirectOptions.from_dictionary({**params, **dataflow})
+    assert mp_limits(options.view_as(ActivationOptions))["default"]["rate"] == 25
+
+
+def test_check_resume(mocker):
+    params = {
+        "project": "project",
+        "ga4_measurement_id": "G-TEST",
+        "ga4_api_secret": "secret",
+        "log_db_dataset": "dataset",
+        "prediction_run_id": "202301010000",
+        "resume": True,
+    }
+    client = mocker.Mock()
+    client.query.return_value.result.return_value = [{"sent": 0}]
+
+    # runs logging successful events don't need the check
+    check_resume(
+        client, DirectOptions.from_dictionary(params).view_as(ActivationOptions)
+    )
+    client.query.assert_not_called()
+
+    # failures_only logs no SEND_OK rows, a resume would send every event again
+    options = DirectOptions.from_dictionary({**params, "log_detail": "failures_only"})
+    with pytest.raises(ValueError):
+        check_resume(client, options.view_as(ActivationOptions))
+
+    client.query.return_value.result.return_value = [{"sent": 3}]
+    check_resume(client, options.view_as(ActivationOptions))
+
+
+def test_inprocess_matches_pipeline(mp_server):
+    rows = [
+        {
+            "client_id": f"c{i % 4}",
+            "event_timestamp": "2023-02-25",
+            "event_name": f"e{i}",
+            "ep_score": i,
+        }
+        for i in range(30)
+    ]
+    mp_server.fail_clients.add("c3")
+    options = DirectOptions.from_dictionary(
+        {
+            "project": "project",
+            "source_table": "dataset.table",
+            "log_db_dataset": "dataset",
+            "prediction_run_id": "202309172113",
+            "ga4_measurement_id": "G-TEST",
+            "ga4_api_secret": "secret",
+            "mp_batch_size": 5,
+            "mp_endpoint": mp_server.endpoint,
+        }
+    ).view_as(ActivationOptions)
+
+    log_rows, dead_letter_rows = activate(rows, options)
+    assert len(log_rows) == 30
+    assert len(dead_letter_rows) == 7
+
+    def comparable(row):
+        # uuid and attempt times differ between any two runs
+        ignored = ("id", "first_attempt_ts", "last_attempt_ts")
+        return {k: v for k, v in row.items() if k not in ignored}
+
+    with TestPipeline() as p:
+        outputs = (
+            p
+            | beam.Create(rows)
+            | beam.ParDo(TransformToPayload())
+            | beam.Map(EncodedPayload.from_dict)
+            | beam.Map(lambda payload: (payload.key, payload))
+            | beam.GroupByKey()
+            | beam.ParDo(BatchPayloads(options.mp_batch_size))
+            | beam.ParDo(
+                CallMeasurementProtocolAPI(
+                    "project", "G-TEST", "secret", endpoint=mp_server.endpoint
+                )
+            ).with_outputs(CallMeasurementProtocolAPI.DEAD_LETTER, main="responses")
+        )
+        logs = (
+            outputs.responses
+            | "Log" >> beam.ParDo(ToLogFormat("202309172113"))
+            | "Comparable log" >> beam.Map(comparable)
+        )
+        dead_letters = (
+            outputs[CallMeasurementProtocolAPI.DEAD_LETTER]
+            | "Dead letter" >> beam.ParDo(ToDeadLetterFormat("202309172113"))
+            | "Comparable dead letter" >> beam.Map(comparable)
+        )
+
+        assert_that(
+            logs, equal_to([comparable(r) for r in log_rows]), label="Check logs"
+        )
+        assert_that(
+            dead_letters,
+            equal_to([comparable(r) for r in dead_letter_rows]),
+            label="Check dead letters",
+        )
+
+
+def test_run_metrics(mp_server, mocker):
+    mocker.patch("activation.ga4mp.main.backoff_delay", return_value=0)
+    rows = [
+        {
+            "client_id": f"c{i % 4}",
+            "event_timestamp": "2023-02-25",
+            "event_name": f"e{i}",
+            "ep_score": i,
+        }
+        for i in range(30)
+    ]
+    mp_server.fail_clients.add("c3")
+    params = {
+        "project": "project",
+        "source_table": "dataset.table",
+        "log_db_dataset": "dataset",
+        "prediction_run_id": "202309172113",
+        "ga4_measurement_id": "G-TEST",
+        "ga4_api_secret": "secret",
+        "mp_batch_size": 5,
+        "mp_endpoint": mp_server.endpoint,
+    }
+
+    mp_server.statuses.append(503)
+    summary = run(
+        params,
+        source=beam.Create(rows),
+        sink=lambda *args: beam.Map(lambda row: None),
+    )
+    assert summary["rows_in"] == 30
+    assert summary["events_sent_ok"] == 23
+    assert summary["events_send_fail"] == 7
+    assert summary["requests"] == 9  # 8 batches and one retry
+    assert summary["retries"] == 1
+    assert summary["status_codes"] == [
+        {"status_code": 204, "responses": 6},
+        {"status_code": 400, "responses": 2},
+        {"status_code": 503, "responses": 1},
+    ]
+    assert summary["http_latency_ms_max"] >= 0
+    assert summary["send_latency_ms_max"] >= summary["http_latency_ms_max"]
+    assert summary["payload_bytes"] > summary["request_bytes"] > 0
+
+    mp_server.statuses.append(503)
+    with metrics_scope() as container:
+        activate(rows, DirectOptions.from_dictionary(params).view_as(ActivationOptions))
+    inprocess_summary = container_summary(container)
+
+    def comparable(summary):
+        ignored = (
+            "http_latency_ms_mean",
+            "http_latency_ms_max",
+            "send_latency_ms_mean",
+            "send_latency_ms_max",
+        )
+        return {k: v for k, v in summary.items() if k not in ignored}
+
+    assert comparable(inprocess_summary) == comparable(summary)
+
+    row = run_stats_row(
+        "202309172113",
+        "beam",
+        datetime.datetime.now(datetime.timezone.utc),
+        2.0,
+        summary,
+    )
+    assert row["events_per_sec"] == 15.0
+    assert row["prediction_run_ts"] == datetime.datetime(2023, 9, 17, 21, 13)
+
+
+def test_run_without_batching(mp_server):
+    rows = [
+        {"client_id": f"c{i}", "event_timestamp": "2023-02-25", "event_name": "e"}
+        for i in range(10)
+    ]
+    params = {
+        "project": "project",
+        "source_table": "dataset.table",
+        "log_db_dataset": "dataset",
+        "prediction_run_id": "202309172113",
+        "ga4_measurement_id": "G-TEST",
+        "ga4_api_secret": "secret",
+        "mp_batch_size": 1,
+        "mp_endpoint": mp_server.endpoint,
+    }
+
+    summary = run(
+        params,
+        source=beam.Create(rows),
+        sink=lambda *args: beam.Map(lambda row: None),
+    )
+    assert summary["events_sent_ok"] == 10
+    assert summary["requests"] == 10
+
+    # one request per payload, without grouping the payloads by request attributes
+    options = DirectOptions.from_dictionary(params).view_as(ActivationOptions)
+    p = beam.Pipeline()
+    _ = p | beam.Create([]) | SendPayloads(options)
+    labels = {t.unique_name for t in p.to_runner_api().components.transforms.values()}
+    assert not any("Group by request attributes" in label for label in labels)
+
+
+def test_run_stream_limits(mp_server):
+    rows = [
+        {"client_id": f"c{i}", "event_timestamp": "2023-02-25", "event_name": "e"}
+        for i in range(5)
+    ]
+    params = {
+        "project": "project",
+        "source_table": "dataset.table",
+        "log_db_dataset": "dataset",
+        "prediction_run_id": "202309172113",
+        "ga4_measurement_id": "G-TEST",
+        "ga4_api_secret": "secret",
+        "mp_rate_limit": 100,
+        "mp_stream_limits": json.dumps({"G-TEST": {"rate": 50, "max_concurrency": 2}}),
+        "mp_endpoint": mp_server.endpoint,
+    }
+
+    # the override replaces the defaults of the destination instead of clashing with them
+    summary = run(
+        params,
+        source=beam.Create(rows),
+        sink=lambda *args: beam.Map(lambda row: None),
+    )
+    assert summary["events_sent_ok"] == 5
+    assert len(mp_server.received) == 5
+
+    options = DirectOptions.from_dictionary(params).view_as(ActivationOptions)
+    dofn = CallMeasurementProtocolAPI(
+        "project", "G-TEST", "secret", limits=mp_limits(options)
+    )
+    limiter = dofn._limiter(None)
+    assert limiter.bucket.rate == 50
+    assert limiter.concurrency.max_concurrency == 2
+
+
+def test_resume_option():
+    params = {
+        "project": "project",
+        "ga4_measurement_id": "G-TEST",
+        "ga4_api_secret": "secret",
+        "log_db_dataset": "dataset",
+    }
+
+    def resume(*flags, **options):
+        if options:
+            activation_options = DirectOptions.from_dictionary({**params, **options})
+        else:
+            activation_options = DirectOptions(
+                [f"--{k}={v}" for k, v in params.items()] + list(flags)
+            )
+        return activation_options.view_as(ActivationOptions).resume
+
+    assert resume() is False
+    assert resume("--resume") is True
+    assert resume("--resume=1") is True
+    assert resume("--resume=False") is False
+    assert resume(resume=True) is True
+    assert resume(resume=False) is False
+
+
+def test_resume(mp_server, mocker):
+    from activation.ga4mp import inprocess
+
+    rows = [
+        {"client_id": f"c{i}", "event_timestamp": "2023-02-25", "event_name": "e"}
+        for i in range(4)
+    ]
+    # the payloads of c0 and c1 were logged as SEND_OK by a previous attempt
+    sent = [
+        {"payload_md5": EncodedPayload.from_dict(payload).md5}
+        for row in rows[:2]
+        for payload in TransformToPayload().process(row)
+    ]
+    params = {
+        "project": "project",
+        "source_table": "dataset.table",
+        "log_db_dataset": "dataset",
+        "prediction_run_id": "202309172113",
+        "ga4_measurement_id": "G-TEST",
+        "ga4_api_secret": "secret",
+        "mp_endpoint": mp_server.endpoint,
+        "resume": True,
+    }
+
+    mocker.patch("common.bigquery_ops.get_client")
+    mocker.patch(
+        "activation.ga4mp.main.read_sent_payloads",
+        side_effect=lambda p, options: p | "Sent payloads" >> beam.Create(sent),
+    )
+    summary = run(
+        params,
+        source=beam.Create(rows),
+        sink=lambda *args: beam.Map(lambda row: None),
+    )
+    assert summary["events_sent_ok"] == 2
+    assert sorted(json.loads(body)["client_id"] for body in mp_server.received) == [
+        "c2",
+        "c3",
+    ]
+
+    mp_server.received.clear()
+    client = mocker.patch("activation.ga4mp.inprocess.get_client").return_value
+    client.get_table.return_value.schema = [
+        types.SimpleNamespace(name=name) for name in rows[0]
+    ]
+    client.list_rows.return_value = [types.SimpleNamespace(items=row.items) for row in rows]
+    client.query.return_value.result.return_value = sent
+    load_rows = mocker.patch("activation.ga4mp.inprocess.load_rows")
+
+    summary = inprocess.run(params)
+    assert summary["events_sent_ok"] == 2
+    assert sorted(json.loads(body)["client_id"] for body in mp_server.received) == [
+        "c2",
+        "c3",
+    ]
+    log_rows = load_rows.call_args_list[0].args[1]
+    assert sorted(r["client_id"] for r in log_rows) == ["c2", "c3"]
+
+
+def test_inprocess_run_checks(mocker):
+    from activation.ga4mp import inprocess
+
+    get_client = mocker.patch("activation.ga4mp.inprocess.get_client")
+    params = {
+        "project": "project",
+        "source_table": "dataset.table",
+        "log_db_dataset": "dataset",
+        "ga4_measurement_id": "G-TEST",
+        "ga4_api_secret": "secret",
+    }
+    with pytest.raises(ValueError):
+        inprocess.run(params)
+    get_client.assert_not_called()
+
+    # without the Beam internals the activation runs, only without metrics
+    mocker.patch("activation.ga4mp.inprocess.statesampler", None)
+    with metrics_scope() as container:
+        assert container is None
+    assert container_summary(container)["requests"] == 0
+
+
+def test_streaming_activation(mp_server):
+    start = 1695000000  # 2023-09-18 01:20:00 UTC, a window start
+
+    def message(client_id, event_name):
+        row = {
+            "client_id": client_id,
+            "event_timestamp": "2023-09-18 01:20:00 UTC",
+            "event_name": event_name,
+            "ep_score": 1,
+        }
+        return json.dumps(row).encode()
+
+    stream = (
+        TestStream()
+        .advance_watermark_to(start)
+        .add_elements(
+            [
+                beam.window.TimestampedValue(message("c1", "e0"), start + 1),
+                beam.window.TimestampedValue(message("c1", "e1"), start + 2),
+                beam.window.TimestampedValue(b"not a row", start + 3),
+            ]
+        )
+        .advance_watermark_to(start + 60)
+        .add_elements(
+            [
+                beam.window.TimestampedValue(message("c2", "e2"), start + 61),
+                beam.window.TimestampedValue(message("c3", "e3"), start + 62),
+            ]
+        )
+        .advance_watermark_to_infinity()
+    )
+    mp_server.fail_clients.add("c3")
+    options = DirectOptions.from_dictionary(
+        {
+            "project": "project",
+            "log_db_dataset": "dataset",
+            "ga4_measurement_id": "G-TEST",
+            "ga4_api_secret": "secret",
+            "mp_endpoint": mp_server.endpoint,
+        }
+    )
+    options.view_as(StandardOptions).streaming = True
+
+    with TestPipeline(options=options) as p:
+        log_rows, dead_letter_rows = (
+            p | stream | ActivateStream(options.view_as(ActivationOptions), 60)
+        )
+        assert_that(
+            log_rows
+            | "Log run and state"
+            >> beam.Map(
+                lambda r: (r["prediction_run_id"], r["event_name"], r["state"])
+            ),
+            equal_to(
+                [
+                    ("202309180120", "e0", "SEND_OK 204"),
+                    ("202309180120", "e1", "SEND_OK 204"),
+                    ("202309180121", "e2", "SEND_OK 204"),
+                    ("202309180121", "e3", "SEND_FAIL 400"),
+                ]
+            ),
+            label="Check logs",
+        )
+        assert_that(
+            dead_letter_rows
+            | "Dead letter run"
+            >> beam.Map(lambda r: (r["prediction_run_id"], r["client_id"])),
+            equal_to([("202309180121", "c3")]),
+            label="Check dead letters",
+        )
+
+    # e0 and e1 share their request attributes and window, so one request
+    assert len(mp_server.received) == 3
+
+
 def test_pipeline(config):
     from main import run
 
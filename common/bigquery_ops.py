@@ -0,0 +1,385 @@
+"""
+BigQuery helpers shared by the pipeline components.
+
+Components get their client from `get_client`, one per project and process, and run
+every statement with `run_query`, i.e. with the retry policy and the job labels.
+
+Writes are scoped to a single run. Re-running a step replaces the rows of its run only:
+a MERGE on FALSE inserts the new rows and deletes the run's previous ones with a
+`WHEN NOT MATCHED BY SOURCE` clause bounded by constants (and the run's date
+partitions), so BigQuery prunes the target to the affected partitions and clusters
+instead of scanning the whole table as a `DELETE ... WHERE run_id = ...` does. The
+table is created if missing in the same script, so a write is a single job.
+
+The queries run inside a `job_stats_scope` are recorded (bytes, slot-ms, cache hit,
+wall time) to the `pipeline_job_stats` table and the component's Metrics artifact. The
+scope also applies the `cost_guardrails` config: a dry run estimating the bytes of each
+query, warned about or rejected above the component's budget. When rejected, the budget
+is also set as the maximum bytes billed of the query.
+"""
+
+import contextlib
+import datetime
+import logging
+import time
+
+from google.api_core.exceptions import GoogleAPICallError
+from google.cloud import bigquery
+
+from common.retry_policies import BIGQUERY_RETRY_POLICY
+
+JOB_STATS_TABLE_NAME = "pipeline_job_stats"
+JOB_STATS_SCHEMA = [
+    bigquery.SchemaField("run_id", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("component", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("job_id", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("statement_type", "STRING"),
+    bigquery.SchemaField("total_bytes_processed", "INT64"),
+    bigquery.SchemaField("total_bytes_billed", "INT64"),
+    bigquery.SchemaField("slot_ms", "INT64"),
+    bigquery.SchemaField("cache_hit", "BOOL"),
+    bigquery.SchemaField("wall_time_s", "FLOAT64"),
+    bigquery.SchemaField("finished_ts", "TIMESTAMP", mode="REQUIRED"),
+    bigquery.SchemaField("estimated_bytes", "INT64"),
+    bigquery.SchemaField("maximum_bytes_billed", "INT64"),
+]
+
+_clients = {}
+_job_stats = []
+
+
+class CostGuardrailExceeded(Exception):
+    pass
+
+
+def get_client(project):
+    # one client per project and process, so components and helpers called in the same
+    # process share its credentials and connection pool
+    if project not in _clients:
+        _clients[project] = bigquery.Client(project=project)
+    return _clients[project]
+
+
+def run_query(client, query, labels=None, query_parameters=None):
+    """
+    Runs `query`, a statement or a multi-statement script, with the retry policy and
+    waits for it. Returns the rows of its (last) SELECT.
+    """
+    job_config = bigquery.QueryJobConfig(
+        labels=labels or {}, query_parameters=query_parameters or []
+    )
+    stats = _job_stats[-1] if _job_stats else None
+    estimated_bytes = None
+    if stats is not None:
+        estimated_bytes = stats.preflight(client, query, job_config)
+        if stats.maximum_bytes_billed is not None:
+            job_config.maximum_bytes_billed = stats.maximum_bytes_billed
+
+    start = time.monotonic()
+    query_job = client.query(
+        query=query, job_config=job_config, job_retry=BIGQUERY_RETRY_POLICY
+    )
+    rows = query_job.result()
+    if stats is not None:
+        stats.record(query_job, time.monotonic() - start, estimated_bytes)
+    return rows
+
+
+def estimate_bytes(client, query, labels=None, query_parameters=None):
+    """Bytes `query` would process, from a dry run."""
+    job_config = bigquery.QueryJobConfig(
+        dry_run=True,
+        use_query_cache=False,
+        labels=labels or {},
+        query_parameters=query_parameters or [],
+    )
+    return client.query(query=query, job_config=job_config).total_bytes_processed
+
+
+class JobStats:
+    """Statistics of the query jobs of a component run, see `job_stats_scope`."""
+
+    def __init__(self, component, run_id, cost_guardrails=None):
+        self.component = component
+        self.run_id = run_id
+        self.rows = []
+        self.estimates = []
+
+        cost_guardrails = cost_guardrails or {}
+        self.dry_run = cost_guardrails.get("dry_run", False)
+        self.on_exceeded = cost_guardrails.get("on_exceeded", "warn")
+        max_gb_billed = cost_guardrails.get("max_gb_billed", {}).get(component)
+        self.budget = int(max_gb_billed * 2**30) if max_gb_billed else None
+        # BigQuery fails the jobs over their maximum bytes billed, so the budget is only
+        # set on the jobs when exceeding it should fail
+        self.maximum_bytes_billed = self.budget if self.on_exceeded == "fail" else None
+
+    def preflight(self, client, query, job_config):
+        """
+        Dry runs `query` if configured and checks the estimate against the budget.
+        Returns the estimated bytes, None without a dry run.
+        """
+        if not self.dry_run:
+            return None
+
+        try:
+            estimate = estimate_bytes(
+                client, query, job_config.labels, job_config.query_parameters
+            )
+        except GoogleAPICallError as e:
+            # e.g. a script whose statements read the tables its earlier ones create
+            logging.warning(f"{self.component} query dry run failed: {e}")
+            return None
+
+        self.estimates.append(estimate or 0)
+        logging.info(f"{self.component} query is estimated to process {estimate} bytes")
+        budget = self.budget
+        if budget is not None and estimate and estimate > budget:
+            message = (
+                f"{self.component} query is estimated to process {estimate} bytes, "
+                f"over its budget of {budget} bytes (cost_guardrails.max_gb_billed)"
+            )
+            if self.on_exceeded == "fail":
+                raise CostGuardrailExceeded(message)
+            logging.warning(message)
+        return estimate
+
+    def record(self, query_job, wall_time_s, estimated_bytes=None):
+        # for a script these are the totals of its child jobs
+        self.rows.append(
+            {
+                "run_id": self.run_id,
+                "component": self.component,
+                "job_id": query_job.job_id,
+                "statement_type": query_job.statement_type,
+                "total_bytes_processed": query_job.total_bytes_processed or 0,
+                "total_bytes_billed": query_job.total_bytes_billed or 0,
+                "slot_ms": query_job.slot_millis or 0,
+                "cache_hit": bool(query_job.cache_hit),
+                "wall_time_s": round(wall_time_s, 3),
+                "finished_ts": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                "estimated_bytes": estimated_bytes,
+                "maximum_bytes_billed": self.maximum_bytes_billed,
+            }
+        )
+
+    def totals(self):
+        return {
+            "jobs": len(self.rows),
+            "cache_hits": sum(r["cache_hit"] for r in self.rows),
+            # also of the queries rejected by the guardrails
+            "estimated_bytes": sum(self.estimates),
+            **{
+                k: sum(r[k] for r in self.rows)
+                for k in (
+                    "total_bytes_processed",
+                    "total_bytes_billed",
+                    "slot_ms",
+                    "wall_time_s",
+                )
+            },
+        }
+
+    def log_metrics(self, metrics):
+        for k, v in self.totals().items():
+            metrics.log_metric(k, v)
+
+    def write(self, client, table_id):
+        if not self.rows:
+            return
+        job_config = bigquery.LoadJobConfig(
+            schema=JOB_STATS_SCHEMA,
+            write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+            create_disposition=bigquery.CreateDisposition.CREATE_IF_NEEDED,
+            time_partitioning=bigquery.TimePartitioning(
+                type_=bigquery.TimePartitioningType.DAY, field="finished_ts"
+            ),
+            clustering_fields=["run_id", "component"],
+            schema_update_options=[bigquery.SchemaUpdateOption.ALLOW_FIELD_ADDITION],
+        )
+        client.load_table_from_json(self.rows, table_id, job_config=job_config).result()
+
+
+@contextlib.contextmanager
+def job_stats_scope(
+    client, dataset, component, run_id, metrics=None, cost_guardrails=None
+):
+    """
+    Records the queries `run_query` runs in the scope, also when the component fails,
+    to the `pipeline_job_stats` table of `dataset` and the totals to `metrics`.
+    `cost_guardrails` is the validated config section, see `JobStats.preflight`.
+    """
+    stats = JobStats(component, run_id, cost_guardrails)
+    _job_stats.append(stats)
+    try:
+        yield stats
+    finally:
+        _job_stats.remove(stats)
+        logging.info(f"{component} BigQuery job stats: {stats.totals()}")
+        if metrics is not None:
+            stats.log_metrics(metrics)
+        try:
+            stats.write(client, f"{dataset}.{JOB_STATS_TABLE_NAME}")
+        except Exception as e:  # the stats must not fail the component
+            logging.warning(f"Could not write the job stats of {component}: {e}")
+
+
+def _labels(labels):
+    return ", ".join(f'("{k}", "{v}")' for k, v in (labels or {}).items())
+
+
+def create_table_sql(
+    table_id,
+    columns=None,
+    as_query=None,
+    partition_by=None,
+    cluster_by=None,
+    labels=None,
+):
+    """
+    Idempotent DDL of `table_id`, either from `columns` (column definitions, e.g.
+    "client_id STRING NOT NULL") or with the schema and rows of `as_query`.
+    """
+    return f"""
+        CREATE TABLE IF NOT EXISTS `{table_id}`
+        {f"({', '.join(columns)})" if columns else ""}
+        {f"PARTITION BY {partition_by}" if partition_by else ""}
+        {f"CLUSTER BY {', '.join(cluster_by)}" if cluster_by else ""}
+        {f"OPTIONS( labels = [{_labels(labels)}] )" if labels else ""}
+        {f"AS {as_query}" if as_query else ""}
+    """
+
+
+def ensure_table(client, table_id, labels=None, **table_options):
+    """Creates `table_id` if missing, see `create_table_sql` for the options."""
+    run_query(
+        client, create_table_sql(table_id, labels=labels, **table_options), labels
+    )
+
+
+def replace_run_rows_script(
+    table_id,
+    source_query,
+    match,
+    partition_by=None,
+    cluster_by=None,
+    labels=None,
+    then=None,
+    return_rows=False,
+):
+    """
+    Multi-statement script replacing the rows of `table_id` that match `match`, a dict
+    of column to string value (e.g. {"prediction_run_id": run_id, "model_name": name}),
+    with the result of `source_query`.
+
+    The table is created from the source's schema if missing. With a DATE
+    `partition_by` column, the rows replaced are limited to the partitions the new
+    rows fall in, so they should cover the same dates as the rows of a previous run.
+    Without new rows there are no partitions to limit to, the matching rows are then
+    deleted from the whole table.
+    `then` are statements run after the MERGE, they can read the new rows from the
+    `run_rows` temp table. With `return_rows` the script ends selecting the new rows.
+    """
+    matched = [f't.{col} = "{value}"' for col, value in match.items()]
+    bounded = list(matched)
+    declare, set_partitions = "", ""
+    if partition_by:
+        declare = "DECLARE run_partitions ARRAY<DATE>;"
+        set_partitions = f"""
+        SET run_partitions = (
+          SELECT ARRAY_AGG(DISTINCT {partition_by}) FROM run_rows
+        );"""
+        bounded.insert(0, f"t.{partition_by} IN UNNEST(run_partitions)")
+
+    merge = f"""
+        MERGE `{table_id}` as t
+        USING run_rows as s
+        ON FALSE
+        WHEN NOT MATCHED BY SOURCE AND {" AND ".join(bounded)} THEN
+          DELETE
+        WHEN NOT MATCHED THEN
+          INSERT ROW"""
+    if partition_by:
+        # ARRAY_AGG of no rows is NULL, a re-run without rows still removes the old ones
+        merge = f"""
+        IF run_partitions IS NULL THEN
+          DELETE FROM `{table_id}` as t
+          WHERE {" AND ".join(matched)};
+        ELSE
+          {merge};
+        END IF"""
+
+    create_table = create_table_sql(
+        table_id,
+        as_query="SELECT * FROM run_rows WHERE FALSE",
+        partition_by=partition_by,
+        cluster_by=cluster_by,
+        labels=labels,
+    )
+    return f"""
+        {declare}
+        CREATE TEMP TABLE run_rows AS
+        {source_query};
+        {set_partitions}
+
+        {create_table};
+
+        {merge};
+
+        {then or ""}
+
+        {"SELECT * FROM run_rows;" if return_rows else ""}
+    """
+
+
+def upsert_run_rows(
+    client,
+    table_id,
+    source_query,
+    match,
+    labels=None,
+    query_parameters=None,
+    **table_options,
+):
+    """
+    Replaces the rows of `table_id` matching `match` with the result of
+    `source_query` in a single job, see `replace_run_rows_script`.
+    """
+    return run_query(
+        client,
+        replace_run_rows_script(
+            table_id, source_query, match, labels=labels, **table_options
+        ),
+        labels,
+        query_parameters,
+    )
+
+
+def prediction_run_index_sql(table_id, run_id, model_name, labels=None):
+    """
+    Statements recording the prediction run in the `table_id` index, one row per
+    date of the predictions in `run_rows` (see `replace_run_rows_script`), so the
+    latest run and its dates are looked up without scanning the predictions.
+    """
+    create_table = create_table_sql(
+        table_id,
+        columns=[
+            "prediction_run_id STRING NOT NULL",
+            "model_name STRING NOT NULL",
+            "date DATE",
+            "row_count INT64 NOT NULL",
+            "finished_at TIMESTAMP NOT NULL",
+        ],
+        labels=labels,
+    )
+    return f"""
+        {create_table};
+
+        DELETE FROM `{table_id}`
+        WHERE prediction_run_id = "{run_id}" AND model_name = "{model_name}";
+
+        INSERT INTO `{table_id}`
+        SELECT "{run_id}", "{model_name}", date, COUNT(*), CURRENT_TIMESTAMP()
+        FROM run_rows
+        GROUP BY date;
+    """
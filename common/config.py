@@ -18,6 +18,14 @@ def val_greater_or_equal_to_one(x):
     return x >= 1
 
 
+def val_dataflow_runner(runner):
+    # Dataflow workers need an image with this repository to import the activation
+    # code, and a worker count to split the run wide rate limit between them
+    return runner["type"] != "dataflow" or (
+        "sdk_container_image" in runner and runner["num_workers"] > 0
+    )
+
+
 def between_5_and_100(x):
     return 5 <= x <= 100
 
@@ -28,6 +36,30 @@ def length_less_than_64(x):
 
 # START: ACTIVATION
 
+schema_activation_ga4mp_runner = Schema(
+    And(
+        {
+            Optional("type", default="multi_processing"): And(
+                str,
+                Use(str.lower),
+                lambda t: t
+                in ["inprocess", "multi_threading", "multi_processing", "dataflow"],
+            ),
+            Optional("num_workers", default=0): And(int, val_greater_or_equal_to_zero),
+            Optional("cpu_request"): Use(str),
+            Optional("cpu_limit"): Use(str),
+            Optional("memory_request"): Use(str),
+            Optional("memory_limit"): Use(str),
+            Optional("machine_type"): str,  # applies to type=dataflow
+            Optional("sdk_container_image"): str,  # applies to type=dataflow
+        },
+        Schema(
+            val_dataflow_runner,
+            error="runner type dataflow requires sdk_container_image and num_workers > 0",
+        ),
+    )
+)
+
 schema_activation_ga4mp = Schema(
     {
         "query_path": And(str, os.path.exists),
@@ -36,6 +68,15 @@ schema_activation_ga4mp = Schema(
         "ga4_api_secret": str,
         Optional("ga4_mp_debug", default=True): bool,
         Optional("create_ga4_setup", default=False): bool,
+        Optional("inprocess_max_rows", default=10000): int,
+        Optional("log_detail", default="full"): And(
+            str,
+            Use(str.lower),
+            lambda d: d in ["full", "hash_only", "failures_only"],
+        ),
+        Optional(
+            "runner", default={"type": "multi_processing", "num_workers": 0}
+        ): schema_activation_ga4mp_runner,
     }
 )
 
@@ -99,6 +140,23 @@ schema_training = Schema(
 
 # END: TRAINING
 
+# START: COST GUARDRAILS
+
+schema_cost_guardrails = Schema(
+    {
+        Optional("dry_run", default=False): bool,
+        Optional("on_exceeded", default="warn"): And(
+            str, Use(str.lower), lambda a: a in ["warn", "fail"]
+        ),
+        # budget by component name, e.g. bqml_training_op: 500
+        Optional("max_gb_billed", default={}): {
+            Optional(str): And(Use(float), lambda gb: gb > 0)
+        },
+    }
+)
+
+# END: COST GUARDRAILS
+
 # START: MAIN
 
 config_schema = Schema(
@@ -111,6 +169,10 @@ config_schema = Schema(
         Optional("training"): schema_training,
         "prediction": schema_prediction,
         Optional("activation"): schema_activation,
+        Optional(
+            "cost_guardrails",
+            default={"dry_run": False, "on_exceeded": "warn", "max_gb_billed": {}},
+        ): schema_cost_guardrails,
         Optional(object): dict,
     }
 )
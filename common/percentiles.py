@@ -0,0 +1,81 @@
+"""
+Percentile maps as sorted boundary arrays, so percentiles are assigned with RANGE_BUCKET
+instead of `p >= lower_bnd AND p < upper_bnd` range joins.
+
+A model's percentile map has contiguous [lower_bnd, upper_bnd) buckets ordered by
+percentile, the first one starting at -inf. Its boundaries are the lower bounds of all
+buckets but the first, so RANGE_BUCKET(p, bounds) is the position of p's bucket and
+percentiles[OFFSET(RANGE_BUCKET(p, bounds))] its percentile.
+"""
+
+
+def percentile_buckets_query(predictions, training_run_id, model_name):
+    """
+    Query of the percentile map buckets of the `p` column of `predictions`, a table or
+    CTE name, the model_percentile_map rows of the model without the conversion stats.
+    Duplicate tiles of skewed predictions are dropped, so some percentiles have no bucket.
+    """
+    return f"""
+    SELECT
+      "{training_run_id}" as training_run_id,
+      "{model_name}" as model_name,
+      *
+    FROM (
+      SELECT
+        q - 1 as percentile,
+        IF(prev_lower_bnd IS NULL, CAST('-inf' as FLOAT64), lower_bnd) as lower_bnd,
+        IF(upper_bnd IS NULL, CAST('inf' as FLOAT64), upper_bnd) as upper_bnd
+      FROM (
+        SELECT
+          ROW_NUMBER() OVER (ORDER BY tile) as q,
+          LAG(tile) OVER (ORDER BY tile) as prev_lower_bnd,
+          tile as lower_bnd,
+          LEAD(tile) OVER (ORDER BY tile) as upper_bnd
+        FROM (SELECT APPROX_QUANTILES(p, 99) as tile FROM {predictions}), UNNEST(tile) as tile
+      )
+    )
+    WHERE lower_bnd != upper_bnd
+    """
+
+
+def percentile_bounds_query(percentile_map):
+    """
+    Query of one (training_run_id, model_name, bounds, percentiles) row per map of
+    `percentile_map`, a table or subquery with the model_percentile_map columns.
+    """
+    return f"""
+    SELECT
+      training_run_id,
+      model_name,
+      ARRAY_AGG(
+        IF(lower_bnd = CAST('-inf' as FLOAT64), NULL, lower_bnd)
+        IGNORE NULLS ORDER BY percentile
+      ) as bounds,
+      ARRAY_AGG(percentile ORDER BY percentile) as percentiles
+    FROM {percentile_map}
+    GROUP BY training_run_id, model_name
+    """
+
+
+def missing_bounds_sql(percentile_map_table, bounds_table):
+    """
+    INSERT into `bounds_table` of the bounds of every map of `percentile_map_table` it
+    has no row for yet, e.g. of models trained before the bounds table existed.
+    """
+    missing_maps = f"""(
+      SELECT m.*
+      FROM {percentile_map_table} as m
+      LEFT JOIN (
+        SELECT DISTINCT training_run_id, model_name FROM {bounds_table}
+      ) as b USING (training_run_id, model_name)
+      WHERE b.model_name IS NULL
+    )"""
+    return f"""
+    INSERT INTO {bounds_table} (training_run_id, model_name, bounds, percentiles)
+    {percentile_bounds_query(missing_maps)}
+    """
+
+
+def percentile_lookup(value, bounds):
+    # SQL expression of the percentile of `value`, `bounds` is a percentile_bounds_query row
+    return f"{bounds}.percentiles[OFFSET(RANGE_BUCKET({value}, {bounds}.bounds))]"
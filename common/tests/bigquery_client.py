@@ -0,0 +1,28 @@
+"""
+Offline BigQuery client of the tests counting the BigQuery API calls of the components,
+its query jobs carry the statistics `job_stats_scope` records.
+"""
+
+import collections
+from unittest import mock
+
+QUERY_JOB = {
+    "job_id": "job",
+    "statement_type": "SCRIPT",
+    "total_bytes_processed": 100,
+    "total_bytes_billed": 10 * 2**20,
+    "slot_millis": 50,
+    "cache_hit": False,
+}
+
+
+def offline_client(**query_job):
+    # `query_job` overrides the statistics of the query jobs
+    client = mock.Mock()
+    client.query.return_value.result.return_value = []
+    client.query.return_value.configure_mock(**{**QUERY_JOB, **query_job})
+    return client
+
+
+def api_calls(client):
+    return collections.Counter(name for name, *_ in client.method_calls)
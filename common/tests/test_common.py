@@ -2,6 +2,8 @@ import logging
 from google.cloud import bigquery
 from common.retry_policies import *
 from common.config import *
+from common.bigquery_ops import *
+from common.tests.bigquery_client import offline_client
 
 def test_bq_query_retry_logic(caplog):
     caplog.set_level(logging.INFO)
@@ -38,4 +40,162 @@ def test_helpers():
 
     assert length_less_than_64("Hello, world!") 
     assert not length_less_than_64("Tb0snRBOjmit0MrxosQkmXJ19oJTGR6pEQJzS7Oy0mrrfl79uRw392UhVKvVgzRr") 
-    assert not length_less_than_64("H7A6cygR2wG7keEjQzXwarhYKtWtVZZnZURQM3GLCvZlTvegy6xsjgHHd6Vw72UvO")
\ No newline at end of file
+    assert not length_less_than_64("H7A6cygR2wG7keEjQzXwarhYKtWtVZZnZURQM3GLCvZlTvegy6xsjgHHd6Vw72UvO")
+
+
+def test_replace_run_rows_script():
+    script = replace_run_rows_script(
+        "ds.predictions",
+        "SELECT * FROM ds.tmp",
+        {"prediction_run_id": "123", "model_name": "model_1"},
+        partition_by="date",
+        cluster_by=["prediction_run_id"],
+        labels={"vai-mlops": "inference"},
+    )
+    assert script.strip().startswith("DECLARE run_partitions ARRAY<DATE>;")
+    assert "CREATE TABLE IF NOT EXISTS `ds.predictions`" in script
+    assert "PARTITION BY date" in script and "CLUSTER BY prediction_run_id" in script
+    assert 'OPTIONS( labels = [("vai-mlops", "inference")] )' in script
+    assert (
+        "WHEN NOT MATCHED BY SOURCE AND t.date IN UNNEST(run_partitions) "
+        'AND t.prediction_run_id = "123" AND t.model_name = "model_1" THEN'
+    ) in script
+    # without new rows, the rows of a previous attempt are deleted from every partition
+    assert (
+        "IF run_partitions IS NULL THEN\n"
+        "          DELETE FROM `ds.predictions` as t\n"
+        '          WHERE t.prediction_run_id = "123" AND t.model_name = "model_1";\n'
+        "        ELSE"
+    ) in script
+    assert script.count("DELETE FROM") == 1
+
+    script = replace_run_rows_script("ds.model_evals", "SELECT 1 as x", {"training_run_id": "123"})
+    assert "DECLARE" not in script and "PARTITION BY" not in script
+    assert 'WHEN NOT MATCHED BY SOURCE AND t.training_run_id = "123" THEN' in script
+    assert "DELETE FROM" not in script
+
+
+
+def test_bigquery_ops(monkeypatch):
+    from unittest import mock
+
+    monkeypatch.setattr("common.bigquery_ops._clients", {})
+    with mock.patch("google.cloud.bigquery.Client") as client_cls:
+        assert get_client("project") is get_client("project")
+        assert client_cls.call_count == 1
+
+    client = mock.Mock()
+    ensure_table(client, "ds.state", columns=["client_id STRING"], cluster_by=["client_id"])
+    upsert_run_rows(client, "ds.model_evals", "SELECT 1 as x", {"training_run_id": "123"})
+    assert [name for name, *_ in client.method_calls] == ["query", "query"]
+    ddl = client.query.call_args_list[0].kwargs["query"]
+    assert "CREATE TABLE IF NOT EXISTS `ds.state`" in ddl and "(client_id STRING)" in ddl
+    assert "MERGE `ds.model_evals`" in client.query.call_args_list[1].kwargs["query"]
+
+
+def test_prediction_run_index_sql():
+    index = prediction_run_index_sql("ds.prediction_runs", "123", "model_1")
+    script = replace_run_rows_script(
+        "ds.predictions",
+        "SELECT * FROM ds.tmp",
+        {"prediction_run_id": "123"},
+        partition_by="date",
+        then=index,
+    )
+    # the index is written after the predictions, from the same run rows
+    assert script.index("MERGE `ds.predictions`") < script.index(index)
+    assert "CREATE TABLE IF NOT EXISTS `ds.prediction_runs`" in index
+    assert 'WHERE prediction_run_id = "123" AND model_name = "model_1"' in index
+    assert "FROM run_rows" in index
+
+
+def test_job_stats_scope():
+    from unittest import mock
+
+    client = offline_client(
+        job_id="job_1",
+        statement_type="SELECT",
+        total_bytes_billed=None,  # e.g. a cache hit
+        slot_millis=None,
+        cache_hit=True,
+    )
+    metrics = mock.Mock()
+
+    run_query(client, "SELECT 1")  # outside of a scope, not recorded
+    try:
+        with job_stats_scope(client, "project.ds", "op", "123", metrics) as stats:
+            run_query(client, "SELECT 1")
+            run_query(client, "SELECT 2")
+            raise RuntimeError("component failed")
+    except RuntimeError:
+        pass
+
+    # recorded and written also when the component fails
+    assert [r["job_id"] for r in stats.rows] == ["job_1", "job_1"]
+    assert stats.totals()["total_bytes_processed"] == 200
+    assert stats.totals()["total_bytes_billed"] == 0
+    assert stats.totals()["cache_hits"] == 2
+    metrics.log_metric.assert_any_call("jobs", 2)
+    rows, table_id = client.load_table_from_json.call_args.args
+    assert table_id == "project.ds.pipeline_job_stats"
+    assert {(r["run_id"], r["component"]) for r in rows} == {("123", "op")}
+
+
+def test_cost_guardrails(caplog):
+    client = offline_client(
+        job_id="job_1",
+        statement_type="SELECT",
+        total_bytes_processed=2 * 2**30,  # also the dry run estimate
+        total_bytes_billed=2 * 2**30,
+    )
+    cost_guardrails = schema_cost_guardrails.validate(
+        {"dry_run": True, "max_gb_billed": {"op": 1}}
+    )
+
+    # over budget, warns and runs without a byte ceiling, which BigQuery would enforce
+    with job_stats_scope(client, "project.ds", "op", "123", None, cost_guardrails) as stats:
+        run_query(client, "SELECT 1")
+    dry_run, real = client.query.call_args_list
+    assert dry_run.kwargs["job_config"].dry_run
+    assert "maximumBytesBilled" not in real.kwargs["job_config"].to_api_repr()["query"]
+    assert "over its budget" in caplog.text
+    assert stats.rows[0]["estimated_bytes"] == 2 * 2**30
+
+    # components without a budget only get the estimate
+    client.reset_mock()
+    with job_stats_scope(client, "project.ds", "other_op", "123", None, cost_guardrails):
+        run_query(client, "SELECT 1")
+    job_config = client.query.call_args.kwargs["job_config"]
+    assert "maximumBytesBilled" not in job_config.to_api_repr()["query"]
+
+    client.reset_mock()
+    cost_guardrails["on_exceeded"] = "fail"
+    try:
+        with job_stats_scope(client, "project.ds", "op", "123", None, cost_guardrails):
+            run_query(client, "SELECT 1")
+        assert False
+    except CostGuardrailExceeded:
+        pass
+    assert client.query.call_count == 1  # only the dry run
+
+    # within budget, the queries run with the byte ceiling
+    client.reset_mock()
+    cost_guardrails["max_gb_billed"]["op"] = 4
+    with job_stats_scope(client, "project.ds", "op", "123", None, cost_guardrails):
+        run_query(client, "SELECT 1")
+    job_config = client.query.call_args.kwargs["job_config"]
+    assert job_config.maximum_bytes_billed == 4 * 2**30
+
+
+def test_missing_bounds_sql():
+    from common.percentiles import missing_bounds_sql
+
+    sql = missing_bounds_sql("`p.d.model_percentile_map`", "`p.d.model_percentile_bounds`")
+    assert sql.strip().startswith(
+        "INSERT INTO `p.d.model_percentile_bounds` (training_run_id, model_name, bounds, percentiles)"
+    )
+    # only the maps without bounds, grouped into one row per map
+    assert "LEFT JOIN (\n        SELECT DISTINCT training_run_id, model_name FROM `p.d.model_percentile_bounds`" in sql
+    assert "WHERE b.model_name IS NULL" in sql
+    assert "GROUP BY training_run_id, model_name" in sql
+
@@ -5,6 +5,9 @@ bq_stored_procedure_path: sp_create_dataset.sqlx  # Path to the create_dataset p
 bq_sp_params:  # Custom create_dataset parameters
     lookback: 14
     lookahead: 7
+    session_cache: False  # True builds the dataset from the sessions_daily cache, see the readme
+    sessions_refresh_days: 3  # Recent days rebuilt in the sessions_daily cache on every run
+    label_engine: self_join  # self_join or window, how the template computes the label
 
 model:
     type: BQML  # BQML or CUSTOM
@@ -30,6 +33,16 @@ prediction:
     cron: TZ=America/Los_Angeles 0 11 * * *
     data_date_start_days_ago: 3  # How far back from today should we go to grab data for prediction
 
+cost_guardrails:  # BigQuery bytes budgets of the pipeline components
+    dry_run: False  # Estimate the bytes of each query with a dry run before running it
+    on_exceeded: warn  # warn or fail when the estimate is over the component's budget
+    max_gb_billed: {}  # Per component budget in GB, none by default, e.g.
+        # bq_call_create_dataset_op: 1000
+        # bqml_training_op: 1000
+        # bq_calc_percentile_map_op: 100
+        # bqml_predict_op: 100
+        # activation_ga4mp_op: 100
+
 activation:
     ga4mp:  # GA4 Measurement Protocol based activation
         query_path: sp_ga4mp_activation.sqlx  # Path to the activation query
@@ -37,4 +50,11 @@ activation:
         ga4_property_id: 318895463
         ga4_api_secret: ZdUboRUkQFicOlE6DVPzT3
         ga4_mp_debug: True  # Use the prod GA4 MP endpoint or debug
-        create_ga4_setup: False  # True means the conversion event and its params are created in GA4
\ No newline at end of file
+        create_ga4_setup: False  # True means the conversion event and its params are created in GA4
+        inprocess_max_rows: 10000  # Activations of up to this many rows are sent without a Beam pipeline
+        log_detail: full  # full, hash_only or failures_only, what is logged of successfully sent events
+        runner:  # how and with what resources activation_ga4mp_op sends the events
+            type: multi_processing  # inprocess, multi_threading, multi_processing or dataflow
+            num_workers: 0  # Local workers (0 = one per CPU) or Dataflow max workers (> 0)
+            cpu_limit: 2
+            memory_limit: 4G
\ No newline at end of file
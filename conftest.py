@@ -0,0 +1,11 @@
+import pytest
+
+from common.tests.bigquery_client import offline_client
+
+
+@pytest.fixture()
+def bq_client(mocker):
+    # offline client of every component, see common.tests.bigquery_client
+    client = offline_client()
+    mocker.patch("common.bigquery_ops.get_client", return_value=client)
+    return client
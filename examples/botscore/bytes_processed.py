@@ -0,0 +1,99 @@
+"""
+Bytes processed of the botscore create_dataset procedure, before and after the events
+temp table, from dry runs on the public GA4 sample dataset (free, read access only).
+
+    python examples/botscore/bytes_processed.py --project my-project --before d63bb51
+
+The procedure is dry run statement by statement, with its arguments and DECLAREs as
+literals, as a procedure or a script can't be dry run. Statements reading a temp table
+created earlier in the procedure can't be estimated either, they are listed with the
+temp table they read, which is billed at its size when the procedure runs.
+"""
+
+import argparse
+import os
+import re
+import subprocess
+
+import jinja2
+from google.cloud import bigquery
+
+TEMPLATE = "examples/botscore/sp_create_dataset.sqlx.tpl"
+TEMP_TABLE = re.compile(
+    r"CREATE OR REPLACE TEMP TABLE (\w+)\b.*?\bAS\b(.*)", re.DOTALL | re.IGNORECASE
+)
+
+
+def render(template, lookback, lookahead):
+    return (
+        jinja2.Environment(loader=jinja2.BaseLoader())
+        .from_string(template)
+        .render(
+            gcp_project_id="project",
+            bq_dataset_id="dataset",
+            bq_sp_params={"lookback": lookback, "lookahead": lookahead},
+        )
+    )
+
+
+def temp_table_queries(sql, variables):
+    """(temp table, query) of each CREATE TEMP TABLE of the procedure body"""
+    for name, value in variables.items():
+        sql = re.sub(rf"\b{name}\b", value, sql)
+    for statement in sql.split(";"):
+        m = TEMP_TABLE.search(statement)
+        if m:
+            yield m.group(1), m.group(2).strip()
+
+
+def dry_run(client, query):
+    job = client.query(
+        query,
+        job_config=bigquery.QueryJobConfig(dry_run=True, use_query_cache=False),
+    )
+    return job.total_bytes_processed
+
+
+def main(args):
+    root = os.path.join(os.path.dirname(__file__), "../../")
+    versions = {
+        "before": subprocess.check_output(
+            ["git", "show", f"{args.before}:{TEMPLATE}"], cwd=root, text=True
+        ),
+        "after": open(os.path.join(root, TEMPLATE)).read(),
+    }
+    variables = {
+        "date_start": f"DATE '{args.date_start}'",
+        "date_end": f"DATE '{args.date_end}'",
+        "LOOKBACK_DAYS": str(args.lookback),
+        "LOOKAHEAD_DAYS": str(args.lookahead),
+    }
+    client = bigquery.Client(project=args.project)
+
+    for version, template in versions.items():
+        sql = render(template, args.lookback, args.lookahead)
+        # the DECLAREs would turn into e.g. DECLARE 14 INT64 DEFAULT 14
+        sql = re.sub(r"DECLARE \w+ INT64 DEFAULT \d+;", "", sql)
+        temp_tables, total = set(), 0
+        print(version)
+        for name, query in temp_table_queries(sql, variables):
+            reads = sorted(t for t in temp_tables if re.search(rf"\bFROM {t}\b", query))
+            temp_tables.add(name)
+            if reads:
+                print(f"  {name}: reads temp table {', '.join(reads)}, not estimated")
+                continue
+            processed = dry_run(client, query)
+            total += processed
+            print(f"  {name}: {processed / 2**20:,.1f} MiB")
+        print(f"  total estimated: {total / 2**20:,.1f} MiB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--project", required=True, help="project billed for the dry runs")
+    parser.add_argument("--before", required=True, help="git revision of the old template")
+    parser.add_argument("--date_start", default="2020-12-01")
+    parser.add_argument("--date_end", default="2020-12-31")
+    parser.add_argument("--lookback", type=int, default=14)
+    parser.add_argument("--lookahead", type=int, default=7)
+    main(parser.parse_args())
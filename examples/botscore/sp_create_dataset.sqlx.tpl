@@ -9,6 +9,24 @@ BEGIN
   DECLARE LOOKBACK_DAYS INT64 DEFAULT {{ bq_sp_params.lookback }};
   DECLARE LOOKAHEAD_DAYS INT64 DEFAULT {{ bq_sp_params.lookahead }};
 
+  ----
+  -- Reads the events of the range once, with only the columns used below and the session_id
+  -- computed once per event, all the CTEs of the dataset read from it
+  ----
+  CREATE OR REPLACE TEMP TABLE events
+  CLUSTER BY user_pseudo_id
+  AS
+  SELECT
+    user_pseudo_id,
+    user_pseudo_id ||"/"||event_date||"/"|| (SELECT value.int_value FROM UNNEST(event_params) WHERE key = "ga_session_id") as session_id,
+    SAFE.PARSE_DATE('%Y%m%d', _TABLE_SUFFIX) as event_date,
+    event_name,
+    event_timestamp,
+    TIMESTAMP_MICROS(event_timestamp) as event_tstamp
+  FROM `bigquery-public-data.ga4_obfuscated_sample_ecommerce.events_*`
+  WHERE
+    SAFE.PARSE_DATE('%Y%m%d', _TABLE_SUFFIX) BETWEEN date_start - LOOKBACK_DAYS AND date_end + LOOKAHEAD_DAYS;
+
   CREATE OR REPLACE TEMP TABLE dataset AS (
       WITH
         visitor_pool AS (
@@ -28,13 +46,11 @@ BEGIN
             SELECT
               user_pseudo_id,
               event_name,
-              SAFE.PARSE_DATE('%Y%m%d', _TABLE_SUFFIX) as event_date,
-              TIMESTAMP_MICROS(event_timestamp) as event_tstamp,
-              MAX(TIMESTAMP_MICROS(event_timestamp)) OVER (PARTITION BY user_pseudo_id) as last_event_tstamp,
-            FROM
-              `bigquery-public-data.ga4_obfuscated_sample_ecommerce.events_*`
-            WHERE
-              SAFE.PARSE_DATE('%Y%m%d', _TABLE_SUFFIX) BETWEEN date_start - LOOKBACK_DAYS AND date_end
+              event_date,
+              event_tstamp,
+              MAX(event_tstamp) OVER (PARTITION BY user_pseudo_id) as last_event_tstamp,
+            FROM events
+            WHERE event_date <= date_end
           )
           GROUP BY user_pseudo_id
           HAVING
@@ -50,18 +66,16 @@ BEGIN
           FROM (
             SELECT
               user_pseudo_id,
-              event_name,
-              _TABLE_SUFFIX,
               event_timestamp,
-              COUNTIF(event_name = "page_view") OVER(PARTITION BY user_pseudo_id ||"/"||event_date||"/"|| (SELECT value.int_value FROM UNNEST(event_params) WHERE key = "ga_session_id")) as page_views,
-              LAG(event_timestamp) OVER(PARTITION BY user_pseudo_id ||"/"||event_date||"/"|| (SELECT value.int_value FROM UNNEST(event_params) WHERE key = "ga_session_id") ORDER BY event_timestamp) as prev_event_timestamp,
-              user_pseudo_id ||"/"||event_date||"/"|| (SELECT value.int_value FROM UNNEST(event_params) WHERE key = "ga_session_id") as session_id,
-            FROM `bigquery-public-data.ga4_obfuscated_sample_ecommerce.events_*` 
-            WHERE SAFE.PARSE_DATE('%Y%m%d', _TABLE_SUFFIX) BETWEEN date_start - LOOKBACK_DAYS AND date_end + LOOKAHEAD_DAYS
+              event_tstamp,
+              COUNTIF(event_name = "page_view") OVER(PARTITION BY session_id) as page_views,
+              LAG(event_timestamp) OVER(PARTITION BY session_id ORDER BY event_timestamp) as prev_event_timestamp,
+              session_id,
+            FROM events
           ) as ga
           INNER JOIN visitor_pool as vp
             ON vp.user_pseudo_id = ga.user_pseudo_id
-              AND TIMESTAMP_MICROS(ga.event_timestamp)
+              AND ga.event_tstamp
                 BETWEEN
                   TIMESTAMP_SUB(vp.last_event_tstamp, INTERVAL LOOKBACK_DAYS DAY)
                   AND
@@ -76,11 +90,11 @@ BEGIN
           SELECT
             ga.user_pseudo_id,
             session_id,
-            MIN(SAFE.PARSE_DATE('%Y%m%d', _TABLE_SUFFIX)) as date,
-            MIN(TIMESTAMP_MICROS(event_timestamp)) as session_start_tstamp,
-            MAX(TIMESTAMP_MICROS(event_timestamp)) as session_end_tstamp,
+            MIN(event_date) as date,
+            MIN(event_tstamp) as session_start_tstamp,
+            MAX(event_tstamp) as session_end_tstamp,
             
-            TIMESTAMP_DIFF(MAX(TIMESTAMP_MICROS(event_timestamp)), MIN(TIMESTAMP_MICROS(event_timestamp)), SECOND) as time_on_site,
+            TIMESTAMP_DIFF(MAX(event_tstamp), MIN(event_tstamp), SECOND) as time_on_site,
             COUNTIF(event_name = 'page_view') as pageviews,
             COUNTIF(event_name = 'view_item') as view_items,
             COUNTIF(event_name = 'view_promotion') as view_promotions,
@@ -88,19 +102,10 @@ BEGIN
             COUNTIF(event_name = 'add_to_cart') as add_to_carts,
             COUNTIF(event_name = 'begin_checkout') as begin_checkout,
             COUNTIF(event_name = 'purchase') as purchase
-          FROM (
-                SELECT
-                  user_pseudo_id,
-                  event_name,
-                  _TABLE_SUFFIX,
-                  event_timestamp,
-                  user_pseudo_id ||"/"||event_date||"/"|| (SELECT value.int_value FROM UNNEST(event_params) WHERE key = "ga_session_id") as session_id,
-                FROM `bigquery-public-data.ga4_obfuscated_sample_ecommerce.events_*` 
-                WHERE SAFE.PARSE_DATE('%Y%m%d', _TABLE_SUFFIX) BETWEEN date_start - LOOKBACK_DAYS AND date_end + LOOKAHEAD_DAYS
-          ) as ga
+          FROM events as ga
           INNER JOIN visitor_pool as vp
             ON vp.user_pseudo_id = ga.user_pseudo_id
-              AND TIMESTAMP_MICROS(ga.event_timestamp)
+              AND ga.event_tstamp
                 BETWEEN
                   TIMESTAMP_SUB(vp.last_event_tstamp, INTERVAL LOOKBACK_DAYS DAY)
                   AND
@@ -223,6 +228,7 @@ BEGIN
 
   END IF;
 
+  DROP TABLE events;
   DROP TABLE dataset;
 
 END;
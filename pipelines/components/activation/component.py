@@ -2,7 +2,7 @@ import os
 from typing import NamedTuple
 
 from pipelines import config, base_image
-from kfp.dsl import component, Output, Dataset
+from kfp.dsl import component, Output, Dataset, Metrics
 
 
 @component(base_image=base_image)
@@ -17,16 +17,41 @@ def validate_activation_config_op(
 @component(base_image=base_image)
 def activation_ga4mp_op(
     project: str,
+    region: str,
     dataset_id: str,
     run_id: str,
     cfg: dict,
     activation_log_table: Output[Dataset],
+    job_stats: Output[Metrics],
+    cost_guardrails: dict = None,
 ):
+    import datetime
     import logging
+    import time
     from google.cloud import bigquery
-    from google.cloud.exceptions import NotFound
-    from common.retry_policies import BIGQUERY_RETRY_POLICY
-    from activation.ga4mp.main import run as run_activation_flow
+    from google.cloud.exceptions import BadRequest, NotFound
+    from common.bigquery_ops import (
+        ensure_table,
+        get_client,
+        job_stats_scope,
+        run_query,
+    )
+    from common.percentiles import (
+        missing_bounds_sql,
+        percentile_bounds_query,
+        percentile_lookup,
+    )
+    from activation.ga4mp.main import (
+        RUN_STATS_TABLE_NAME,
+        RUN_STATS_TABLE_SCHEMA,
+        run as run_activation_flow,
+        run_stats_row,
+        runner_params,
+    )
+    from activation.ga4mp.inprocess import (
+        load_rows,
+        run as run_activation_inprocess,
+    )
 
     query, ga4_measurement_id, ga4_api_secret, ga4_mp_debug = (
         cfg["query"],
@@ -35,32 +60,163 @@ def activation_ga4mp_op(
         cfg["ga4_mp_debug"],
     )
 
-    client = bigquery.Client(project=project)
-    job_config = bigquery.QueryJobConfig(labels={"vai-mlops": f"activation"})
-    query_job = client.query(
-        query=f"""
-        CREATE OR REPLACE TABLE `{project}.{dataset_id}.tmp_activation_ga4mp_{run_id}`
-        OPTIONS(
-            expiration_timestamp=TIMESTAMP_ADD(CURRENT_TIMESTAMP(), INTERVAL 12 HOUR)
+    client = get_client(project)
+
+    with job_stats_scope(
+        client,
+        f"{project}.{dataset_id}",
+        "activation_ga4mp_op",
+        run_id,
+        job_stats,
+        cost_guardrails=cost_guardrails,
+    ):
+        labels = {"vai-mlops": f"activation"}
+        # the log and dead letter tables are partitioned by the timestamp of the run id
+        run_params = [
+            bigquery.ScalarQueryParameter("prediction_run_id", "STRING", run_id),
+            bigquery.ScalarQueryParameter(
+                "prediction_run_ts",
+                "TIMESTAMP",
+                datetime.datetime.strptime(run_id, "%Y%m%d%H%M"),
+            ),
+        ]
+
+        # dates of this run's predictions from the prediction_runs index, as a query
+        # parameter they prune the predictions to this run's partitions
+        run_dates = None
+        try:
+            run_dates = list(
+                run_query(
+                    client,
+                    f"""
+                    SELECT ARRAY_AGG(DISTINCT date IGNORE NULLS) as dates
+                    FROM `{project}.{dataset_id}.prediction_runs`
+                    WHERE prediction_run_id = @prediction_run_id
+                    """,
+                    labels,
+                    run_params,
+                )
+            )[0]["dates"]
+        except NotFound:
+            pass
+        if not run_dates:
+            today = datetime.datetime.now(datetime.timezone.utc).date()
+            run_dates = [today - datetime.timedelta(days=d) for d in range(8)]
+            logging.warning(
+                f"Prediction run {run_id} is not in `{project}.{dataset_id}.prediction_runs`, "
+                f"the activation query reads the predictions of the last 7 days"
+            )
+        query_params = [
+            *run_params,
+            bigquery.ArrayQueryParameter("prediction_dates", "DATE", run_dates),
+        ]
+
+        # models trained before the boundaries table existed only have the map, their
+        # bounds are added on every run as the query drops predictions without bounds
+        perc_map_table = f"`{project}.{dataset_id}.model_percentile_map`"
+        perc_bounds_table = f"`{project}.{dataset_id}.model_percentile_bounds`"
+        try:
+            ensure_table(
+                client,
+                f"{project}.{dataset_id}.model_percentile_bounds",
+                labels={"vai-mlops": "training"},
+                as_query=percentile_bounds_query(perc_map_table),
+            )
+            run_query(
+                client,
+                missing_bounds_sql(perc_map_table, perc_bounds_table),
+                {"vai-mlops": "training"},
+            )
+        except NotFound:
+            logging.warning(
+                f"No {perc_map_table} table, the bounds of models trained before "
+                f"{perc_bounds_table} existed can't be added"
+            )
+
+        # last percentile sent to GA4 by client_id, so the activation query only compares
+        # this run's predictions against it
+        state_table_id = f"{project}.{dataset_id}.activation_state"
+        try:
+            client.get_table(state_table_id)
+        except NotFound:
+            ensure_table(
+                client,
+                state_table_id,
+                columns=[
+                    "client_id STRING NOT NULL",
+                    "percentile INT64",
+                    "prediction_run_id STRING NOT NULL",
+                    "updated_ts TIMESTAMP NOT NULL",
+                ],
+                cluster_by=["client_id"],
+                labels=labels,
+            )
+            # seeded with the percentile of each client's latest session in the previous
+            # prediction runs, what the activation query compared against before the state
+            # table existed, so the first run doesn't send the whole audience again. The
+            # previous runs are read by date, as they may predate the prediction_runs index
+            try:
+                run_query(
+                    client,
+                    f"""
+                    INSERT INTO `{state_table_id}`
+                        (client_id, percentile, prediction_run_id, updated_ts)
+                    SELECT
+                        p.client_id,
+                        {percentile_lookup("p.proba", "b")} as percentile,
+                        p.prediction_run_id,
+                        CURRENT_TIMESTAMP()
+                    FROM (
+                        SELECT
+                            user_pseudo_id as client_id,
+                            prediction_run_id,
+                            model_name,
+                            session_end_tstamp,
+                            (SELECT plp.prob FROM UNNEST(predicted_label_probs) as plp WHERE plp.label = 1) as proba
+                        FROM `{project}.{dataset_id}.predictions`
+                        WHERE date >= CURRENT_DATE() - 7
+                            AND prediction_run_id != @prediction_run_id
+                    ) as p
+                    INNER JOIN (
+                        SELECT * FROM {perc_bounds_table}
+                        WHERE TRUE
+                        QUALIFY MAX(training_run_id) OVER (PARTITION BY model_name) = training_run_id
+                    ) as b USING (model_name)
+                    WHERE p.proba IS NOT NULL
+                    QUALIFY ROW_NUMBER() OVER (PARTITION BY p.client_id ORDER BY p.session_end_tstamp DESC) = 1
+                    """,
+                    labels,
+                    run_params,
+                )
+            except (BadRequest, NotFound) as e:
+                logging.warning(
+                    f"`{state_table_id}` could not be seeded from the previous predictions, "
+                    f"the first run sends every client: {e}"
+                )
+
+        run_query(
+            client,
+            f"""
+            CREATE OR REPLACE TABLE `{project}.{dataset_id}.tmp_activation_ga4mp_{run_id}`
+            OPTIONS(
+                expiration_timestamp=TIMESTAMP_ADD(CURRENT_TIMESTAMP(), INTERVAL 12 HOUR)
+            )
+            AS
+            {query}
+        """,
+            labels,
+            query_params,
         )
-        AS
-        {query}
-    """,
-        job_config=job_config,
-        job_retry=BIGQUERY_RETRY_POLICY,
-    )
-    query_job.result()
 
-    tbl = client.get_table(f"{project}.{dataset_id}.tmp_activation_ga4mp_{run_id}")
-    logging.info(f"Activation query produced {tbl.num_rows}!")
+        tbl = client.get_table(f"{project}.{dataset_id}.tmp_activation_ga4mp_{run_id}")
+        logging.info(f"Activation query produced {tbl.num_rows}!")
 
-    activation_log_table.metadata[
-        "table_id"
-    ] = f"`{project}.{dataset_id}.activation_ga4mp_log`"
+        activation_log_table.metadata[
+            "table_id"
+        ] = f"`{project}.{dataset_id}.activation_ga4mp_log`"
 
-    repo_name = dataset_id.replace("_", "-")
-    run_activation_flow(
-        {
+        repo_name = dataset_id.replace("_", "-")
+        params = {
             "project": project,
             "source_table": f"{project}.{dataset_id}.tmp_activation_ga4mp_{run_id}",
             "prediction_run_id": run_id,
@@ -69,36 +225,145 @@ def activation_ga4mp_op(
             "ga4_api_secret": ga4_api_secret,
             "log_db_dataset": dataset_id,
             "use_api_validation": 1 if ga4_mp_debug else None,
-            "direct": "direct",
-            "direct_running_mode": "multi_processing",
-            "direct_num_workers": 0,
+            "log_detail": cfg["log_detail"],
         }
-    )
+        started_ts = datetime.datetime.now(datetime.timezone.utc)
+        start = time.monotonic()
+        runner = cfg["runner"]
+        # small runs skip the Beam pipeline construction and worker start-up
+        if runner["type"] == "inprocess" or tbl.num_rows <= cfg["inprocess_max_rows"]:
+            logging.info("Running the activation in-process")
+            engine = "inprocess"
+            summary = run_activation_inprocess(params)
+        else:
+            logging.info(f"Running the activation with the {runner['type']} runner")
+            engine = runner["type"]
+            summary = run_activation_flow({**params, **runner_params(runner, region)})
 
-    client.query(
-        query=f"DROP TABLE `{project}.{dataset_id}.tmp_activation_ga4mp_{run_id}`",
-        job_config=job_config,
-        job_retry=BIGQUERY_RETRY_POLICY,
-    ).result()
-
-    # add labels to the log table
-    try:
-        tbl = client.get_table(f"{project}.{dataset_id}.activation_ga4mp_log")
-        if "vai-mlops" not in tbl.labels:
-            tbl.labels = {"vai-mlops": f"activation"}
-            client.update_table(tbl, ["labels"])
-    except NotFound:
-        logging.info(
-            "No activation log table was created. "
-            "Likely due to activation query returning no rows."
+        stats = run_stats_row(
+            run_id, engine, started_ts, time.monotonic() - start, summary
+        )
+        logging.info(f"Activation run stats: {stats}")
+        load_rows(
+            client,
+            [stats],
+            f"{project}.{dataset_id}.{RUN_STATS_TABLE_NAME}",
+            RUN_STATS_TABLE_SCHEMA,
+            ["prediction_run_id"],
         )
 
+        # keep the source rows around (until they expire) if some events failed to send,
+        # so the failed slice can be re-sent with activation.ga4mp.main --resume
+        failed = 0
+        try:
+            failed = list(
+                run_query(
+                    client,
+                    f"""
+                    SELECT COUNT(*) as failed
+                    FROM `{project}.{dataset_id}.activation_ga4mp_dead_letter`
+                    WHERE
+                        prediction_run_ts = @prediction_run_ts
+                        AND prediction_run_id = @prediction_run_id
+                    """,
+                    labels,
+                    run_params,
+                )
+            )[0]["failed"]
+        except NotFound:
+            pass
+
+        # record what was sent, clients whose events failed keep their previous state so
+        # the next run selects them again
+        if ga4_mp_debug:
+            # the validation endpoint answers 2xx without sending anything to GA4
+            logging.info(f"Debug run (ga4_mp_debug), `{state_table_id}` is not updated")
+        elif "up_percentile" in {f.name for f in tbl.schema}:
+            failed_clients = ""
+            if failed > 0:
+                failed_clients = f"""
+                WHERE client_id NOT IN (
+                    SELECT client_id
+                    FROM `{project}.{dataset_id}.activation_ga4mp_dead_letter`
+                    WHERE
+                        prediction_run_ts = @prediction_run_ts
+                        AND prediction_run_id = @prediction_run_id
+                )
+                """
+            run_query(
+                client,
+                f"""
+                MERGE `{state_table_id}` as s
+                USING (
+                    SELECT client_id, ANY_VALUE(up_percentile) as percentile
+                    FROM `{project}.{dataset_id}.tmp_activation_ga4mp_{run_id}`
+                    {failed_clients}
+                    GROUP BY client_id
+                ) as sent
+                ON s.client_id = sent.client_id
+                WHEN MATCHED THEN
+                    UPDATE SET
+                        percentile = sent.percentile,
+                        prediction_run_id = @prediction_run_id,
+                        updated_ts = CURRENT_TIMESTAMP()
+                WHEN NOT MATCHED THEN
+                    INSERT (client_id, percentile, prediction_run_id, updated_ts)
+                    VALUES (sent.client_id, sent.percentile, @prediction_run_id, CURRENT_TIMESTAMP())
+                """,
+                labels,
+                run_params,
+            )
+        else:
+            logging.info(
+                f"Activation query has no up_percentile column, `{state_table_id}` is not updated"
+            )
+
+        if failed > 0 and cfg["log_detail"] == "failures_only":
+            # no SEND_OK log entries to skip, a resume would send every event again
+            logging.warning(
+                f"{failed} events failed to send, see `{project}.{dataset_id}.activation_ga4mp_dead_letter`. "
+                f"They can't be re-sent with --resume as log_detail failures_only logs no sent events."
+            )
+        elif failed > 0:
+            logging.warning(
+                f"{failed} events failed to send, see `{project}.{dataset_id}.activation_ga4mp_dead_letter`. "
+                f"Re-send them with: python -m activation.ga4mp.main --resume=1 "
+                f"--project={project} --source_table={project}.{dataset_id}.tmp_activation_ga4mp_{run_id} "
+                f"--prediction_run_id={run_id} --log_db_dataset={dataset_id} --log_detail={cfg['log_detail']} "
+                f"--ga4_measurement_id=... --ga4_api_secret=... --temp_location=gs://{project}-{repo_name}-pipelines"
+            )
+        else:
+            run_query(
+                client,
+                f"DROP TABLE `{project}.{dataset_id}.tmp_activation_ga4mp_{run_id}`",
+                labels,
+            )
+
+        # add labels to the log table
+        try:
+            tbl = client.get_table(f"{project}.{dataset_id}.activation_ga4mp_log")
+            if "vai-mlops" not in tbl.labels:
+                tbl.labels = labels
+                client.update_table(tbl, ["labels"])
+        except NotFound:
+            logging.info(
+                "No activation log table was created. "
+                "Likely due to activation query returning no rows."
+            )
+
 
 @component(base_image=base_image)
-def activation_bq_routine_op(project: str, dataset_id: str, run_id: str, cfg: dict):
+def activation_bq_routine_op(
+    project: str,
+    dataset_id: str,
+    run_id: str,
+    cfg: dict,
+    job_stats: Output[Metrics],
+):
     from google.cloud import bigquery
+    from common.bigquery_ops import get_client, job_stats_scope, run_query
 
-    client = bigquery.Client(project=project)
+    client = get_client(project)
     bqr = client.get_routine(f"{cfg['dataset_id']}.{cfg['routine_id']}")
     params = cfg.get("params", {})
     params.update(
@@ -117,9 +382,12 @@ def activation_bq_routine_op(project: str, dataset_id: str, run_id: str, cfg: di
             )
         )
 
-    client.query(
-        query=f"CALL `{str(bqr.reference)}`({', '.join([f'@{a.name}' for a in args])});",
-        job_config=bigquery.QueryJobConfig(
-            query_parameters=args, labels={"vai-mlops": f"activation"}
-        ),
-    ).result()
+    with job_stats_scope(
+        client, f"{project}.{dataset_id}", "activation_bq_routine_op", run_id, job_stats
+    ):
+        run_query(
+            client,
+            f"CALL `{str(bqr.reference)}`({', '.join([f'@{a.name}' for a in args])});",
+            labels={"vai-mlops": f"activation"},
+            query_parameters=args,
+        )
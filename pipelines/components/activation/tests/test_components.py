@@ -1,7 +1,11 @@
+import datetime
+import types
+
 import pytest, yaml
 from pytest_mock import MockerFixture
 from jinja2 import Environment, BaseLoader
 
+from common.tests.bigquery_client import api_calls
 from pipelines.components.activation.component import *
 
 
@@ -55,4 +59,127 @@ def test_activation_bq_routine_op(config):
         dataset_id=config["bq_dataset_id"],
         run_id="202309172113",
         cfg=config["activation"]["bq_routine"],
+        job_stats=mock.Mock(spec=Metrics),
+    )
+
+
+def activation_cfg(debug=False):
+    return {
+        "query": "SELECT 1",
+        "ga4_measurement_id": "G-TEST",
+        "ga4_api_secret": "secret",
+        "ga4_mp_debug": debug,
+        "log_detail": "full",
+        "inprocess_max_rows": 10000,
+        "runner": {"type": "multi_processing", "num_workers": 0},
+    }
+
+
+@pytest.mark.parametrize("debug", [False, True])
+def test_activation_ga4mp_op_api_calls(bq_client, mocker, debug):
+    from activation.ga4mp.main import metrics_summary
+
+    # counts the BigQuery API calls of an in-process activation run
+    bq_client.query.return_value.result.return_value = [
+        {"failed": 0, "dates": [datetime.date(2023, 9, 17)]}
+    ]
+    bq_client.get_table.return_value.configure_mock(
+        num_rows=5, schema=[types.SimpleNamespace(name="up_percentile")], labels={}
     )
+    run = mocker.patch(
+        "activation.ga4mp.inprocess.run", return_value=metrics_summary({}, {})
+    )
+    job_stats = mocker.Mock(spec=Metrics)
+
+    activation_ga4mp_op.python_func(
+        project="project",
+        region="region",
+        dataset_id="dataset",
+        run_id="202309172113",
+        cfg=activation_cfg(debug),
+        activation_log_table=mocker.Mock(spec=Dataset, metadata={}),
+        job_stats=job_stats,
+    )
+    run.assert_called_once()
+
+    queries = [c.kwargs["query"] for c in bq_client.query.call_args_list]
+    # run dates, bounds table, missing bounds, the activation query, the dead letter
+    # count, the activation_state MERGE (not on debug runs), temp table drop
+    assert len(queries) == (6 if debug else 7)
+    assert any("MERGE" in q and "activation_state" in q for q in queries) != debug
+    # the dead letter reads are bounded to the run's partition
+    for call in bq_client.query.call_args_list:
+        if "activation_ga4mp_dead_letter" in call.kwargs["query"]:
+            assert "prediction_run_ts = @prediction_run_ts" in call.kwargs["query"]
+            assert {
+                p.name for p in call.kwargs["job_config"].query_parameters
+            } == {"prediction_run_id", "prediction_run_ts"}
+    # activation_state, source table and log table labels, the run stats and the job
+    # stats loads
+    # the activation query reads the run's dates of the prediction_runs index
+    (activation,) = [
+        c
+        for c in bq_client.query.call_args_list
+        if "CREATE OR REPLACE TABLE" in c.kwargs["query"]
+    ]
+    (dates,) = [
+        p
+        for p in activation.kwargs["job_config"].query_parameters
+        if p.name == "prediction_dates"
+    ]
+    assert dates.values == [datetime.date(2023, 9, 17)]
+    assert api_calls(bq_client) == {
+        "query": len(queries),
+        "get_table": 3,
+        "update_table": 1,
+        "load_table_from_json": 2,
+    }
+
+
+def test_activation_ga4mp_op_first_run(bq_client, mocker):
+    from google.cloud.exceptions import NotFound
+    from activation.ga4mp.main import metrics_summary
+
+    # a run missing from the prediction_runs index reads the last 7 days
+    bq_client.query.return_value.result.return_value = [{"failed": 0, "dates": None}]
+    table = mocker.Mock(
+        num_rows=5, schema=[types.SimpleNamespace(name="up_percentile")], labels={}
+    )
+
+    def get_table(table_id):
+        if table_id.endswith(".activation_state"):
+            raise NotFound(table_id)
+        return table
+
+    bq_client.get_table.side_effect = get_table
+    mocker.patch("activation.ga4mp.inprocess.run", return_value=metrics_summary({}, {}))
+
+    activation_ga4mp_op.python_func(
+        project="project",
+        region="region",
+        dataset_id="dataset",
+        run_id="202309172113",
+        cfg=activation_cfg(),
+        activation_log_table=mocker.Mock(spec=Dataset, metadata={}),
+        job_stats=mocker.Mock(spec=Metrics),
+    )
+
+    # the new state table is seeded from the previous runs before the activation query
+    queries = [c.kwargs["query"] for c in bq_client.query.call_args_list]
+    def position(text):
+        return next(i for i, q in enumerate(queries) if text in q)
+
+    create = position("CREATE TABLE IF NOT EXISTS `project.dataset.activation_state`")
+    seed = position("INSERT INTO `project.dataset.activation_state`")
+    activation = position("tmp_activation_ga4mp_")
+    assert create < seed < activation
+    assert "prediction_run_id != @prediction_run_id" in queries[seed]
+    assert "RANGE_BUCKET(p.proba, b.bounds)" in queries[seed]
+    (dates,) = [
+        p
+        for p in bq_client.query.call_args_list[activation].kwargs[
+            "job_config"
+        ].query_parameters
+        if p.name == "prediction_dates"
+    ]
+    assert len(dates.values) == 8
@@ -15,11 +15,13 @@ def bq_call_create_dataset_op(
     p_date_end: str,
     training_table: Output[Dataset],
     inference_table: Output[Dataset],
+    job_stats: Output[Metrics],
+    cost_guardrails: dict = None,
 ) -> None:
     from google.cloud import bigquery
-    from common.retry_policies import BIGQUERY_RETRY_POLICY
+    from common.bigquery_ops import get_client, job_stats_scope, run_query
 
-    client = bigquery.Client(project=project)
+    client = get_client(project)
 
     params = [
         bigquery.ScalarQueryParameter(
@@ -30,19 +32,22 @@ def bq_call_create_dataset_op(
         bigquery.ScalarQueryParameter("mode", "STRING", p_mode),
     ]
 
-    job_config = bigquery.QueryJobConfig(
-        query_parameters=params, labels={"vai-mlops": f"{p_mode.lower()}"}
-    )
-
-    query_job = client.query(
-        query=f"""
-        CALL `{project}.{dataset_id}.create_dataset`(@table_name, @date_start, @date_end, @mode);
-        """,
-        job_config=job_config,
-        job_retry=BIGQUERY_RETRY_POLICY,
-    )
-
-    query_job.result()
+    with job_stats_scope(
+        client,
+        f"{project}.{dataset_id}",
+        "bq_call_create_dataset_op",
+        run_id,
+        job_stats,
+        cost_guardrails=cost_guardrails,
+    ):
+        run_query(
+            client,
+            f"""
+            CALL `{project}.{dataset_id}.create_dataset`(@table_name, @date_start, @date_end, @mode);
+            """,
+            labels={"vai-mlops": f"{p_mode.lower()}"},
+            query_parameters=params,
+        )
 
     if p_mode == "TRAINING":
         training_table.metadata["table_id"] = (
@@ -63,16 +68,17 @@ def bqml_training_op(
     training_table: Input[Dataset],
     create_model_params: dict,
     model: Output[Model],
+    job_stats: Output[Metrics],
+    cost_guardrails: dict = None,
 ) -> None:
     from jinja2 import Environment, BaseLoader
-    from google.cloud import bigquery
-    from common.retry_policies import BIGQUERY_RETRY_POLICY
+    from common.bigquery_ops import get_client, job_stats_scope, run_query
 
     from google.api_core.future.polling import DEFAULT_POLLING
 
     DEFAULT_POLLING._timeout = 60 * 60 * 24 * 3
 
-    client = bigquery.Client(project=project)
+    client = get_client(project)
 
     model_name = f"model_{run_id}"
     mt_is_automl = "AUTOML" in create_model_params["model_type"].upper()
@@ -126,12 +132,15 @@ def bqml_training_op(
         }
     )
 
-    job_config = bigquery.QueryJobConfig(labels={"vai-mlops": f"training"})
-    query_job = client.query(
-        query=query, job_config=job_config, job_retry=BIGQUERY_RETRY_POLICY
-    )
-
-    r = query_job.result()
+    with job_stats_scope(
+        client,
+        f"{project}.{dataset_id}",
+        "bqml_training_op",
+        run_id,
+        job_stats,
+        cost_guardrails=cost_guardrails,
+    ):
+        run_query(client, query, labels={"vai-mlops": f"training"})
 
     # save the Vertex Model ID and Version as labels in BQ
     bq_model = client.get_model(f"{project}.{dataset_id}.{model_name}")
@@ -152,9 +161,9 @@ def bqml_training_op(
 
 @component(base_image=base_image)
 def bqml_list_models_op(project: str, dataset_id: str) -> List[dict]:
-    from google.cloud import bigquery
+    from common.bigquery_ops import get_client
 
-    client = bigquery.Client(project=project)
+    client = get_client(project)
 
     bqml_models = client.list_models(dataset_id)
 
@@ -179,62 +188,49 @@ def bqml_model_evaluate_op(
     model: dict,
     training_table: Input[Dataset],
     metrics: Output[Metrics],
+    job_stats: Output[Metrics],
 ):
-    from google.cloud import bigquery
-    from common.retry_policies import BIGQUERY_RETRY_POLICY
-    from google.cloud.exceptions import NotFound
+    from common.bigquery_ops import get_client, job_stats_scope, upsert_run_rows
 
     model_ = Model()
     model_.metadata.update(model)
     model = model_
 
-    client = bigquery.Client(project=project)
+    client = get_client(project)
     model_eval_table_id = f"{model.metadata['dataset_id']}.model_evals"
 
-    q_statement = None
-    try:
-        client.get_table(model_eval_table_id)
-        q_statement = f"""
-        DELETE FROM `{model_eval_table_id}` 
-        WHERE training_run_id = "{run_id}" AND model_name = "{model.metadata["model_name"]}";
-        
-        INSERT INTO `{model_eval_table_id}`
-        """
-    except NotFound:
-        q_statement = f"""
-        CREATE OR REPLACE TABLE `{model_eval_table_id}` 
-        OPTIONS( labels = [("vai-mlops", "training")] )
-        AS"""
-
-    query = f"""
-        {q_statement}
-        SELECT 
-            "{run_id}" as training_run_id, 
-            "{model.metadata["model_name"]}" as model_name,
-            * -- leave whatever the default output is
-        FROM ML.EVALUATE(
-            MODEL `{model.metadata["model_id"]}`,
-            (
-                SELECT * EXCEPT(data_split) FROM `{training_table.metadata['table_id']}`
-                WHERE data_split = 'TEST'
+    # the evaluation is written and read back in the same job
+    with job_stats_scope(
+        client,
+        f"{project}.{model.metadata['dataset_id']}",
+        "bqml_model_evaluate_op",
+        run_id,
+        job_stats,
+    ):
+        r = upsert_run_rows(
+            client,
+            model_eval_table_id,
+            f"""
+            SELECT 
+                "{run_id}" as training_run_id, 
+                "{model.metadata["model_name"]}" as model_name,
+                * -- leave whatever the default output is
+            FROM ML.EVALUATE(
+                MODEL `{model.metadata["model_id"]}`,
+                (
+                    SELECT * EXCEPT(data_split) FROM `{training_table.metadata['table_id']}`
+                    WHERE data_split = 'TEST'
+                )
             )
-        );
-        """
-
-    job_config = bigquery.QueryJobConfig(labels={"vai-mlops": f"training"})
-    client.query(
-        query=query, job_config=job_config, job_retry=BIGQUERY_RETRY_POLICY
-    ).result()
-
-    query_job = client.query(
-        query=f"""
-        SELECT * FROM `{model_eval_table_id}`
-        WHERE training_run_id = "{run_id}" AND model_name = "{model.metadata["model_name"]}"
-        """,
-        job_retry=BIGQUERY_RETRY_POLICY,
-    )
-
-    r = query_job.result()
+            """,
+            match={
+                "training_run_id": run_id,
+                "model_name": model.metadata["model_name"],
+            },
+            labels={"vai-mlops": "training"},
+            cluster_by=["training_run_id", "model_name"],
+            return_rows=True,
+        )
     r = list(r)
 
     for i in r:
@@ -246,14 +242,15 @@ def bqml_model_evaluate_op(
 def bqml_model_cleanup_op(
     project: str,
     dataset_id: str,
+    run_id: str,
     keep_n_best_models: Optional[int],
     eval_metrics: Optional[List[Metrics]],
     best_model: Output[Model],
     metrics: Output[Metrics],
+    job_stats: Output[Metrics],
 ):
     import logging
-    from google.cloud import bigquery
-    from common.retry_policies import BIGQUERY_RETRY_POLICY
+    from common.bigquery_ops import get_client, job_stats_scope, run_query
     from google.cloud import aiplatform
 
     def _metric_min_max(m):
@@ -267,7 +264,7 @@ def bqml_model_cleanup_op(
         if m in ("roc_auc", "f1_score", "recall", "precision"):
             return "DESC"
 
-    client = bigquery.Client(project=project)
+    client = get_client(project)
 
     model_latest = sorted(
         list(client.list_models(dataset_id)),
@@ -325,12 +322,10 @@ def bqml_model_cleanup_op(
         ORDER BY {eval_metric} {_metric_min_max(eval_metric)}
     """
 
-    job_config = bigquery.QueryJobConfig(labels={"vai-mlops": f"training"})
-    query_job = client.query(
-        query=query, job_config=job_config, job_retry=BIGQUERY_RETRY_POLICY
-    )
-    r = query_job.result()
-    r = list(r)
+    with job_stats_scope(
+        client, f"{project}.{dataset_id}", "bqml_model_cleanup_op", run_id, job_stats
+    ):
+        r = list(run_query(client, query, labels={"vai-mlops": f"training"}))
 
     best_model.metadata = {
         "project_id": project,
@@ -373,12 +368,17 @@ def bq_calc_percentile_map_op(
     training_table: Input[Dataset],
     model: Input[Model],
     percentile_map_table: Output[Dataset],
+    job_stats: Output[Metrics],
+    cost_guardrails: dict = None,
 ):
-    from google.cloud import bigquery
-    from common.retry_policies import BIGQUERY_RETRY_POLICY
-    from google.cloud.exceptions import NotFound
+    from common.bigquery_ops import get_client, job_stats_scope, upsert_run_rows
+    from common.percentiles import (
+        percentile_buckets_query,
+        percentile_bounds_query,
+        percentile_lookup,
+    )
 
-    client = bigquery.Client(project=project)
+    client = get_client(project)
 
     bq_model = client.get_model(model.metadata["model_id"])
     if "REGRESSOR" in bq_model.model_type.upper():
@@ -391,24 +391,9 @@ def bq_calc_percentile_map_op(
         return
 
     perc_map_table_id = f"{dataset_id}.model_percentile_map"
+    perc_bounds_table_id = f"{dataset_id}.model_percentile_bounds"
 
-    q_statement = None
-    try:
-        client.get_table(perc_map_table_id)
-        q_statement = f"""
-        DELETE FROM `{perc_map_table_id}` 
-        WHERE training_run_id = "{run_id}" AND model_name = "{model.metadata["model_name"]}";
-
-        INSERT INTO `{perc_map_table_id}`
-        """
-    except NotFound:
-        q_statement = f"""
-        CREATE OR REPLACE TABLE `{perc_map_table_id}` 
-        OPTIONS( labels = [("vai-mlops", "training")] ) 
-        AS"""
-
-    query = f"""
-    {q_statement}
+    run_map_query = f"""
     WITH 
       predictions AS (
         SELECT 
@@ -426,53 +411,57 @@ def bq_calc_percentile_map_op(
           )
         )
       ),
-    
-      ptiles AS (
-         SELECT 
-          APPROX_QUANTILES(p , 99) as tile
-        FROM predictions
-      )
-    
+
+      buckets AS ({percentile_buckets_query("predictions", run_id, model.metadata["model_name"])}),
+
+      bounds AS ({percentile_bounds_query("buckets")})
+
     SELECT
       training_run_id, model_name,
       percentile, lower_bnd, upper_bnd,
       IFNULL(SUM(label) / COUNT(*), 0) as conv_rate,
       COUNT(*) / SUM(COUNT(*)) OVER() as size_share,
       SUM(SUM(label)) OVER () / SUM(COUNT(*)) OVER() as conv_rate_base
-        
-    FROM (
+
+    FROM buckets as b
+    LEFT JOIN (
       SELECT
-        "{run_id}" as training_run_id, 
-        "{model.metadata['model_name']}" as model_name,
-        *
-      FROM (
-        SELECT
-          q - 1 as percentile,
-          IF(prev_lower_bnd IS NULL, CAST('-inf' as FLOAT64), lower_bnd) as lower_bnd,
-          IF(upper_bnd IS NULL, CAST('inf' as FLOAT64), upper_bnd) as upper_bnd
-        FROM (
-          SELECT
-            ROW_NUMBER() OVER (ORDER BY tile) as q,
-            LAG(tile) OVER (ORDER BY tile) as prev_lower_bnd,
-            tile as lower_bnd,
-            LEAD(tile) OVER (ORDER BY tile) as upper_bnd,
-            
-    
-          FROM ptiles, UNNEST(tile) as tile
-        )
-      )
-      WHERE lower_bnd != upper_bnd
-    ) as b
-    LEFT JOIN predictions as p
-      ON p.p >= b.lower_bnd AND p.p < b.upper_bnd
+        {percentile_lookup("p.p", "bounds")} as percentile,
+        p.label
+      FROM predictions as p, bounds
+    ) as p USING (percentile)
     GROUP BY 1,2,3,4,5
     """
-
-    job_config = bigquery.QueryJobConfig(labels={"vai-mlops": f"training"})
-    query_job = client.query(
-        query=query, job_config=job_config, job_retry=BIGQUERY_RETRY_POLICY
+    run_match = {"training_run_id": run_id, "model_name": model.metadata["model_name"]}
+    run_table_options = dict(
+        cluster_by=["training_run_id", "model_name"],
+        labels={"vai-mlops": "training"},
     )
-    query_job.result()
+
+    with job_stats_scope(
+        client,
+        f"{project}.{dataset_id}",
+        "bq_calc_percentile_map_op",
+        run_id,
+        job_stats,
+        cost_guardrails=cost_guardrails,
+    ):
+        upsert_run_rows(
+            client, perc_map_table_id, run_map_query, run_match, **run_table_options
+        )
+
+        # the same map as sorted boundaries, for RANGE_BUCKET lookups
+        run_map = f"""(
+          SELECT * FROM `{perc_map_table_id}`
+          WHERE training_run_id = "{run_id}" AND model_name = "{model.metadata["model_name"]}"
+        )"""
+        upsert_run_rows(
+            client,
+            perc_bounds_table_id,
+            percentile_bounds_query(run_map),
+            run_match,
+            **run_table_options,
+        )
 
     percentile_map_table.metadata["table_id"] = perc_map_table_id
 
@@ -485,51 +474,55 @@ def bqml_predict_op(
     inference_table: Input[Dataset],
     model: Input[Model],
     predictions_table: Output[Dataset],
+    job_stats: Output[Metrics],
+    cost_guardrails: dict = None,
 ):
-    from google.cloud import bigquery
-    from common.retry_policies import BIGQUERY_RETRY_POLICY
-    from google.cloud.exceptions import NotFound
+    from common.bigquery_ops import (
+        get_client,
+        job_stats_scope,
+        prediction_run_index_sql,
+        upsert_run_rows,
+    )
 
-    client = bigquery.Client(project=project)
+    client = get_client(project)
 
     predictions_table_id = f"{project}.{dataset_id}.predictions"
 
-    q_statement = None
-    try:
-        client.get_table(predictions_table_id)
-        q_statement = f"""
-        DELETE FROM `{predictions_table_id}` 
-        WHERE prediction_run_id = "{run_id}" AND model_name = "{model.metadata["model_name"]}";
-
-        INSERT INTO `{predictions_table_id}`
-        """
-    except NotFound:
-        q_statement = f"""
-        CREATE OR REPLACE TABLE `{predictions_table_id}` 
-        PARTITION BY date
-        CLUSTER BY prediction_run_id
-        OPTIONS( labels = [("vai-mlops", "inference")] )
-        AS"""
-
-    query = f"""
-        CREATE OR REPLACE TEMP TABLE temp_predictions AS
-        SELECT
-          "{run_id}" as prediction_run_id,
-          "{model.metadata["model_name"]}" as model_name,
-          * EXCEPT(predicted_label) 
-        FROM ML.PREDICT(
-          MODEL `{model.metadata['model_id']}`, 
-          TABLE `{inference_table.metadata['table_id']}`
-        );
-    
-        {q_statement}
-        SELECT * FROM temp_predictions;
-    """
-
-    job_config = bigquery.QueryJobConfig(labels={"vai-mlops": f"inference"})
-    query_job = client.query(
-        query=query, job_config=job_config, job_retry=BIGQUERY_RETRY_POLICY
-    )
-    query_job.result()
+    # re-runs only replace this run's rows in the partitions of its predictions
+    with job_stats_scope(
+        client,
+        f"{project}.{dataset_id}",
+        "bqml_predict_op",
+        run_id,
+        job_stats,
+        cost_guardrails=cost_guardrails,
+    ):
+        upsert_run_rows(
+            client,
+            predictions_table_id,
+            f"""
+            SELECT
+              "{run_id}" as prediction_run_id,
+              "{model.metadata["model_name"]}" as model_name,
+              * EXCEPT(predicted_label) 
+            FROM ML.PREDICT(
+              MODEL `{model.metadata['model_id']}`, 
+              TABLE `{inference_table.metadata['table_id']}`
+            )
+            """,
+            match={
+                "prediction_run_id": run_id,
+                "model_name": model.metadata["model_name"],
+            },
+            labels={"vai-mlops": "inference"},
+            partition_by="date",
+            cluster_by=["prediction_run_id"],
+            then=prediction_run_index_sql(
+                f"{project}.{dataset_id}.prediction_runs",
+                run_id,
+                model.metadata["model_name"],
+                labels={"vai-mlops": "inference"},
+            ),
+        )
 
     predictions_table.metadata["table_id"] = predictions_table_id
@@ -2,6 +2,7 @@ import pytest, yaml
 from kfp.dsl import Artifact
 from pytest_mock import MockerFixture
 
+from common.tests.bigquery_client import api_calls
 from pipelines.components.bigquery.component import *
 
 
@@ -38,6 +39,7 @@ def test_bq_call_create_dataset_op(config):
         p_date_end="2022-01-01",
         training_table=destination_table,
         inference_table=destination_table,
+        job_stats=mock.Mock(spec=Metrics),
     )
 
 
@@ -55,6 +57,7 @@ def test_bqml_training_op(config):
         training_table=training_table,
         create_model_params=config["model"]["create_model_params"],
         model=model,
+        job_stats=mock.Mock(spec=Metrics),
     )
 
 
@@ -89,6 +92,7 @@ def test_bqml_model_evaluate_op(config):
         model=model,
         training_table=training_table,
         metrics=metrics,
+        job_stats=mock.Mock(spec=Metrics),
     )
 
 
@@ -100,9 +104,11 @@ def test_bqml_model_cleanup_op(config):
     bqml_model_cleanup_op.python_func(
         project=config["gcp_project_id"],
         dataset_id=config["bq_dataset_id"],
+        run_id="123",
         keep_n_best_models=None,
         best_model=model,
         metrics=metrics,
+        job_stats=mock.Mock(spec=Metrics),
     )
 
 
@@ -128,9 +134,152 @@ def test_bq_calc_percentile_map_op(config):
         model=model,
         training_table=training_table,
         percentile_map_table=percentile_map_table,
+        job_stats=mock.Mock(spec=Metrics),
     )
 
 
+def test_percentile_bounds_parity(config):
+    from google.cloud import bigquery
+    from common.percentiles import (
+        percentile_buckets_query,
+        percentile_bounds_query,
+        percentile_lookup,
+    )
+
+    # the lookup of the activation template is the one of bq_calc_percentile_map_op
+    with open(
+        os.path.join(os.path.dirname(__file__), "../../../../sp_ga4mp_activation.sqlx.tpl")
+    ) as fh:
+        assert percentile_lookup("p.proba", "p_bounds") in fh.read()
+
+    # skewed and rounded probabilities give duplicate tiles, i.e. dropped buckets, and
+    # points on the bucket boundaries. The buckets, bounds and lookup are built with the
+    # helpers of bq_calc_percentile_map_op, the range join is the lookup they replaced
+    query = f"""
+    WITH
+      predictions AS (
+        SELECT id, ROUND(POW(RAND(), 3), 2) as p
+        FROM UNNEST(GENERATE_ARRAY(1, 100000)) as id
+      ),
+
+      buckets AS ({percentile_buckets_query("predictions", "123", "model_123")}),
+
+      bounds AS ({percentile_bounds_query("buckets")}),
+
+      by_range AS (
+        SELECT p.id, b.percentile
+        FROM predictions as p
+        LEFT JOIN buckets as b
+          ON p.p >= b.lower_bnd AND p.p < b.upper_bnd
+      ),
+
+      by_bucket AS (
+        SELECT p.id, {percentile_lookup("p.p", "bounds")} as percentile
+        FROM predictions as p, bounds
+      )
+
+    SELECT
+      COUNT(*) as n,
+      COUNT(DISTINCT r.percentile) as n_percentiles,
+      COUNTIF(r.percentile IS DISTINCT FROM b.percentile) as mismatches
+    FROM by_range as r
+    INNER JOIN by_bucket as b USING (id)
+    """
+
+    client = bigquery.Client(project=config["gcp_project_id"])
+    (row,) = list(client.query(query=query).result())
+    assert row["n"] == 100000
+    assert row["n_percentiles"] < 100  # some buckets were dropped
+    assert row["mismatches"] == 0
+
+
+def label_engine_conv(config, label_engine):
+    from jinja2 import BaseLoader, Environment
+
+    # the conv CTE of the create_dataset template, rendered with the label engine
+    with open(
+        os.path.join(
+            os.path.dirname(__file__), "../../../../sp_create_dataset.sqlx.tpl"
+        )
+    ) as fh:
+        tpl = Environment(loader=BaseLoader).from_string(fh.read())
+    sql = tpl.render(
+        {
+            **config,
+            "bq_sp_params": {**config["bq_sp_params"], "label_engine": label_engine},
+        }
+    )
+    conv = sql[sql.index("      conv AS (") :]
+    return conv[: conv.index("\n      )\n") + len("\n      )")]
+
+
+def test_label_engine_parity(config):
+    import logging
+    from google.cloud import bigquery
+
+    # heavy visitors (500 sessions each) with zero length sessions, i.e. a session start equal
+    # to its end, and starts on whole minutes, i.e. ties between sessions
+    query = f"""
+    DECLARE LOOKAHEAD_DAYS INT64 DEFAULT 7;
+
+    CREATE TEMP TABLE base_sessions AS
+    SELECT
+      CAST(MOD(n, 200) as STRING) as user_pseudo_id,
+      CAST(n as STRING) as session_id,
+      session_start_tstamp,
+      TIMESTAMP_ADD(
+        session_start_tstamp,
+        INTERVAL IF(MOD(h, 5) = 0, 0, MOD(h, 7200)) SECOND
+      ) as session_end_tstamp,
+      IF(MOD(h, 97) < 5, 1, 0) as purchase
+    FROM (
+      SELECT
+        n,
+        ABS(FARM_FINGERPRINT(CAST(n as STRING))) as h,
+        TIMESTAMP_ADD(
+          TIMESTAMP "2021-01-01",
+          INTERVAL MOD(ABS(FARM_FINGERPRINT(CAST(-n as STRING))), 60 * 24 * 90) MINUTE
+        ) as session_start_tstamp
+      FROM UNNEST(GENERATE_ARRAY(1, 100000)) as n
+    );
+
+    CREATE TEMP TABLE labels_self_join AS
+    WITH
+{label_engine_conv(config, "self_join")}
+    SELECT * FROM conv;
+
+    CREATE TEMP TABLE labels_window AS
+    WITH
+{label_engine_conv(config, "window")}
+    SELECT * FROM conv;
+
+    SELECT
+      COUNT(*) as n,
+      COUNTIF(s.label = 1) as positives,
+      COUNTIF(s.label IS DISTINCT FROM w.label) as mismatches,
+      COUNTIF(s.conv_session_start_tstamp IS DISTINCT FROM w.conv_session_start_tstamp) as conv_mismatches
+    FROM labels_self_join as s
+    FULL OUTER JOIN labels_window as w USING (session_id);
+    """
+
+    client = bigquery.Client(project=config["gcp_project_id"])
+    job = client.query(query=query)
+    (row,) = list(job.result())
+    assert row["n"] == 100000
+    assert row["positives"] > 0
+    assert row["mismatches"] == 0
+    assert row["conv_mismatches"] == 0
+
+    # slot time of the two label computations, i.e. of the script's child jobs creating them
+    slot_ms = {}
+    for child in client.list_jobs(parent_job=job):
+        for engine in ("self_join", "window"):
+            if f"CREATE TEMP TABLE labels_{engine} AS" in child.query:
+                slot_ms[engine] = child.slot_millis
+    # reported only, slot time on shared slots is too noisy to assert on
+    logging.info(f"Label engine slot ms: {slot_ms}")
+
+
 def test_bqml_predict_op(config):
     mock = mock = MockerFixture(config=None)
     model = mock.Mock(
@@ -153,4 +302,114 @@ def test_bqml_predict_op(config):
         inference_table=inference_table,
         model=model,
         predictions_table=predictions_table,
+        job_stats=mock.Mock(spec=Metrics),
+    )
+
+
+def test_api_calls(bq_client, mocker):
+    from common.percentiles import percentile_buckets_query, percentile_lookup
+
+    model = mocker.Mock(
+        spec=Model,
+        metadata={
+            "model_name": "model_123",
+            "dataset_id": "dataset",
+            "model_id": "project.dataset.model_123",
+        },
+    )
+    training_table = mocker.Mock(spec=Dataset, metadata={"table_id": "dataset.t"})
+    inference_table = mocker.Mock(spec=Dataset, metadata={"table_id": "dataset.i"})
+    job_stats = mocker.Mock(spec=Metrics)
+
+    bq_call_create_dataset_op.python_func(
+        project="project",
+        run_id="123",
+        dataset_id="dataset",
+        p_mode="TRAINING",
+        p_date_start="2021-01-01",
+        p_date_end="2022-01-01",
+        training_table=training_table,
+        inference_table=inference_table,
+        job_stats=job_stats,
+    )
+    assert api_calls(bq_client) == {"query": 1, "load_table_from_json": 1}
+
+    bq_client.reset_mock()
+    bq_client.get_model.return_value.training_runs = [{"vertexAiModelVersion": "1"}]
+    bqml_training_op.python_func(
+        project="project",
+        run_id="123",
+        dataset_id="dataset",
+        training_table=training_table,
+        create_model_params={"model_type": "BOOSTED_TREE_CLASSIFIER"},
+        model=mocker.Mock(spec=Model),
+        job_stats=job_stats,
+    )
+    assert api_calls(bq_client) == {
+        "query": 1,
+        "get_model": 1,
+        "update_model": 1,
+        "load_table_from_json": 1,
+    }
+
+    # the evaluation is written and read back by the same job
+    bq_client.reset_mock()
+    bq_client.query.return_value.result.return_value = [{"roc_auc": 0.9}]
+    metrics = mocker.Mock(spec=Metrics)
+    bqml_model_evaluate_op.python_func(
+        project="project",
+        run_id="123",
+        model=model.metadata,
+        training_table=training_table,
+        metrics=metrics,
+        job_stats=job_stats,
+    )
+    assert api_calls(bq_client) == {"query": 1, "load_table_from_json": 1}
+    metrics.log_metric.assert_called_once_with("roc_auc", 0.9)
+
+    bq_client.reset_mock()
+    bq_client.get_model.return_value.model_type = "BOOSTED_TREE_CLASSIFIER"
+    bq_calc_percentile_map_op.python_func(
+        project="project",
+        dataset_id="dataset",
+        run_id="123",
+        model=model,
+        training_table=training_table,
+        percentile_map_table=mocker.Mock(spec=Dataset, metadata={}),
+        job_stats=job_stats,
+    )
+    assert api_calls(bq_client) == {
+        "get_model": 1,
+        "query": 2,
+        "load_table_from_json": 1,
+    }
+    # the map is computed with the helpers of test_percentile_bounds_parity
+    query = bq_client.query.call_args_list[0].kwargs["query"]
+    assert percentile_buckets_query("predictions", "123", model.metadata["model_name"]) in query
+    assert percentile_lookup("p.p", "bounds") in query
+
+    bq_client.reset_mock()
+    bqml_predict_op.python_func(
+        project="project",
+        dataset_id="dataset",
+        run_id="123",
+        inference_table=inference_table,
+        model=model,
+        predictions_table=mocker.Mock(spec=Dataset, metadata={}),
+        job_stats=job_stats,
+    )
+    assert api_calls(bq_client) == {"query": 1, "load_table_from_json": 1}
+    query = bq_client.query.call_args.kwargs["query"]
+    assert "CREATE TABLE IF NOT EXISTS `project.dataset.predictions`" in query
+    assert "t.date IN UNNEST(run_partitions)" in query
+    assert "INSERT INTO `project.dataset.prediction_runs`" in query
+
+    # the job stats of the run, tagged with the component
+    rows = bq_client.load_table_from_json.call_args.args[0]
+    assert [(r["run_id"], r["component"]) for r in rows] == [("123", "bqml_predict_op")]
+    assert rows[0]["total_bytes_billed"] == 10 * 2**20
+    assert (
+        bq_client.load_table_from_json.call_args.args[1]
+        == "project.dataset.pipeline_job_stats"
     )
+    job_stats.log_metric.assert_any_call("total_bytes_billed", 10 * 2**20)
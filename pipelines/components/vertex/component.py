@@ -35,9 +35,9 @@ def vai_get_default_model_op(
 
     if model_type == ModelSourceInfo.ModelSourceType.BQML:
         # the api doesn't yet expose bigQueryModelReference parameter it just tells you the model is BQML
-        from google.cloud import bigquery
+        from common.bigquery_ops import get_client
 
-        client = bigquery.Client(project=project)
+        client = get_client(project)
         bq_model = None
         for m in client.list_models(dataset_id):
             bqm = client.get_model(f"{project}.{dataset_id}.{m.model_id}")
@@ -98,6 +98,7 @@ def vai_model_evaluate_op(
     training_table: Input[Dataset],
     custom_training_params: dict,
     metrics: Output[Metrics],
+    job_stats: Output[Metrics],
 ):
     import json
     from io import BytesIO
@@ -151,44 +152,31 @@ def vai_model_evaluate_op(
         metrics.log_metric(k, v)
 
     # push evaluation to BigQuery
-    from google.cloud import bigquery
-    from common.retry_policies import BIGQUERY_RETRY_POLICY
-    from google.cloud.exceptions import NotFound
+    from common.bigquery_ops import get_client, job_stats_scope, upsert_run_rows
 
-    client = bigquery.Client(project=project)
+    client = get_client(project)
     model_eval_table_id = f"{dataset_id}.model_evals"
 
-    q_statement = None
-    try:
-        client.get_table(model_eval_table_id)
-        q_statement = f"""
-            DELETE FROM `{model_eval_table_id}` 
-            WHERE training_run_id = "{run_id}" AND model_name = "{model["model_id"]}";
-
-            INSERT INTO `{model_eval_table_id}`
-            """
-    except NotFound:
-        q_statement = f"""
-            CREATE OR REPLACE TABLE `{model_eval_table_id}` 
-            OPTIONS( labels = [("vai-mlops", "training")] )
-            AS"""
-
-    query = f"""
-    {q_statement}
-    SELECT
-        '{run_id}' as training_run_id,
-        '{model["model_id"]}' as model_name,
-        '{emn}' as eval_metric_name,
-        {eval_res[emn]} as eval_metric_value,
-        [
-            {", ".join([f"STRUCT('{k}' as name, {v} as value)" for k, v in eval_res.items()])}
-        ] as metrics
-    """
-
-    job_config = bigquery.QueryJobConfig(labels={"vai-mlops": f"training"})
-    client.query(
-        query=query, job_config=job_config, job_retry=BIGQUERY_RETRY_POLICY
-    ).result()
+    with job_stats_scope(
+        client, f"{project}.{dataset_id}", "vai_model_evaluate_op", run_id, job_stats
+    ):
+        upsert_run_rows(
+            client,
+            model_eval_table_id,
+            f"""
+            SELECT
+                '{run_id}' as training_run_id,
+                '{model["model_id"]}' as model_name,
+                '{emn}' as eval_metric_name,
+                {eval_res[emn]} as eval_metric_value,
+                [
+                    {", ".join([f"STRUCT('{k}' as name, {v} as value)" for k, v in eval_res.items()])}
+                ] as metrics
+            """,
+            match={"training_run_id": run_id, "model_name": model["model_id"]},
+            labels={"vai-mlops": "training"},
+            cluster_by=["training_run_id", "model_name"],
+        )
 
 
 @component(base_image=base_image)
@@ -261,6 +249,7 @@ def vai_batch_prediction_op(
     run_id: str,
     inference_table: Input[Dataset],
     predictions_table: Output[Dataset],
+    job_stats: Output[Metrics],
     model: Input[Model],
     job_name_prefix: str = "vai-mlops",
     machine_type: str = "n1-standard-4",
@@ -273,12 +262,15 @@ def vai_batch_prediction_op(
 ):
     import logging
     from datetime import datetime, timedelta, timezone
-    from google.cloud import bigquery
-    from common.retry_policies import BIGQUERY_RETRY_POLICY
-    from google.cloud.exceptions import NotFound
+    from common.bigquery_ops import (
+        get_client,
+        job_stats_scope,
+        prediction_run_index_sql,
+        upsert_run_rows,
+    )
     from google.cloud.aiplatform import Model
 
-    client = bigquery.Client(project=project)
+    client = get_client(project)
 
     # run batch predictions
     vai_model = Model(f"{model.metadata['model_id']}")
@@ -317,34 +309,35 @@ def vai_batch_prediction_op(
 
     logging.info(batch_prediction_job.to_dict())
 
-    # merge temp predictions table into main predictions table
-    q_statement = None
-    try:
-        client.get_table(predictions_table_id)
-        q_statement = f"""
-            DELETE FROM `{predictions_table_id}` 
-            WHERE prediction_run_id = "{run_id}" AND model_name = "{model.metadata["model_id"]}";
-
-            INSERT INTO `{predictions_table_id}`
-            """
-    except NotFound:
-        q_statement = f"""
-            CREATE OR REPLACE TABLE `{predictions_table_id}` 
-            PARTITION BY date
-            CLUSTER BY prediction_run_id
-            AS"""
-
-    query = f"""
-            {q_statement}
+    # merge temp predictions table into main predictions table, re-runs only replace
+    # this run's rows in the partitions of its predictions
+    with job_stats_scope(
+        client, f"{project}.{dataset_id}", "vai_batch_prediction_op", run_id, job_stats
+    ):
+        upsert_run_rows(
+            client,
+            predictions_table_id,
+            f"""
             SELECT 
                 "{run_id}" as prediction_run_id,
                 "{model.metadata["model_id"]}" as model_name,
                 * 
-            FROM `{tmp_dst_prediction_table_id}`;
-        """
-
-    query_job = client.query(query=query, job_retry=BIGQUERY_RETRY_POLICY)
-    query_job.result()
+            FROM `{tmp_dst_prediction_table_id}`
+            """,
+            match={
+                "prediction_run_id": run_id,
+                "model_name": model.metadata["model_id"],
+            },
+            labels={"vai-mlops": "inference"},
+            partition_by="date",
+            cluster_by=["prediction_run_id"],
+            then=prediction_run_index_sql(
+                f"{project}.{dataset_id}.prediction_runs",
+                run_id,
+                model.metadata["model_id"],
+                labels={"vai-mlops": "inference"},
+            ),
+        )
 
     predictions_table.metadata["table_id"] = predictions_table_id
 
@@ -353,17 +346,18 @@ def vai_batch_prediction_op(
 def vai_model_cleanup_op(
     project: str,
     dataset_id: str,
+    run_id: str,
     keep_n_best_models: Optional[int],
     eval_metrics: Optional[List[Metrics]],
     best_model: Output[Model],
     metrics: Output[Metrics],
+    job_stats: Output[Metrics],
 ):
     import logging
-    from google.cloud import bigquery
-    from common.retry_policies import BIGQUERY_RETRY_POLICY
+    from common.bigquery_ops import get_client, job_stats_scope, run_query
     from google.cloud import aiplatform
 
-    client = bigquery.Client(project=project)
+    client = get_client(project)
 
     eval_metric = "eval_metric_value"
     query = f"""
@@ -376,12 +370,10 @@ def vai_model_cleanup_op(
             ORDER BY {eval_metric} DESC
         """
 
-    job_config = bigquery.QueryJobConfig(labels={"vai-mlops": f"training"})
-    query_job = client.query(
-        query=query, job_config=job_config, job_retry=BIGQUERY_RETRY_POLICY
-    )
-    r = query_job.result()
-    r = list(r)
+    with job_stats_scope(
+        client, f"{project}.{dataset_id}", "vai_model_cleanup_op", run_id, job_stats
+    ):
+        r = list(run_query(client, query, labels={"vai-mlops": f"training"}))
 
     model_id = r[0]["model_name"]
     model_name, model_version = model_id.split("@")
@@ -2,6 +2,7 @@ import pytest
 import yaml
 from pytest_mock import MockerFixture
 
+from common.tests.bigquery_client import api_calls
 from pipelines.components.vertex.component import *
 
 
@@ -90,6 +91,7 @@ def test_vai_model_evaluate_op(config):
             "machine_type": "n1-standard-4",
         },
         metrics=mock.Mock(spec=Metrics),
+        job_stats=mock.Mock(spec=Metrics),
     )
 
 
@@ -116,6 +118,7 @@ def test_vai_batch_prediction_op(config):
         inference_table=inference_table,
         predictions_table=predictions_table,
         model=model,
+        job_stats=mock.Mock(spec=Metrics),
     )
 
 
@@ -127,7 +130,120 @@ def test_vai_model_cleanup_op(config):
     vai_model_cleanup_op.python_func(
         project=config["gcp_project_id"],
         dataset_id=config["bq_dataset_id"],
+        run_id="123",
         keep_n_best_models=None,
         best_model=model,
         metrics=metrics,
+        job_stats=mock.Mock(spec=Metrics),
+    )
+
+
+def test_vai_batch_prediction_op_api_calls(bq_client, mocker):
+    bq_client.get_table.return_value.schema = []
+    job_stats = mocker.Mock(spec=Metrics)
+    mocker.patch("google.cloud.aiplatform.Model")
+
+    vai_batch_prediction_op.python_func(
+        project="project",
+        dataset_id="dataset",
+        run_id="123",
+        inference_table=mocker.Mock(spec=Dataset, metadata={"table_id": "dataset.i"}),
+        predictions_table=mocker.Mock(spec=Dataset, metadata={}),
+        model=mocker.Mock(spec=Model, metadata={"model_id": "model@1"}),
+        job_stats=job_stats,
+    )
+    # inference table schema, temp table expiration, a single job for the write and
+    # the load of its job stats
+    assert api_calls(bq_client) == {
+        "get_table": 2,
+        "update_table": 1,
+        "query": 1,
+        "load_table_from_json": 1,
+    }
+
+
+def test_vai_get_default_model_op_api_calls(bq_client, mocker):
+    from google.cloud.aiplatform_v1.types.model import ModelSourceInfo
+
+    version = mocker.Mock(
+        version_aliases=["default"], model_resource_name="vertex_model", version_id="2"
+    )
+    model = mocker.Mock()
+    model.gca_resource.model_source_info.source_type = (
+        ModelSourceInfo.ModelSourceType.BQML
+    )
+    mocker.patch("google.cloud.aiplatform.init")
+    mocker.patch("google.cloud.aiplatform.Model.list", return_value=[model])
+    registry = mocker.patch("google.cloud.aiplatform.ModelRegistry")
+    registry.return_value.list_versions.return_value = [version]
+    bq_client.list_models.return_value = [mocker.Mock(model_id="model_1")]
+    bq_client.get_model.return_value.model_id = "model_1"
+    bq_client.get_model.return_value.training_runs = [
+        {"vertexAiModelId": "vertex_model", "vertexAiModelVersion": "2"}
+    ]
+    default_model = mocker.Mock(spec=Model, metadata={})
+
+    vai_get_default_model_op.python_func(
+        project="project",
+        region="region",
+        dataset_id="dataset",
+        default_model=default_model,
+    )
+    # the BQML model of the default version, found among the dataset's models
+    assert api_calls(bq_client) == {"list_models": 1, "get_model": 1}
+    assert default_model.metadata["model_id"] == "project.dataset.model_1"
+
+
+def test_vai_model_evaluate_op_api_calls(bq_client, mocker):
+    import json
+
+    mocker.patch("google.cloud.aiplatform.init")
+    mocker.patch("google.cloud.aiplatform.Model")
+    mocker.patch("google.cloud.aiplatform.CustomJob")
+    gcs = mocker.patch("google.cloud.storage.Client")
+    gcs.return_value.download_blob_to_file.side_effect = (
+        lambda blob_or_uri, file_obj: file_obj.write(
+            json.dumps({"eval_metric_name": "auc", "auc": 0.9}).encode()
+        )
+    )
+    metrics = mocker.Mock(spec=Metrics)
+
+    vai_model_evaluate_op.python_func(
+        project="project",
+        region="region",
+        run_id="123",
+        model={"model_id": "model@1", "dataset_id": "dataset"},
+        training_table=mocker.Mock(spec=Dataset, metadata={"table_id": "dataset.t"}),
+        custom_training_params={
+            "model_serving_container_image_uri": "image",
+            "container_uri": "image",
+        },
+        metrics=metrics,
+        job_stats=mocker.Mock(spec=Metrics),
+    )
+    # a single job for the evaluation write and the load of its job stats
+    assert api_calls(bq_client) == {"query": 1, "load_table_from_json": 1}
+    metrics.log_metric.assert_called_once_with("auc", 0.9)
+
+
+def test_vai_model_cleanup_op_api_calls(bq_client, mocker):
+    registry = mocker.patch("google.cloud.aiplatform.ModelRegistry")
+    bq_client.query.return_value.result.return_value = [
+        {"model_name": "model@2", "eval_metric": 0.9},
+        {"model_name": "model@1", "eval_metric": 0.8},
+    ]
+    best_model = mocker.Mock(spec=Model, metadata={})
+
+    vai_model_cleanup_op.python_func(
+        project="project",
+        dataset_id="dataset",
+        run_id="123",
+        keep_n_best_models=None,
+        eval_metrics=[],
+        best_model=best_model,
+        metrics=mocker.Mock(spec=Metrics),
+        job_stats=mocker.Mock(spec=Metrics),
     )
+    assert api_calls(bq_client) == {"query": 1, "load_table_from_json": 1}
+    assert best_model.metadata["model_id"] == "model@2"
+    registry.return_value.add_version_aliases.assert_called_once_with(["default"], "2")
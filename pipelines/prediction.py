@@ -2,6 +2,8 @@ from typing import Optional
 
 import kfp.dsl as dsl
 
+from common.config import schema_activation_ga4mp_runner
+from pipelines import config
 from pipelines.components.activation.component import (
     validate_activation_config_op,
     activation_ga4mp_op,
@@ -17,6 +19,25 @@ from pipelines.components.vertex.component import (
     vai_batch_prediction_op,
 )
 
+# resources are part of the compiled pipeline, so they come from the config file
+# rather than from the activation_config parameter
+ga4mp_runner = schema_activation_ga4mp_runner.validate(
+    ((config.get("activation") or {}).get("ga4mp") or {}).get("runner", {})
+)
+
+
+def set_runner_resources(task, runner):
+    for key, set_resource in (
+        ("cpu_request", task.set_cpu_request),
+        ("cpu_limit", task.set_cpu_limit),
+        ("memory_request", task.set_memory_request),
+        ("memory_limit", task.set_memory_limit),
+    ):
+        if key in runner:
+            set_resource(runner[key])
+
+    return task
+
 
 @dsl.pipeline()
 def prediction_pipeline_bqml(
@@ -25,6 +46,7 @@ def prediction_pipeline_bqml(
     bq_dataset_id: str,
     data_date_start_days_ago: int,
     activation_config: Optional[dict],
+    cost_guardrails: dict,
 ):
     run = (
         run_metadata_op(data_date_start_days_ago=data_date_start_days_ago)
@@ -40,6 +62,7 @@ def prediction_pipeline_bqml(
             p_mode="INFERENCE",
             p_date_start=run.outputs["date_start"],
             p_date_end=run.outputs["date_end"],
+            cost_guardrails=cost_guardrails,
         )
         .set_cpu_limit("1")
         .set_memory_limit("1G")
@@ -64,6 +87,7 @@ def prediction_pipeline_bqml(
             run_id=run.outputs["run_id"],
             inference_table=ds.outputs["inference_table"],
             model=bqml_best_model.outputs["default_model"],
+            cost_guardrails=cost_guardrails,
         )
         .set_cpu_limit("1")
         .set_memory_limit("1G")
@@ -82,11 +106,16 @@ def prediction_pipeline_bqml(
         name="check-if-activation-ga4mp-config-exists",
         condition=act_ga4mp_cfg.outputs["valid"] == True,
     ):
-        activation_ga4mp_op(
-            project=gcp_project_id,
-            dataset_id=bq_dataset_id,
-            run_id=run.outputs["run_id"],
-            cfg=act_ga4mp_cfg.outputs["config"],
+        set_runner_resources(
+            activation_ga4mp_op(
+                project=gcp_project_id,
+                region=gcp_region,
+                dataset_id=bq_dataset_id,
+                run_id=run.outputs["run_id"],
+                cfg=act_ga4mp_cfg.outputs["config"],
+                cost_guardrails=cost_guardrails,
+            ),
+            ga4mp_runner,
         ).after(bqml_predict)
 
     # bq_routine activation
@@ -117,6 +146,7 @@ def prediction_pipeline_custom(
     bq_dataset_id: str,
     data_date_start_days_ago: int,
     activation_config: Optional[dict],
+    cost_guardrails: dict,
 ):
     run = (
         run_metadata_op(data_date_start_days_ago=data_date_start_days_ago)
@@ -132,6 +162,7 @@ def prediction_pipeline_custom(
             p_mode="INFERENCE",
             p_date_start=run.outputs["date_start"],
             p_date_end=run.outputs["date_end"],
+            cost_guardrails=cost_guardrails,
         )
         .set_cpu_limit("1")
         .set_memory_limit("1G")
@@ -174,11 +205,16 @@ def prediction_pipeline_custom(
         name="check-if-activation-ga4mp-config-exists",
         condition=act_ga4mp_cfg.outputs["valid"] == True,
     ):
-        activation_ga4mp_op(
-            project=gcp_project_id,
-            dataset_id=bq_dataset_id,
-            run_id=run.outputs["run_id"],
-            cfg=act_ga4mp_cfg.outputs["config"],
+        set_runner_resources(
+            activation_ga4mp_op(
+                project=gcp_project_id,
+                region=gcp_region,
+                dataset_id=bq_dataset_id,
+                run_id=run.outputs["run_id"],
+                cfg=act_ga4mp_cfg.outputs["config"],
+                cost_guardrails=cost_guardrails,
+            ),
+            ga4mp_runner,
         ).after(vai_predict)
 
     # bq_routine activation
@@ -26,6 +26,7 @@ def training_pipeline_bqml(
     data_date_start_days_ago: int,
     create_model_params: dict,
     keep_n_best_models: Optional[int],
+    cost_guardrails: dict,
 ):
     run = (
         run_metadata_op(data_date_start_days_ago=data_date_start_days_ago)
@@ -41,6 +42,7 @@ def training_pipeline_bqml(
             p_mode="TRAINING",
             p_date_start=run.outputs["date_start"],
             p_date_end=run.outputs["date_end"],
+            cost_guardrails=cost_guardrails,
         )
         .set_cpu_limit("1")
         .set_memory_limit("1G")
@@ -53,6 +55,7 @@ def training_pipeline_bqml(
             dataset_id=bq_dataset_id,
             training_table=ds.outputs["training_table"],
             create_model_params=create_model_params,
+            cost_guardrails=cost_guardrails,
         )
         .set_cpu_limit("1")
         .set_memory_limit("1G")
@@ -83,6 +86,7 @@ def training_pipeline_bqml(
         bqml_model_cleanup_op(
             project=gcp_project_id,
             dataset_id=bq_dataset_id,
+            run_id=run.outputs["run_id"],
             keep_n_best_models=keep_n_best_models,
             eval_metrics=dsl.Collected(bqml_eval.outputs["metrics"]),
         )
@@ -96,6 +100,7 @@ def training_pipeline_bqml(
         run_id=run.outputs["run_id"],
         model=bqml_model_cleanup.outputs["best_model"],
         training_table=ds.outputs["training_table"],
+        cost_guardrails=cost_guardrails,
     ).set_cpu_limit("1").set_memory_limit("1G").after(bqml_model_cleanup)
 
 
@@ -107,6 +112,7 @@ def training_pipeline_custom(
     data_date_start_days_ago: int,
     custom_training_params: dict,
     keep_n_best_models: Optional[int],
+    cost_guardrails: dict,
 ):
     run = (
         run_metadata_op(data_date_start_days_ago=data_date_start_days_ago)
@@ -122,6 +128,7 @@ def training_pipeline_custom(
             p_mode="TRAINING",
             p_date_start=run.outputs["date_start"],
             p_date_end=run.outputs["date_end"],
+            cost_guardrails=cost_guardrails,
         )
         .set_cpu_limit("1")
         .set_memory_limit("1G")
@@ -169,6 +176,7 @@ def training_pipeline_custom(
         vai_model_cleanup_op(
             project=gcp_project_id,
             dataset_id=bq_dataset_id,
+            run_id=run.outputs["run_id"],
             keep_n_best_models=keep_n_best_models,
             eval_metrics=dsl.Collected(vai_eval.outputs["metrics"]),
         )
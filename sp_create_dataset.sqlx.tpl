@@ -8,9 +8,135 @@ BEGIN
 
   DECLARE LOOKBACK_DAYS INT64 DEFAULT {{ bq_sp_params.lookback }};
   DECLARE LOOKAHEAD_DAYS INT64 DEFAULT {{ bq_sp_params.lookahead }};
+{%- if bq_sp_params.session_cache | default(false) %}
+  DECLARE SESSIONS_REFRESH_DAYS INT64 DEFAULT {{ bq_sp_params.sessions_refresh_days | default(3) }};
+  DECLARE build_days ARRAY<DATE>;
+  DECLARE build_start, build_end DATE;
+
+  ----
+  -- sessions_daily caches the per session metrics of every event day, both modes read from it
+  -- so a run only scans the event days that are not cached yet, plus the last SESSIONS_REFRESH_DAYS
+  -- days which GA4 may still update with late events. The metrics cover whole sessions, not only
+  -- the events within the lookback and lookahead of the visitor's last event, see the readme
+  ----
+  CREATE TABLE IF NOT EXISTS `{{ gcp_project_id }}.{{ bq_dataset_id }}.sessions_daily` (
+    user_pseudo_id STRING,
+    session_id STRING,
+    date DATE,
+    session_start_tstamp TIMESTAMP,
+    session_end_tstamp TIMESTAMP,
+    time_on_site INT64,
+    pageviews INT64,
+    view_items INT64,
+    view_promotions INT64,
+    view_search_results INT64,
+    add_to_carts INT64,
+    begin_checkout INT64,
+    purchase INT64
+  )
+  PARTITION BY date
+  CLUSTER BY user_pseudo_id;
+
+  SET build_days = (
+    SELECT ARRAY_AGG(day)
+    FROM UNNEST(GENERATE_DATE_ARRAY(date_start - LOOKBACK_DAYS, LEAST(date_end + LOOKAHEAD_DAYS, CURRENT_DATE()))) as day
+    WHERE
+      day >= CURRENT_DATE() - SESSIONS_REFRESH_DAYS
+      OR day NOT IN (
+        SELECT DISTINCT date
+        FROM `{{ gcp_project_id }}.{{ bq_dataset_id }}.sessions_daily`
+        WHERE date BETWEEN date_start - LOOKBACK_DAYS AND date_end + LOOKAHEAD_DAYS
+      )
+  );
+
+  -- wildcard tables are only pruned by constant filters, not by subqueries, hence the variables
+  SET (build_start, build_end) = (SELECT AS STRUCT MIN(day), MAX(day) FROM UNNEST(build_days) as day);
+
+  IF ARRAY_LENGTH(build_days) > 0 THEN
+    -- replaces the sessions of the (re)built days, days without events simply stay uncached
+    MERGE `{{ gcp_project_id }}.{{ bq_dataset_id }}.sessions_daily` as t
+    USING (
+      SELECT
+        user_pseudo_id,
+        user_pseudo_id ||"/"||event_date||"/"|| (SELECT value.int_value FROM UNNEST(event_params) WHERE key = "ga_session_id") as session_id,
+        SAFE.PARSE_DATE('%Y%m%d', _TABLE_SUFFIX) as date,
+        MIN(TIMESTAMP_MICROS(event_timestamp)) as session_start_tstamp,
+        MAX(TIMESTAMP_MICROS(event_timestamp)) as session_end_tstamp,
+
+        TIMESTAMP_DIFF(MAX(TIMESTAMP_MICROS(event_timestamp)), MIN(TIMESTAMP_MICROS(event_timestamp)), SECOND) as time_on_site,
+        COUNTIF(event_name = 'page_view') as pageviews,
+        COUNTIF(event_name = 'view_item') as view_items,
+        COUNTIF(event_name = 'view_promotion') as view_promotions,
+        COUNTIF(event_name = 'view_search_results') as view_search_results,
+        COUNTIF(event_name = 'add_to_cart') as add_to_carts,
+        COUNTIF(event_name = 'begin_checkout') as begin_checkout,
+        COUNTIF(event_name = 'purchase') as purchase
+
+      FROM `bigquery-public-data.ga4_obfuscated_sample_ecommerce.events_*`
+      WHERE
+        -- the range of the build_start/build_end variables prunes the scanned tables,
+        -- the list then skips the cached days in it
+        SAFE.PARSE_DATE('%Y%m%d', _TABLE_SUFFIX) BETWEEN build_start AND build_end
+        AND SAFE.PARSE_DATE('%Y%m%d', _TABLE_SUFFIX) IN UNNEST(build_days)
+      GROUP BY
+        1, 2, 3
+    ) as s
+    ON FALSE
+    WHEN NOT MATCHED BY SOURCE AND t.date IN UNNEST(build_days) THEN DELETE
+    WHEN NOT MATCHED THEN INSERT ROW;
+  END IF;
+{%- endif %}
 
   CREATE OR REPLACE TEMP TABLE dataset AS (
     WITH
+{%- if bq_sp_params.session_cache | default(false) %}
+      sessions AS (
+        SELECT *
+        FROM `{{ gcp_project_id }}.{{ bq_dataset_id }}.sessions_daily`
+        WHERE date BETWEEN date_start - LOOKBACK_DAYS AND date_end + LOOKAHEAD_DAYS
+      ),
+
+      visitor_pool AS (
+      ----
+      -- Should return only user_pseudo_ids that are eligible for the dataset creation.
+      -- Potential exclusions: bounced sessions, visitors with only one session, must have more than 2 total pageviews
+      ----
+        SELECT
+          user_pseudo_id,
+          MAX(date) as last_event_date,
+          MAX(session_end_tstamp) as last_event_tstamp,
+          SUM(
+            IF(session_end_tstamp >= TIMESTAMP_SUB(last_event_tstamp, INTERVAL LOOKBACK_DAYS DAY), pageviews, 0)
+          ) as pageviews
+        FROM (
+          SELECT
+            user_pseudo_id,
+            date,
+            session_end_tstamp,
+            pageviews,
+            MAX(session_end_tstamp) OVER (PARTITION BY user_pseudo_id) as last_event_tstamp,
+          FROM sessions
+          WHERE date <= date_end
+        )
+        GROUP BY user_pseudo_id
+        HAVING
+          last_event_date BETWEEN date_start AND date_end  -- only keep visitors who's last visit is within the range
+          AND pageviews > 1  -- only keep visitors who have more than 1 pageviews
+      ),
+
+      base_sessions AS (
+      ----
+      -- Eligible sessions within the lookback and lookahead of the visitor's last visit
+      ----
+        SELECT
+          s.*
+        FROM sessions as s
+        INNER JOIN visitor_pool as vp
+          ON vp.user_pseudo_id = s.user_pseudo_id
+            AND s.session_end_tstamp >= TIMESTAMP_SUB(vp.last_event_tstamp, INTERVAL LOOKBACK_DAYS DAY)
+            AND s.session_start_tstamp <= TIMESTAMP_ADD(vp.last_event_tstamp, INTERVAL LOOKAHEAD_DAYS DAY)
+      ),
+{%- else %}
       visitor_pool AS (
       ----
       -- Should return only user_pseudo_ids that are eligible for the dataset creation.
@@ -75,11 +201,39 @@ BEGIN
         GROUP BY
           1, 2
       ),
+{%- endif %}
 
       conv AS (
       ----
       -- For each session returns the label
       ----
+{%- if bq_sp_params.label_engine | default('self_join') == 'window' %}
+      -- the first purchase session starting at or after the session's end, found by ordering the session
+      -- ends (0) and the purchase session starts (1) of a visitor in one stream, a start equal to an end
+      -- follows it, so it is within the window like in the self join
+        SELECT
+          user_pseudo_id,
+          session_id,
+          IF(next_conv_tstamp <= TIMESTAMP_ADD(tstamp, INTERVAL LOOKAHEAD_DAYS DAY), next_conv_tstamp, NULL) as conv_session_start_tstamp,
+          IF(next_conv_tstamp <= TIMESTAMP_ADD(tstamp, INTERVAL LOOKAHEAD_DAYS DAY), 1, 0) as label
+
+        FROM (
+          SELECT
+            *,
+            MIN(IF(kind = 1, tstamp, NULL)) OVER (
+              PARTITION BY user_pseudo_id ORDER BY tstamp, kind ROWS BETWEEN 1 FOLLOWING AND UNBOUNDED FOLLOWING
+            ) as next_conv_tstamp
+          FROM (
+            SELECT user_pseudo_id, session_id, session_end_tstamp as tstamp, 0 as kind
+            FROM base_sessions
+            UNION ALL
+            SELECT user_pseudo_id, session_id, session_start_tstamp as tstamp, 1 as kind
+            FROM base_sessions
+            WHERE purchase > 0
+          )
+        )
+        WHERE kind = 0
+{%- else %}
         SELECT
           bs1.user_pseudo_id,
           bs1.session_id,
@@ -92,6 +246,7 @@ BEGIN
           bs2.user_pseudo_id = bs1.user_pseudo_id
           AND bs2.session_start_tstamp BETWEEN bs1.session_end_tstamp AND TIMESTAMP_ADD(bs1.session_end_tstamp, INTERVAL LOOKAHEAD_DAYS DAY)
         GROUP BY 1, 2
+{%- endif %}
       )
 
     SELECT
@@ -1,16 +1,16 @@
 WITH
-  p_map AS (  -- produces the latest proba to percentile map for each model
+  p_bounds AS (  -- produces the latest proba to percentile boundaries for each model
     SELECT
       * EXCEPT(training_run_id)
-    FROM `{{ gcp_project_id }}.{{ bq_dataset_id }}.model_percentile_map`
+    FROM `{{ gcp_project_id }}.{{ bq_dataset_id }}.model_percentile_bounds`
     WHERE TRUE
     QUALIFY MAX(training_run_id) OVER (PARTITION BY model_name) = training_run_id
   ),
 
-  p_latest AS (  -- gets all predictions for the latest prediction run for the latest session by client_id
+  p_latest AS (  -- gets the predictions of this prediction run for the latest session by client_id
     SELECT
       p.*,
-      p_map.percentile
+      p_bounds.percentiles[OFFSET(RANGE_BUCKET(p.proba, p_bounds.bounds))] as percentile
     FROM (
       SELECT
         date,
@@ -23,38 +23,19 @@ WITH
         (SELECT plp.prob FROM UNNEST(predicted_label_probs) as plp WHERE plp.label = 1) as proba
 
       FROM `{{ gcp_project_id }}.{{ bq_dataset_id }}.predictions` as p
-      WHERE date >= CURRENT_DATE() - 7
-      QUALIFY MAX(prediction_run_id) OVER() = prediction_run_id
+      WHERE date IN UNNEST(@prediction_dates)  -- this run's dates in the prediction_runs index, prunes to its partitions
+        AND prediction_run_id = @prediction_run_id  -- set by the activation step, prunes to this run's cluster
     ) as p
-    INNER JOIN p_map
-      ON p_map.model_name = p.model_name
-          AND p.proba >= p_map.lower_bnd AND p.proba < p_map.upper_bnd
+    INNER JOIN p_bounds USING (model_name)
+    WHERE p.proba IS NOT NULL
     QUALIFY ROW_NUMBER() OVER (PARTITION BY client_id ORDER BY p.event_timestamp DESC) = 1
   ),
 
-  p_before_latest AS (  -- gets the latest predictions for each latest session before the last prediction run
+  last_sent AS (  -- last percentile sent to GA4 by client_id, maintained by the activation step
     SELECT
-      p.*,
-      p_map.percentile
-    FROM (
-      SELECT
-        date,
-        prediction_run_id,
-        model_name,
-        session_id,
-
-        user_pseudo_id as client_id,
-        session_end_tstamp as event_timestamp,
-        (SELECT plp.prob FROM UNNEST(predicted_label_probs) as plp WHERE plp.label = 1) as proba
-
-      FROM `{{ gcp_project_id }}.{{ bq_dataset_id }}.predictions` as p
-      WHERE date >= CURRENT_DATE() - 7
-      QUALIFY MAX(prediction_run_id) OVER() != prediction_run_id
-    ) as p
-    INNER JOIN p_map
-      ON p_map.model_name = p.model_name
-          AND p.proba >= p_map.lower_bnd AND p.proba < p_map.upper_bnd
-    QUALIFY ROW_NUMBER() OVER (PARTITION BY client_id ORDER BY p.event_timestamp DESC) = 1
+      client_id,
+      percentile
+    FROM `{{ gcp_project_id }}.{{ bq_dataset_id }}.activation_state`
   )
 
   SELECT
@@ -68,7 +49,7 @@ WITH
 #    'USD' as ep_currency_  # for GAds conversion event integration
 
   FROM p_latest as pl
-  LEFT JOIN p_before_latest as pbl USING (client_id)
+  LEFT JOIN last_sent as ls USING (client_id)
   WHERE
-    pbl.percentile IS NULL  -- if prior prediction doesn't exist we need to pass to GA4
-    OR pbl.percentile != pl.percentile  -- if prior prediction is different than current we need to pass to GA4
+    ls.percentile IS NULL  -- if nothing was sent yet we need to pass to GA4
+    OR ls.percentile != pl.percentile  -- if the last sent percentile is different than current we need to pass to GA4
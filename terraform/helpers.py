@@ -174,6 +174,7 @@ def compile_training(config):
             "data_date_start_days_ago": config["training"]["data_date_start_days_ago"],
             "create_model_params": config["model"].get("create_model_params", {}),
             "keep_n_best_models": config["training"]["keep_n_best_models"],
+            "cost_guardrails": config["cost_guardrails"],
         }
 
     elif config["model"]["type"] == "CUSTOM":
@@ -186,6 +187,7 @@ def compile_training(config):
             "data_date_start_days_ago": config["training"]["data_date_start_days_ago"],
             "custom_training_params": config["model"].get("custom_training_params", {}),
             "keep_n_best_models": config["training"]["keep_n_best_models"],
+            "cost_guardrails": config["cost_guardrails"],
         }
 
     compile_pipeline(
@@ -230,6 +232,7 @@ def compile_prediction(config):
                 "data_date_start_days_ago"
             ],
             "activation_config": activation_config,
+            "cost_guardrails": config["cost_guardrails"],
         }
 
     elif config["model"]["type"] == "CUSTOM":
@@ -245,6 +248,7 @@ def compile_prediction(config):
                 "data_date_start_days_ago"
             ],
             "activation_config": activation_config,
+            "cost_guardrails": config["cost_guardrails"],
         }
 
     compile_pipeline(